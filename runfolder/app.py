@@ -1,21 +1,135 @@
+import atexit
+import os
+import shutil
+import signal
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.web
+from tornado.concurrent import dummy_executor
+
 from arteria.web.app import AppService
 from runfolder.handlers import *
+from runfolder.lib.shared_index import SharedDatabase
 
 
-def start():
-    """Entry point of the web service"""
-    app_svc = AppService.create(__package__)
-    runfolder_svc = RunfolderService(app_svc.config_svc)
+def _config_value(config_svc, key, default):
+    try:
+        value = config_svc[key]
+    except KeyError:
+        value = None
+    return default if value is None else value
 
-    # Setup the routing. Help will be automatically available at /api, and will be based on
-    # the doc strings of the get/post/put/delete methods
-    args = dict(app_svc=app_svc, runfolder_svc=runfolder_svc, config_svc=app_svc.config_svc)
-    routes = [
+
+def create_executor(config_svc):
+    """
+    Creates the thread pool in which the handlers access the file system. The size
+    is set by the config value thread_pool_size. If it's 0, the handlers access the
+    file system directly on the IOLoop.
+    """
+    size = _config_value(config_svc, "thread_pool_size", 8)
+    if size == 0:
+        return dummy_executor
+    return ThreadPoolExecutor(max_workers=size)
+
+
+def routes(**args):
+    """Returns the routes of the service, with args passed on to each handler"""
+    return [
         (r"/api/1.0/runfolders", ListAvailableRunfoldersHandler, args),
         (r"/api/1.0/runfolders/next", NextAvailableRunfolderHandler, args),
         (r"/api/1.0/runfolders/pickup", PickupAvailableRunfolderHandler, args),
+        (r"/api/1.0/runfolders/events", RunfolderEventsHandler, args),
+        (r"/api/1.0/runfolders/states", RunfolderStatesHandler, args),
+        (r"/api/1.0/runfolders/lookup", RunfolderLookupHandler, args),
         (r"/api/1.0/runfolders/path(/.*)", RunfolderHandler, args),
-        (r"/api/1.0/runfolders/test/markasready/path(/.*)", TestFakeSequencerReadyHandler, args)
+        (r"/api/1.0/runfolders/test/markasready/path(/.*)", TestFakeSequencerReadyHandler, args),
+        (r"/api/1.0/monitored_directories", MonitoredDirectoriesHandler, args),
+        (r"/api/1.0/metrics", MetricsHandler, args)
     ]
-    app_svc.start(routes)
 
+
+def shared_index_path(config_svc):
+    """
+    Returns the path of the database where the scanner process shares the runfolder
+    index. It's in shared_index_dir, or runfolder_store_dir, or else a new temporary
+    directory, which is removed when the service exits.
+    """
+    directory = _config_value(config_svc, "shared_index_dir", None) or \
+        _config_value(config_svc, "runfolder_store_dir", None)
+    if not directory:
+        directory = tempfile.mkdtemp(prefix="arteria-runfolder-")
+        _remove_on_exit(directory)
+    return os.path.join(directory, "shared_index.sqlite")
+
+
+def _remove_on_exit(directory):
+    """
+    Removes directory when the parent of the forked processes exits, also when it's
+    terminated. The forked processes inherit the exit handler, but don't run it.
+    """
+    parent = os.getpid()
+
+    def remove():
+        if os.getpid() == parent:
+            shutil.rmtree(directory, ignore_errors=True)
+    atexit.register(remove)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+def start_processes(app_svc, processes):
+    """
+    Serves the requests from several processes. The port is bound once, and then the
+    processes are forked. The first process is the scanner, which keeps the runfolder
+    index and shares it with the other processes, so that the monitored directories
+    are only scanned once.
+    """
+    config_svc = app_svc.config_svc
+    sockets = tornado.netutil.bind_sockets(app_svc._port)
+    path = shared_index_path(config_svc)
+    # Cleared before forking, so that the workers can't see a database left behind by
+    # an earlier run as ready
+    SharedDatabase(path).create()
+    task_id = tornado.process.fork_processes(processes)
+    # Only the parent cleans up when it's terminated
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    runfolder_svc = RunfolderService(config_svc)
+    if task_id == 0:
+        runfolder_svc.start_scanner(path)
+    else:
+        runfolder_svc.start_worker(path)
+
+    args = dict(app_svc=app_svc, runfolder_svc=runfolder_svc, config_svc=config_svc,
+                executor=create_executor(config_svc))
+    # AppService.start listens on the port itself, so its setup of the routes is
+    # repeated here, with the sockets bound before forking instead
+    app_routes = routes(**args)
+    app_routes.extend(app_svc._get_default_routes())
+    app_svc.route_svc.set_routes(app_routes)
+    server = tornado.httpserver.HTTPServer(tornado.web.Application(app_svc.route_svc.get_routes()))
+    server.add_sockets(sockets)
+    tornado.ioloop.IOLoop.current().start()
+
+
+def start():
+    """Entry point of the web service"""
+    app_svc = AppService.create(__package__)
+    processes = _config_value(app_svc.config_svc, "worker_processes", 1)
+    if processes > 1:
+        start_processes(app_svc, processes)
+        return
+
+    runfolder_svc = RunfolderService(app_svc.config_svc)
+    runfolder_svc.start()
+
+    # Setup the routing. Help will be automatically available at /api, and will be based on
+    # the doc strings of the get/post/put/delete methods
+    args = dict(app_svc=app_svc, runfolder_svc=runfolder_svc, config_svc=app_svc.config_svc,
+                executor=create_executor(app_svc.config_svc))
+    app_svc.start(routes(**args))
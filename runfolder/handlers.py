@@ -1,14 +1,31 @@
+import base64
+import binascii
+import datetime
+import hashlib
+import itertools
 import sys
 
+import tornado.gen
+import tornado.iostream
 import tornado.web
+from tornado.escape import json_decode, json_encode
 
 import arteria
 from arteria.web.state import State
 from arteria.exceptions import InvalidArteriaStateException
 from arteria.web.handlers import BaseRestHandler
 
+from runfolder.lib import metrics
+from runfolder.lib.filters import RunfolderFilter
 from runfolder.services import *
 
+
+JSON_CONTENT_TYPE = "application/json; charset=UTF-8"
+
+REQUEST_DURATION = metrics.registry.histogram(
+    "runfolder_http_request_duration_seconds", "Time to handle an HTTP request",
+    ["handler", "method", "code"])
+
 class BaseRunfolderHandler(BaseRestHandler):
     """Provides core logic for all runfolder handlers"""
 
@@ -16,82 +33,292 @@ class BaseRunfolderHandler(BaseRestHandler):
         """Empty implementation of abstract method"""
         pass
 
-    def append_runfolder_link(self, runfolder_info):
+    def runfolder_json(self, runfolder_info, projection=None):
+        """
+        Returns the runfolder_info as JSON, with a link to the HTTP endpoint of the
+        runfolder. If projection is given, only those fields are included.
+        """
+        return runfolder_info.to_json(link=self.create_runfolder_link(runfolder_info.path), fields=projection)
+
+    def write_runfolder(self, runfolder_info):
+        """Writes the runfolder_info, with its link, as JSON"""
+        self.set_header("Content-Type", JSON_CONTENT_TYPE)
+        self.write(self.runfolder_json(runfolder_info))
+
+    def write_runfolders(self, runfolders, projection=None, **fields):
         """
-        Adds a new attribute (link) to the runfolder_info object, that points to
-        the HTTP endpoint of the runfolder
+        Writes a JSON object with the runfolders, with their links, as 'runfolders'
+        and any other fields. The runfolders are encoded one by one straight into the
+        response buffer, rather than building the whole response first. If projection
+        is given, only those fields of the runfolders are included.
         """
-        runfolder_info.link = self.create_runfolder_link(runfolder_info.path)
+        self.set_header("Content-Type", JSON_CONTENT_TYPE)
+        self.write("{")
+        for name, value in fields.items():
+            self.write(json_encode(name) + ": " + json_encode(value) + ", ")
+        self.write('"runfolders": [')
+        link_prefix = self.create_runfolder_link("")
+        separator = ""
+        for runfolder_info in runfolders:
+            self.write(separator + runfolder_info.to_json(link=link_prefix + runfolder_info.path,
+                                                          fields=projection))
+            separator = ", "
+        self.write("]}")
 
     def create_runfolder_link(self, path):
         """Creates an HTTP endpoint from the path"""
         return "{0:s}/runfolders/path{1:s}".format(self.api_link(), path)
 
-    def initialize(self, app_svc, runfolder_svc, config_svc):
+    def initialize(self, app_svc, runfolder_svc, config_svc, executor):
         """Initializes the handler's member variables"""
         self.app_svc = app_svc
         self.runfolder_svc = runfolder_svc
         self.config_svc = config_svc
+        self.executor = executor
+
+    def run_in_executor(self, fn, *args):
+        """
+        Runs fn in the handler's thread pool, so that file system access doesn't
+        block the IOLoop. Returns a future that can be yielded in a coroutine.
+        """
+        return self.executor.submit(fn, *args)
+
+    def on_finish(self):
+        REQUEST_DURATION.observe(self.request.request_time(), handler=type(self).__name__,
+                                 method=self.request.method, code=self.get_status())
 
 
 class ListAvailableRunfoldersHandler(BaseRunfolderHandler):
     """Handles listing all available runfolders"""
+    @tornado.gen.coroutine
     def get(self):
         """
         List all runfolders that are ready. Add the query parameter 'state'
         for filtering. By default, state=READY is assumed. Query for state=* to
         get all monitored runfolders.
+
+        The runfolders are ordered by path. To page through them, add the query
+        parameter 'limit' with the maximum number of runfolders to return. The
+        response then contains 'next_cursor', which is passed as the query parameter
+        'cursor' to get the next page. It's null on the last page.
+
+        Add the query parameter stream=true to get the runfolders as JSON lines, one
+        runfolder per line, written as they are read. If there are more runfolders
+        than 'limit', the last line is an object with only 'next_cursor'.
+
+        The runfolders can be filtered further with these query parameters, which are
+        applied before the runfolders are read, as far as possible:
+
+        - root: The monitored directory, can be repeated
+        - instrument: The name of the instrument, e.g. NovaSeq, can be repeated
+        - glob: A shell-style pattern that the path must match, e.g. *_A00123_*
+        - min_marker_age, max_marker_age: The age of the completed marker, in seconds.
+          Runfolders without a marker don't match.
+
+        Add the query parameter 'fields' with a comma-separated list of fields, e.g.
+        fields=path,state, to only get those fields of the runfolders. If metadata isn't
+        one of them, it's not read.
+
+        If a monitored directory doesn't respond, the runfolders last seen in it are
+        listed, and it's included in 'stale_directories'. When streaming, these are in
+        the header X-Stale-Directories instead.
+
+        If the runfolder index is enabled, the response has an ETag, except when
+        filtering on the marker age. Pass it in the header If-None-Match to get 304 Not
+        Modified if no runfolder has changed.
         """
-        def get_runfolders():
-            try:
-                # TODO: This list should be paged. The unfiltered list can be large
-                state = self.get_argument("state", State.READY)
-                if state == "*":
-                    state = None
-                for runfolder_info in self.runfolder_svc.list_runfolders(state):
-                    self.append_runfolder_link(runfolder_info)
-                    yield runfolder_info
-            except InvalidRunfolderState:
-                raise tornado.web.HTTPError(400, "The state '{}' is not accepted".format(state))
+        state = self.get_argument("state", State.READY)
+        if state == "*":
+            state = None
+        limit = self._limit_argument()
+        after = self._cursor_argument()
+        stream = self.get_argument("stream", "false").lower() == "true"
+        filters = self._filters_argument()
+        projection = self._fields_argument()
+
+        # Runfolders age in and out of marker age filters without the index changing
+        etag = None if filters is not None and filters.depends_on_time else self._listing_etag()
+        if etag is not None:
+            self.set_header("Etag", etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                return
 
-        self.write_object({"runfolders": [runfolder.__dict__ for runfolder in get_runfolders()]})
+        with_metadata = projection is None or "metadata" in projection
+        try:
+            runfolders = yield self.run_in_executor(self.runfolder_svc.list_runfolders, state, after,
+                                                    filters, with_metadata)
+        except InvalidRunfolderState:
+            raise tornado.web.HTTPError(400, "The state '{}' is not accepted".format(state))
+        except PathNotMonitored as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+        if stream:
+            stale_directories = self.runfolder_svc.stale_directories()
+            if stale_directories:
+                self.set_header("X-Stale-Directories", ",".join(stale_directories))
+            yield self._stream_runfolders(runfolders, limit, projection)
+            return
+
+        if limit:
+            runfolders = yield self.run_in_executor(lambda: list(itertools.islice(runfolders, limit + 1)))
+        else:
+            runfolders = yield self.run_in_executor(list, runfolders)
+
+        fields = dict()
+        if limit:
+            has_more = len(runfolders) > limit
+            runfolders = runfolders[:limit]
+            fields["next_cursor"] = self.encode_cursor(runfolders[-1].path) if has_more else None
+        stale_directories = self.runfolder_svc.stale_directories()
+        if stale_directories:
+            fields["stale_directories"] = stale_directories
+        self.write_runfolders(runfolders, projection, **fields)
+
+    @tornado.gen.coroutine
+    def _stream_runfolders(self, runfolders, limit, projection=None):
+        """Writes the runfolders as JSON lines, flushing each as soon as it has been read"""
+        self.set_header("Content-Type", "application/x-ndjson")
+        count = 0
+        last_path = None
+        while True:
+            runfolder_info = yield self.run_in_executor(next, runfolders, None)
+            if runfolder_info is None:
+                break
+            if limit and count == limit:
+                self.write(json_encode({"next_cursor": self.encode_cursor(last_path)}) + "\n")
+                break
+            self.write(self.runfolder_json(runfolder_info, projection) + "\n")
+            yield self.flush()
+            count += 1
+            last_path = runfolder_info.path
+
+    def _listing_etag(self):
+        """
+        Returns the ETag of the listing, or None if the service can't tell when the
+        runfolders change. It's derived from the version of the runfolders, the stale
+        monitored directories and the request, as the response depends on the query
+        and links to the host.
+        """
+        version = self.runfolder_svc.listing_version()
+        if version is None:
+            return None
+        request = "{0} {1} {2} {3}".format(version, ",".join(self.runfolder_svc.stale_directories()),
+                                           self.request.host, self.request.uri)
+        return '"{0}"'.format(hashlib.sha1(request.encode("utf-8")).hexdigest())
+
+    def _filters_argument(self):
+        """Returns a RunfolderFilter of the filter query parameters, or None if there are none"""
+        roots = self._list_arguments("root")
+        instruments = self._list_arguments("instrument")
+        glob = self.get_argument("glob", None)
+        min_marker_age = self._age_argument("min_marker_age")
+        max_marker_age = self._age_argument("max_marker_age")
+        if not (roots or instruments or glob or min_marker_age is not None or max_marker_age is not None):
+            return None
+        return RunfolderFilter(roots=roots, glob=glob, instruments=instruments,
+                               min_marker_age=min_marker_age, max_marker_age=max_marker_age)
+
+    def _fields_argument(self):
+        """Returns the fields to include of each runfolder, or None for all of them"""
+        fields = self._list_arguments("fields")
+        if not fields:
+            return None
+        unknown = [field for field in fields if field not in RunfolderInfo.FIELDS]
+        if unknown:
+            raise tornado.web.HTTPError(400, "Unknown fields {0}, expecting any of {1}".format(
+                ", ".join(unknown), ", ".join(RunfolderInfo.FIELDS)))
+        return frozenset(fields)
+
+    def _list_arguments(self, name):
+        """Returns the values of a query parameter that can be repeated or comma-separated"""
+        return [value for argument in self.get_arguments(name) for value in argument.split(",") if value]
+
+    def _age_argument(self, name):
+        age = self.get_argument(name, None)
+        if age is None:
+            return None
+        try:
+            age = float(age)
+        except ValueError:
+            age = -1
+        if age < 0:
+            raise tornado.web.HTTPError(400, "The {0} must be a non-negative number of seconds".format(name))
+        return age
+
+    def _limit_argument(self):
+        limit = self.get_argument("limit", None)
+        if limit is None:
+            return None
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise tornado.web.HTTPError(400, "The limit must be a positive integer")
+        return limit
+
+    def _cursor_argument(self):
+        cursor = self.get_argument("cursor", None)
+        if not cursor:
+            return None
+        try:
+            return self.decode_cursor(cursor)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "The cursor '{}' is not valid".format(cursor))
+
+    @staticmethod
+    def encode_cursor(path):
+        """Encodes the path of the last runfolder on a page into an opaque cursor"""
+        return base64.urlsafe_b64encode(path.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Decodes a cursor into the path of the last runfolder on the previous page
+
+        :raises ValueError if the cursor is not valid
+        """
+        try:
+            return base64.b64decode(cursor.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+        except (binascii.Error, UnicodeError) as e:
+            raise ValueError(str(e))
 
 
 class NextAvailableRunfolderHandler(BaseRunfolderHandler):
     """Handles fetching the next available runfolder"""
+    @tornado.gen.coroutine
     def get(self):
         """
         Returns the next runfolder to process. Note that it will not lock the runfolder, and unless its
         state is changed by the polling client quickly enough it will be presented again.
         """
-        runfolder_info = self.runfolder_svc.next_runfolder()
+        runfolder_info = yield self.run_in_executor(self.runfolder_svc.next_runfolder)
         if runfolder_info:
-            self.append_runfolder_link(runfolder_info)
-            self.write_object(runfolder_info)
+            self.write_runfolder(runfolder_info)
         else:
             self.set_status(204, reason="No ready runfolder available.")
-            self.write(dict())
 
 
 class PickupAvailableRunfolderHandler(BaseRunfolderHandler):
     """Handles fetching the next available runfolder"""
+    @tornado.gen.coroutine
     def get(self):
         """
         Returns the next runfolder to process and set it's state to PENDING.
+
+        Each ready runfolder is only returned once, also when it's called concurrently.
         """
-        runfolder_info = self.runfolder_svc.next_runfolder()
+        runfolder_info = yield self.run_in_executor(self.runfolder_svc.pickup_runfolder)
         if runfolder_info:
-            self.append_runfolder_link(runfolder_info)
-            self.runfolder_svc.set_runfolder_state(runfolder_info.path, State.PENDING)
-            runfolder_info.state = State.PENDING
-            self.write_object(runfolder_info)
+            self.write_runfolder(runfolder_info)
         else:
             self.set_status(204, reason="No ready runfolders available.")
-            self.write(dict())
 
 
 class RunfolderHandler(BaseRunfolderHandler):
     """Handles a particular runfolder, identified by path"""
+    @tornado.gen.coroutine
     def get(self, path):
         """
         Returns information about the runfolder at the path.
@@ -99,14 +326,14 @@ class RunfolderHandler(BaseRunfolderHandler):
         The runfolder must a subdirectory of a monitored path.
         """
         try:
-            runfolder_info = self.runfolder_svc.get_runfolder_by_path(path)
-            self.append_runfolder_link(runfolder_info)
-            self.write_object(runfolder_info)
+            runfolder_info = yield self.run_in_executor(self.runfolder_svc.get_runfolder_by_path, path)
+            self.write_runfolder(runfolder_info)
         except PathNotMonitored:
             raise tornado.web.HTTPError(400, "Searching an unmonitored path '{0}'".format(path))
         except DirectoryDoesNotExist:
             raise tornado.web.HTTPError(404, "Runfolder '{0}' does not exist".format(path))
 
+    @tornado.gen.coroutine
     def post(self, path):
         """
         Sets the state of the runfolder. Note that it's currently assumed that only one
@@ -120,7 +347,7 @@ class RunfolderHandler(BaseRunfolderHandler):
         state = json_body["state"]
 
         try:
-            self.runfolder_svc.set_runfolder_state(path, state)
+            yield self.run_in_executor(self.runfolder_svc.set_runfolder_state, path, state)
         except InvalidArteriaStateException:
             raise tornado.web.HTTPError(400, "The state '{}' is not valid".format(state))
         except DirectoryDoesNotExist:
@@ -145,6 +372,242 @@ class RunfolderHandler(BaseRunfolderHandler):
             raise tornado.web.HTTPError(400, "Directory exists")
 
 
+class RunfolderLookupHandler(BaseRunfolderHandler):
+    """Handles looking up several runfolders by path at once"""
+
+    MAX_PATHS = 10000
+
+    @tornado.gen.coroutine
+    def post(self):
+        """
+        Returns information about the runfolders at several paths.
+
+        Accepts the following JSON message: {"paths": ["/path/to/runfolder", ...]}
+
+        Returns the runfolders that were found in the same order as 'paths', with the
+        paths that are not in a monitored directory in 'not_monitored' and those that
+        don't exist in 'not_found'.
+        """
+        paths = self._paths_argument()
+        results = yield self.run_in_executor(self.runfolder_svc.get_runfolders_by_path, paths)
+        runfolders = [result for result in results if isinstance(result, RunfolderInfo)]
+        not_monitored = [path for path, result in zip(paths, results) if isinstance(result, PathNotMonitored)]
+        not_found = [path for path, result in zip(paths, results) if isinstance(result, DirectoryDoesNotExist)]
+        self.write_runfolders(runfolders, not_monitored=not_monitored, not_found=not_found)
+
+    def _paths_argument(self):
+        try:
+            paths = json_decode(self.request.body)["paths"]
+        except (ValueError, KeyError, TypeError):
+            raise tornado.web.HTTPError(400, "Expecting a JSON body with a list of 'paths'")
+        if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+            raise tornado.web.HTTPError(400, "Expecting 'paths' to be a list of paths")
+        if len(paths) > self.MAX_PATHS:
+            raise tornado.web.HTTPError(400, "At most {0} runfolders can be looked up at once".format(self.MAX_PATHS))
+        return paths
+
+
+class RunfolderStatesHandler(BaseRunfolderHandler):
+    """Handles setting the states of several runfolders at once"""
+
+    MAX_UPDATES = 10000
+
+    @tornado.gen.coroutine
+    def post(self):
+        """
+        Sets the states of several runfolders.
+
+        Accepts the following JSON message:
+            {"runfolders": [{"path": "/path/to/runfolder", "state": "[NONE|READY|STARTED|DONE|ERROR]"}, ...]}
+
+        All updates are validated before any state is set. If any of them is invalid,
+        e.g. the runfolder doesn't exist, no state is set and 400 is returned. The
+        states are then set in parallel.
+
+        Returns the updates in the same order as 'runfolders', each with 'updated'
+        and, if it's false, the 'error' that prevented the update.
+        """
+        updates = self._updates_argument()
+        try:
+            errors = yield self.run_in_executor(self.runfolder_svc.set_runfolder_states, updates)
+            applied = True
+        except InvalidStateUpdates as e:
+            self.set_status(400, reason=str(e))
+            errors = e.errors
+            applied = False
+
+        self.set_header("Content-Type", JSON_CONTENT_TYPE)
+        self.write(json_encode({"runfolders": [
+            {"path": path, "state": state, "updated": applied and error is None, "error": error}
+            for (path, state), error in zip(updates, errors)]}))
+
+    def _updates_argument(self):
+        try:
+            runfolders = json_decode(self.request.body)["runfolders"]
+        except (ValueError, KeyError, TypeError):
+            raise tornado.web.HTTPError(400, "Expecting a JSON body with a list of 'runfolders'")
+        if not isinstance(runfolders, list) or not all(
+                isinstance(runfolder, dict) and isinstance(runfolder.get("path"), str) and
+                isinstance(runfolder.get("state"), str) for runfolder in runfolders):
+            raise tornado.web.HTTPError(400, "Expecting a 'path' and a 'state' for each of the 'runfolders'")
+        if len(runfolders) > self.MAX_UPDATES:
+            raise tornado.web.HTTPError(400, "At most {0} runfolders can be updated at once".format(self.MAX_UPDATES))
+        return [(runfolder["path"], runfolder["state"]) for runfolder in runfolders]
+
+
+class RunfolderEventsHandler(BaseRunfolderHandler):
+    """Handles following the state transitions of the runfolders"""
+
+    DEFAULT_TIMEOUT_SECONDS = 30
+    MAX_TIMEOUT_SECONDS = 300
+    MAX_EVENTS = 1000
+
+    def initialize(self, *args, **kwargs):
+        super(RunfolderEventsHandler, self).initialize(*args, **kwargs)
+        self._closed = False
+        self._waiting = None
+
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Returns the state transitions of the runfolders after the sequence number
+        in the query parameter 'since', e.g. when the completed marker of a runfolder
+        has aged past the grace period, or when a client has set its state. If there
+        are none, waits up to 'timeout' seconds (30 by default) for one.
+
+        The response is {"events": [...], "last_sequence": n, "missed": false}. Each
+        event has the sequence, path, previous_state, state, time and link of the
+        transition. Pass last_sequence as 'since' in the next request to resume. If
+        'since' is omitted, only transitions after the request are returned. 'missed'
+        is true if transitions after 'since' are no longer kept, in which case the
+        runfolders should be listed to catch up.
+
+        With the header Accept: text/event-stream, the transitions are streamed as
+        Server-Sent Events with the sequence as the id, so that a reconnecting client
+        resumes after the Last-Event-ID. A comment is sent every 'timeout' seconds to
+        keep the connection open.
+
+        All transitions are seen when the runfolder index is enabled. Otherwise only
+        the states set through the service, and the transitions seen when runfolders
+        are listed, are published.
+        """
+        events = self.runfolder_svc.events
+        timeout = self._timeout_argument()
+        if "text/event-stream" in self.request.headers.get("Accept", ""):
+            since = self._since_argument(self.request.headers.get("Last-Event-ID"))
+            yield self._stream_events(events, since, timeout)
+            return
+
+        since = self._since_argument()
+        # The sequence numbers start over when the service is restarted
+        restarted = since > events.last_sequence
+        if restarted:
+            since = 0
+        found, missed = events.since(since, self.MAX_EVENTS)
+        if not found and timeout:
+            yield self._wait_for_events(events, since, timeout)
+            found, missed = events.since(since, self.MAX_EVENTS)
+
+        self.set_header("Content-Type", JSON_CONTENT_TYPE)
+        self.write(json_encode({"events": [self.event_dict(event) for event in found],
+                                "last_sequence": found[-1].sequence if found else since,
+                                "missed": missed or restarted}))
+
+    @tornado.gen.coroutine
+    def _stream_events(self, events, since, timeout):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        if since > events.last_sequence:
+            since = 0
+        try:
+            yield self.flush()
+            while not self._closed:
+                found, missed = events.since(since, self.MAX_EVENTS)
+                if missed:
+                    self.write("event: missed\ndata: {}\n\n")
+                for event in found:
+                    self.write("id: {0}\nevent: state\ndata: {1}\n\n".format(
+                        event.sequence, json_encode(self.event_dict(event))))
+                    since = event.sequence
+                if not found:
+                    received = yield self._wait_for_events(events, since, timeout or self.DEFAULT_TIMEOUT_SECONDS)
+                    if not received:
+                        self.write(": keepalive\n\n")
+                if not self._closed:
+                    yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    @tornado.gen.coroutine
+    def _wait_for_events(self, events, since, timeout):
+        """Waits up to timeout seconds for events after since. Returns True if there are any."""
+        self._waiting = events.wait(since)
+        try:
+            yield tornado.gen.with_timeout(datetime.timedelta(seconds=timeout), self._waiting)
+            return True
+        except tornado.gen.TimeoutError:
+            return False
+        finally:
+            events.cancel(self._waiting)
+            self._waiting = None
+
+    def on_connection_close(self):
+        self._closed = True
+        if self._waiting is not None and not self._waiting.done():
+            self._waiting.set_result(None)
+
+    def event_dict(self, event):
+        return {"sequence": event.sequence, "path": event.path, "previous_state": event.previous_state,
+                "state": event.state, "time": event.time, "link": self.create_runfolder_link(event.path)}
+
+    def _since_argument(self, default=None):
+        since = self.get_argument("since", default)
+        if since is None:
+            return self.runfolder_svc.events.last_sequence
+        try:
+            since = int(since)
+        except ValueError:
+            since = -1
+        if since < 0:
+            raise tornado.web.HTTPError(400, "'since' must be a sequence number")
+        return since
+
+    def _timeout_argument(self):
+        try:
+            timeout = float(self.get_argument("timeout", self.DEFAULT_TIMEOUT_SECONDS))
+        except ValueError:
+            timeout = -1
+        if not 0 <= timeout <= self.MAX_TIMEOUT_SECONDS:
+            raise tornado.web.HTTPError(
+                400, "The timeout must be between 0 and {0} seconds".format(self.MAX_TIMEOUT_SECONDS))
+        return timeout
+
+
+class MonitoredDirectoriesHandler(BaseRunfolderHandler):
+    """Handles the health of the monitored directories"""
+
+    def get(self):
+        """
+        Returns the health of each monitored directory. A directory that has failed to
+        be listed, or timed out, scan_root_failure_threshold times in a row has an open
+        circuit. It isn't listed by requests, its last known runfolders are listed
+        instead, and it's probed in the background until it responds again.
+        """
+        self.write_object({"monitored_directories": self.runfolder_svc.monitored_directory_status()})
+
+
+class MetricsHandler(BaseRunfolderHandler):
+    """Exposes the metrics of the service"""
+
+    def get(self):
+        """
+        Returns the request and scan timings, cache counts and runfolder counts per
+        state in the Prometheus text format
+        """
+        self.set_header("Content-Type", metrics.registry.CONTENT_TYPE)
+        self.write(metrics.registry.render())
+
+
 class TestFakeSequencerReadyHandler(BaseRunfolderHandler):
     """
     Handles setting the sequencing finished marker
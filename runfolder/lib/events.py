@@ -0,0 +1,93 @@
+"""
+A log of runfolder state transitions that clients can follow, rather than polling
+for the runfolders' states.
+
+Each transition gets a sequence number, one higher than the previous, so that a
+client can resume after the last transition it has seen. Only the most recent
+transitions are kept, a client that falls further behind than that is told that
+it has missed some, and should list the runfolders to catch up.
+"""
+
+import collections
+import threading
+import time
+
+import tornado.concurrent
+import tornado.ioloop
+
+
+# A state transition of a runfolder:
+#   sequence: The sequence number of the transition
+#   path: The path of the runfolder
+#   previous_state: The state before the transition, or None if it's not known
+#   state: The state after the transition
+#   time: When the transition was seen, in seconds since the epoch
+RunfolderEvent = collections.namedtuple("RunfolderEvent", ["sequence", "path", "previous_state", "state", "time"])
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class RunfolderEventLog:
+    """
+    Keeps the last `capacity` RunfolderEvents. Events can be published from any thread,
+    while waiting for events is done on an IOLoop.
+    """
+
+    def __init__(self, capacity=10000):
+        self._lock = threading.Lock()
+        self._events = collections.deque(maxlen=capacity)
+        self._last_sequence = 0
+        # The futures of the clients waiting for the next event, with the IOLoop they
+        # wait on
+        self._waiters = []
+
+    @property
+    def last_sequence(self):
+        """The sequence number of the last event, 0 if there have been none"""
+        return self._last_sequence
+
+    def publish(self, path, previous_state, state):
+        """Adds a transition of the runfolder at path to the log and wakes all waiting clients"""
+        with self._lock:
+            self._last_sequence += 1
+            event = RunfolderEvent(self._last_sequence, path, previous_state, state, time.time())
+            self._events.append(event)
+            waiters, self._waiters = self._waiters, []
+        for io_loop, future in waiters:
+            io_loop.add_callback(_resolve, future)
+        return event
+
+    def since(self, sequence, limit=None):
+        """
+        Returns the events after sequence, at most limit of them, and whether any
+        events after sequence have been dropped from the log
+        """
+        with self._lock:
+            if not self._events or sequence >= self._last_sequence:
+                return [], False
+            first = self._events[0].sequence
+            missed = sequence + 1 < first
+            start = max(0, sequence + 1 - first)
+            end = len(self._events) if limit is None else min(len(self._events), start + limit)
+            return [self._events[i] for i in range(start, end)], missed
+
+    def wait(self, sequence):
+        """
+        Returns a future that is resolved, on the current IOLoop, when there are events
+        after sequence. Pass the future to cancel if the client stops waiting.
+        """
+        future = tornado.concurrent.Future()
+        with self._lock:
+            if sequence < self._last_sequence:
+                future.set_result(None)
+            else:
+                self._waiters.append((tornado.ioloop.IOLoop.current(), future))
+        return future
+
+    def cancel(self, future):
+        """Stops waking the client waiting on future"""
+        with self._lock:
+            self._waiters = [(io_loop, waiting) for io_loop, waiting in self._waiters if waiting is not future]
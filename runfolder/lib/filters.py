@@ -0,0 +1,73 @@
+"""
+Filters on the runfolders to list, other than their state.
+
+The filters are checked in the order of what they cost. The monitored root and the
+path are checked before a runfolder is read at all, the age of the completed marker
+and the instrument before the metadata of the runfolder is built.
+"""
+
+import fnmatch
+import os
+import re
+import time
+
+
+class RunfolderFilter:
+    """
+    Matches runfolders on their monitored root, a glob of their path, their instrument
+    and the age of their completed marker. A filter that isn't given matches all
+    runfolders.
+    """
+
+    def __init__(self, roots=None, glob=None, instruments=None, min_marker_age=None, max_marker_age=None):
+        """
+        :param roots: The monitored directories to list runfolders in
+        :param glob: A shell-style pattern that the path of the runfolder must match
+        :param instruments: The names of the instruments, e.g. NovaSeq, case insensitive
+        :param min_marker_age: The minimum age of the completed marker, in seconds
+        :param max_marker_age: The maximum age of the completed marker, in seconds
+        """
+        self.roots = frozenset(os.path.normpath(root) for root in roots) if roots else None
+        self.glob = glob
+        self._glob_pattern = re.compile(fnmatch.translate(glob)) if glob else None
+        self.instruments = frozenset(instrument.lower() for instrument in instruments) if instruments else None
+        self.min_marker_age = min_marker_age
+        self.max_marker_age = max_marker_age
+
+    @property
+    def reads_runfolder(self):
+        """True if the runfolder has to be read to tell whether it matches"""
+        return self.instruments is not None or self.depends_on_time
+
+    @property
+    def depends_on_time(self):
+        """True if a runfolder can start or stop matching without changing"""
+        return self.min_marker_age is not None or self.max_marker_age is not None
+
+    def matches_root(self, root):
+        return self.roots is None or os.path.normpath(root) in self.roots
+
+    def matches_path(self, path, root):
+        """Returns True if the runfolder at path, in the monitored directory root, matches the root and glob filters"""
+        if root is None or not self.matches_root(root):
+            return False
+        return self._glob_pattern is None or self._glob_pattern.match(path) is not None
+
+    def matches_instrument(self, name):
+        return self.instruments is None or name.lower() in self.instruments
+
+    def matches_marker_mtime(self, marker_mtime, now=None):
+        """
+        Returns True if a completed marker modified at marker_mtime matches the age
+        filters. A runfolder without a marker only matches if there are none.
+        """
+        if not self.depends_on_time:
+            return True
+        if marker_mtime is None:
+            return False
+        age = (time.time() if now is None else now) - marker_mtime
+        if self.min_marker_age is not None and age < self.min_marker_age:
+            return False
+        if self.max_marker_age is not None and age > self.max_marker_age:
+            return False
+        return True
@@ -0,0 +1,174 @@
+"""
+Tracks the health of the monitored directories, so that one that stops responding,
+e.g. a stalled NFS mount, doesn't hold up every request.
+
+Each monitored directory has a circuit breaker. The circuit is opened when listing
+the directory has failed or timed out failure_threshold times in a row. While it's
+open, the directory isn't listed by requests, the runfolders last seen in it are
+served instead and flagged as stale, and the directory is probed in the background
+every probe_interval seconds. The circuit is closed when a probe succeeds.
+"""
+
+import logging
+import threading
+import time
+
+
+CLOSED = "closed"
+OPEN = "open"
+
+
+class DirectoryHealth:
+    """The health of one monitored directory"""
+
+    def __init__(self, path):
+        self.path = path
+        self.circuit = CLOSED
+        self.consecutive_failures = 0
+        self.last_success = None
+        self.last_failure = None
+        self.last_error = None
+        self.last_duration = None
+        self.probing = False
+
+    @property
+    def stale(self):
+        """True if the runfolders of the directory might not be current"""
+        return self.consecutive_failures > 0
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "circuit": self.circuit,
+            "stale": self.stale,
+            "consecutive_failures": self.consecutive_failures,
+            "last_success": self.last_success,
+            "last_failure": self.last_failure,
+            "last_error": self.last_error,
+            "last_scan_seconds": self.last_duration,
+        }
+
+
+class MonitoredDirectoryHealth:
+    """
+    The circuit breakers of the monitored directories. Failures and successes are
+    recorded by whoever lists the directories, from any thread.
+    """
+
+    def __init__(self, failure_threshold=3, probe_interval=30, logger=None):
+        """
+        :param failure_threshold: The number of failures in a row that opens the
+                                  circuit of a directory, 0 to never open it
+        :param probe_interval: Seconds between probes of a directory with an open circuit
+        """
+        self._failure_threshold = failure_threshold
+        self._probe_interval = probe_interval
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._directories = dict()
+        # Called with the status of all directories whenever it changes
+        self._listeners = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _health(self, path):
+        health = self._directories.get(path)
+        if health is None:
+            health = self._directories[path] = DirectoryHealth(path)
+        return health
+
+    def is_open(self, path):
+        """Returns True if the directory at path shouldn't be listed"""
+        with self._lock:
+            health = self._directories.get(path)
+            return health is not None and health.circuit == OPEN
+
+    def stale_directories(self):
+        """Returns the directories whose runfolders might not be current, ordered by path"""
+        with self._lock:
+            return sorted(path for path, health in self._directories.items() if health.stale)
+
+    def status(self):
+        """Returns the health of each directory seen so far as a dict, ordered by path"""
+        with self._lock:
+            return [self._directories[path].to_dict() for path in sorted(self._directories)]
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def record_success(self, path, duration):
+        """Records that the directory at path was listed in duration seconds"""
+        with self._lock:
+            health = self._health(path)
+            recovered = health.circuit == OPEN
+            health.circuit = CLOSED
+            health.consecutive_failures = 0
+            health.last_success = time.time()
+            health.last_duration = duration
+        if recovered:
+            self._logger.warning("The monitored directory {0} responds again, closed its circuit".format(path))
+        self._notify()
+
+    def record_failure(self, path, error):
+        """Records that listing the directory at path failed or timed out, as described by error"""
+        with self._lock:
+            health = self._health(path)
+            health.consecutive_failures += 1
+            health.last_failure = time.time()
+            health.last_error = error
+            opened = (health.circuit == CLOSED and self._failure_threshold > 0 and
+                      health.consecutive_failures >= self._failure_threshold)
+            if opened:
+                health.circuit = OPEN
+        if opened:
+            self._logger.warning("The monitored directory {0} failed {1} times in a row ({2}), opened its circuit "
+                                 "and serving its last known runfolders".format(path, self._failure_threshold, error))
+        self._notify()
+
+    def _notify(self):
+        if not self._listeners:
+            return
+        status = self.status()
+        for listener in self._listeners:
+            listener(status)
+
+    def start_probing(self, probe):
+        """
+        Probes the directories with an open circuit in a background thread, by calling
+        probe with their path. Each probe runs in its own thread, as a probe of a hung
+        file system might never return, and a directory is only probed once at a time.
+        """
+        self._thread = threading.Thread(target=self._probe_loop, args=(probe,),
+                                        name="runfolder-directory-prober")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _probe_loop(self, probe):
+        while not self._stopped.wait(self._probe_interval):
+            with self._lock:
+                due = [health for health in self._directories.values()
+                       if health.circuit == OPEN and not health.probing]
+                for health in due:
+                    health.probing = True
+            for health in due:
+                thread = threading.Thread(target=self._probe, args=(probe, health),
+                                          name="runfolder-directory-probe")
+                thread.daemon = True
+                thread.start()
+
+    def _probe(self, probe, health):
+        started = time.time()
+        try:
+            probe(health.path)
+        except Exception as e:
+            self.record_failure(health.path, "probe failed: {0!r}".format(e))
+        else:
+            self.record_success(health.path, time.time() - started)
+        finally:
+            with self._lock:
+                health.probing = False
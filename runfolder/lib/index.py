@@ -0,0 +1,351 @@
+"""
+An in-memory index of the runfolders in the monitored directories and their states
+"""
+
+import logging
+import os
+import threading
+import time
+from xml.parsers.expat import ExpatError
+
+from runfolder.lib import inotify
+from runfolder.lib import metrics
+from runfolder.lib.scheduler import GraceScheduler
+
+
+ROOT_WATCH_MASK = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM |
+                   inotify.IN_MOVED_TO | inotify.IN_ONLYDIR)
+RUNFOLDER_WATCH_MASK = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM |
+                        inotify.IN_MOVED_TO | inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB |
+                        inotify.IN_ONLYDIR)
+STATE_DIR_WATCH_MASK = RUNFOLDER_WATCH_MASK
+
+STATE_DIR = ".arteria"
+STATE_FILE = "state"
+
+READY_LAG = metrics.registry.histogram(
+    "runfolder_index_ready_lag_seconds",
+    "Time from the end of a runfolder's grace period until the index refreshed it",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 30, 60))
+
+
+class RunfolderIndex:
+    """
+    Keeps the RunfolderInfo of every runfolder in the monitored directories in memory,
+    bucketed by state, so that listing runfolders doesn't require a walk of the file system.
+
+    The index is built by a full scan when started. It is then kept current by inotify
+    watches on the monitored directories, the runfolders and their .arteria directories,
+    and by a full reconciliation scan every reconcile_interval seconds. The reconciliation
+    scan also picks up changes inotify can't see, e.g. those made by other NFS clients.
+
+    All inspection of the runfolders is delegated to the RunfolderService.
+    """
+
+    def __init__(self, runfolder_svc, reconcile_interval=300, use_inotify=True, logger=None):
+        """
+        :param runfolder_svc: The RunfolderService used to inspect the runfolders
+        :param reconcile_interval: Seconds between full reconciliation scans
+        :param use_inotify: Keep the index current with inotify between scans if True
+        """
+        self._runfolder_svc = runfolder_svc
+        self._reconcile_interval = reconcile_interval
+        self._use_inotify = use_inotify
+        self._logger = logger or logging.getLogger(__name__)
+
+        self._lock = threading.RLock()
+        self._entries = dict()
+        self._by_state = dict()
+        # Increased whenever a runfolder is added, removed or changes, so that clients
+        # can tell whether a listing has changed. The start time tells indexes apart.
+        self._generation = 0
+        self._started = time.time()
+        # Called with the path of each runfolder that is added, removed or refreshed
+        self._listeners = []
+        # Runfolders with a completed marker that is still within the grace period,
+        # scheduled to be refreshed when they become ready
+        self._grace_scheduler = GraceScheduler()
+        # Wakes the background thread when a runfolder is scheduled before the time it
+        # sleeps until
+        self._wake_up = threading.Event()
+        self._sleeping_until = None
+
+        self._inotify = None
+        self._monitored_roots = set()
+        self._relevant_file_names = set()
+        self._watches = dict()
+        self._watched_paths = dict()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Builds the index and starts keeping it current in the background"""
+        self._monitored_roots = set(self._runfolder_svc._monitored_directories())
+        self._relevant_file_names = (set(self._runfolder_svc.RUN_PARAMETERS_FILE_NAMES) |
+                                     self._runfolder_svc._instruments.completed_marker_files() |
+                                     set(self._runfolder_svc._candidate_matcher.required_files))
+        if self._use_inotify:
+            try:
+                self._inotify = inotify.Inotify()
+            except inotify.InotifyUnavailable as e:
+                self._logger.warning("inotify is not available, relying on rescans only: {0}".format(e))
+
+        self.reconcile()
+
+        if self._inotify:
+            self._start_thread(self._watch_loop, "runfolder-index-watcher")
+        self._start_thread(self._reconcile_loop, "runfolder-index-reconciler")
+
+    def stop(self):
+        self._stopped.set()
+        self._wake_up.set()
+        for thread in self._threads:
+            thread.join()
+        if self._inotify:
+            self._inotify.close()
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def runfolders(self, state=None, after=None):
+        """
+        Yields the indexed RunfolderInfos in the given state, or all of them
+        if state is None, ordered by path. Only runfolders with a path after `after`
+        are included, if it's specified.
+        """
+        with self._lock:
+            if state:
+                infos = list(self._by_state.get(state, dict()).values())
+            else:
+                infos = list(self._entries.values())
+        if after is not None:
+            infos = [info for info in infos if info.path > after]
+        infos.sort(key=lambda info: info.path)
+        return iter(infos)
+
+    def add_listener(self, listener):
+        """Calls listener with the path of each runfolder that is added, removed or refreshed"""
+        self._listeners.append(listener)
+
+    def _notify(self, path):
+        for listener in self._listeners:
+            listener(path)
+
+    def get(self, path):
+        """Returns the indexed RunfolderInfo of the runfolder at path, or None if it's not indexed"""
+        with self._lock:
+            return self._entries.get(path)
+
+    @property
+    def version(self):
+        """A token that changes whenever any indexed runfolder changes"""
+        with self._lock:
+            return "{0:x}.{1}".format(int(self._started * 1000), self._generation)
+
+    def counts(self):
+        """Returns the number of indexed runfolders per state"""
+        with self._lock:
+            return dict((state, len(infos)) for state, infos in self._by_state.items() if infos)
+
+    def reconcile(self):
+        """Rescans all monitored directories and brings the index up to date"""
+        started = time.time()
+        for root in self._runfolder_svc._monitored_directories():
+            self._watch(root, ROOT_WATCH_MASK)
+
+        found = set()
+        unavailable_roots = set()
+        for root, paths in self._runfolder_svc._scan_monitored_directories():
+            if paths is None:
+                unavailable_roots.add(root)
+                continue
+            for path in paths:
+                found.add(path)
+                self.refresh(path)
+
+        # Keep the runfolders of monitored directories that couldn't be listed, rather
+        # than dropping them because the file system is slow
+        roots = self._runfolder_svc._monitored_roots()
+        with self._lock:
+            removed = [path for path in self._entries
+                       if path not in found and roots.root_of(path) not in unavailable_roots]
+        for path in removed:
+            self._remove(path)
+        self._runfolder_svc._flush_store(found if not unavailable_roots else None)
+
+        self._logger.debug("Reconciled the runfolder index with {0} runfolders in {1:.2f}s"
+                           .format(len(found), time.time() - started))
+
+    def refresh(self, path):
+        """Re-reads the runfolder at path from disk and updates its entry in the index"""
+        if not self._runfolder_svc._dir_exists(path):
+            self._remove(path)
+            return
+
+        self._watch(path, RUNFOLDER_WATCH_MASK)
+        if not self._runfolder_svc._is_candidate(path):
+            # Still watched, as it becomes a runfolder when a required file is added
+            self._drop(path)
+            return
+        self._watch(os.path.join(path, STATE_DIR), STATE_DIR_WATCH_MASK)
+
+        try:
+            info, deadline = self._runfolder_svc._runfolder_info_and_deadline(path)
+        except OSError as e:
+            # The runfolder was most likely removed while it was being read
+            self._logger.debug("Could not read runfolder {0}: {1}".format(path, e))
+            self._remove(path)
+            return
+        except ExpatError as e:
+            # Most likely a runParameters.xml that is still being written. The runfolder
+            # is still watched, so it's read again when the file changes.
+            self._logger.warning("Could not parse the run parameters of {0}, leaving it out of the index: {1}"
+                                 .format(path, e))
+            self._drop(path)
+            return
+
+        self._runfolder_svc._observe_state(path, info.state)
+        with self._lock:
+            previous = self._discard(path)
+            if previous is None or previous.state != info.state or previous.metadata != info.metadata:
+                self._generation += 1
+            self._entries[path] = info
+            self._by_state.setdefault(info.state, dict())[path] = info
+            if deadline is not None:
+                self._grace_scheduler.schedule(path, deadline)
+                if self._sleeping_until is not None and deadline < self._sleeping_until:
+                    self._wake_up.set()
+        self._notify(path)
+
+    def _drop(self, path):
+        """Drops the runfolder at path from the index, but keeps watching it"""
+        with self._lock:
+            discarded = self._discard(path) is not None
+            if discarded:
+                self._generation += 1
+        if discarded:
+            self._notify(path)
+
+    def _remove(self, path):
+        with self._lock:
+            if self._discard(path) is not None:
+                self._generation += 1
+        self._runfolder_svc._forget_state(path)
+        self._notify(path)
+        self._unwatch(path)
+        self._unwatch(os.path.join(path, STATE_DIR))
+
+    def _discard(self, path):
+        previous = self._entries.pop(path, None)
+        if previous is not None:
+            self._by_state.get(previous.state, dict()).pop(path, None)
+        self._grace_scheduler.cancel(path)
+        return previous
+
+    def _refresh_due(self):
+        """
+        Refreshes the runfolders whose completed marker has aged past the grace period.
+        Each scheduled runfolder is refreshed once, unless it's scheduled again, e.g.
+        because its marker was touched.
+        """
+        now = time.time()
+        for path, deadline in self._grace_scheduler.pop_due(now):
+            READY_LAG.observe(max(0, now - deadline))
+            self.refresh(path)
+
+    def _watch(self, path, mask):
+        if not self._inotify:
+            return
+        with self._lock:
+            if path in self._watched_paths:
+                return
+        try:
+            wd = self._inotify.add_watch(path, mask)
+        except OSError as e:
+            # The directory doesn't exist (yet), or we've run out of watches, in which
+            # case the reconciliation scan will have to pick up any changes
+            self._logger.debug("Could not watch {0}: {1}".format(path, e))
+            return
+        with self._lock:
+            self._watches[wd] = path
+            self._watched_paths[path] = wd
+
+    def _unwatch(self, path):
+        if not self._inotify:
+            return
+        with self._lock:
+            wd = self._watched_paths.pop(path, None)
+            if wd is not None:
+                self._watches.pop(wd, None)
+        if wd is not None:
+            self._inotify.rm_watch(wd)
+
+    def _runfolder_of_event(self, watched, event):
+        """Returns the path of the runfolder affected by an event, or None if it's irrelevant"""
+        if os.path.basename(watched) == STATE_DIR:
+            return os.path.dirname(watched) if event.name == STATE_FILE else None
+        if watched in self._monitored_roots:
+            # In nested monitored directories, the entries of the root might not be
+            # runfolders, so new runfolders are found by the reconciliation scan
+            if self._runfolder_svc._monitored_depth > 1 or not self._runfolder_svc._is_candidate_name(event.name):
+                return None
+            return os.path.join(watched, event.name)
+        if event.name == STATE_DIR or event.name in self._relevant_file_names:
+            return watched
+        return None
+
+    def _watch_loop(self):
+        while not self._stopped.is_set():
+            try:
+                events = self._inotify.read(timeout=1)
+                dirty = set()
+                for event in events:
+                    if event.mask & inotify.IN_Q_OVERFLOW:
+                        self._logger.warning("The inotify event queue overflowed, rescanning")
+                        self.reconcile()
+                        dirty.clear()
+                        break
+                    with self._lock:
+                        watched = self._watches.get(event.wd)
+                        if event.mask & inotify.IN_IGNORED and watched is not None:
+                            self._watches.pop(event.wd, None)
+                            self._watched_paths.pop(watched, None)
+                    if watched is None or event.mask & inotify.IN_IGNORED:
+                        continue
+                    runfolder = self._runfolder_of_event(watched, event)
+                    if runfolder:
+                        dirty.add(runfolder)
+                for path in dirty:
+                    self._runfolder_svc.invalidate_run_parameters(path)
+                    self.refresh(path)
+            except Exception:
+                self._logger.exception("Failed to process inotify events")
+
+    def _reconcile_loop(self):
+        """
+        Reconciles the index every reconcile_interval seconds, and refreshes the
+        runfolders whose completed marker ages past the grace period in between, so
+        that they become ready without waiting for a query
+        """
+        next_reconcile = time.time() + self._reconcile_interval
+        while True:
+            with self._lock:
+                wake_up = next_reconcile
+                deadline = self._grace_scheduler.next_deadline()
+                if deadline is not None:
+                    wake_up = min(wake_up, deadline)
+                self._sleeping_until = wake_up
+                self._wake_up.clear()
+            self._wake_up.wait(max(0, wake_up - time.time()))
+            if self._stopped.is_set():
+                return
+            try:
+                self._refresh_due()
+                if time.time() >= next_reconcile:
+                    self.reconcile()
+                    next_reconcile = time.time() + self._reconcile_interval
+            except Exception:
+                self._logger.exception("Failed to reconcile the runfolder index")
@@ -0,0 +1,124 @@
+"""
+A minimal wrapper around the Linux inotify API, using ctypes so that no
+extra dependency is required.
+
+Note that inotify only reports changes made through the local kernel. Changes
+made by other hosts on network file systems (e.g. NFS) are not reported, so
+inotify can only ever be used as an optimization on top of periodic rescans.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+class InotifyUnavailable(Exception):
+    pass
+
+
+class InotifyEvent:
+    """An event read from an inotify file descriptor"""
+
+    def __init__(self, wd, mask, cookie, name):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+
+    def __repr__(self):
+        return "InotifyEvent(wd={0}, mask={1:#x}, name={2!r})".format(self.wd, self.mask, self.name)
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        library = ctypes.util.find_library("c")
+        if not library:
+            raise InotifyUnavailable("Could not find the C library")
+        libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise InotifyUnavailable("The C library does not support inotify")
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+class Inotify:
+    """An inotify instance, to which watches can be added and from which events can be read"""
+
+    def __init__(self):
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise InotifyUnavailable("inotify_init1 failed: {0}".format(os.strerror(error)))
+
+    def add_watch(self, path, mask):
+        """
+        Watches path for the events in mask and returns the watch descriptor
+
+        :raises OSError if the watch could not be added, e.g. because the
+                        path doesn't exist or the watch limit is reached
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        """Removes a watch. Errors are ignored, as the watch might already be gone."""
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+    def read(self, timeout=None):
+        """
+        Returns the events that are available, waiting for at most timeout seconds
+        for the first event to arrive
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append(InotifyEvent(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
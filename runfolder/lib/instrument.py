@@ -4,9 +4,15 @@
 # been transferred.
 
 import re
+import threading
 
 
 class InstrumentFactory():
+    @staticmethod
+    def completed_marker_files():
+        """Returns the names of all completed marker files used by the known instruments"""
+        return _default_registry.completed_marker_files()
+
     @staticmethod
     def get_id(run_parameters):
         run_parameters = run_parameters.get('RunParameters', None)
@@ -24,27 +30,118 @@ class InstrumentFactory():
 
     @staticmethod
     def get_instrument(run_parameters):
+        return _default_registry.get_instrument(run_parameters)
+
+
+class InstrumentRegistry():
+    """
+    Finds the instrument of a runfolder by matching its instrument id against the
+    ID_PATTERN of each registered instrument class, in the order they were registered.
+
+    The patterns are compiled when registered, each instrument class has a single
+    instance, and the instrument found for each id is remembered.
+    """
+
+    # The number of instrument ids to remember. Sites have a handful of instruments,
+    # so this is only reached if the ids are garbage.
+    MAX_REMEMBERED_IDS = 4096
+
+    def __init__(self, instrument_classes=None):
+        """
+        :param instrument_classes: The instrument classes to register, by default
+                                   those of the instruments supported by the service
+        """
+        self._lock = threading.Lock()
+        self._default = Instrument()
+        self._instruments = []
+        self._instrument_by_id = dict()
+        self._completed_marker_files = None
+        if instrument_classes is None:
+            instrument_classes = DEFAULT_INSTRUMENT_CLASSES
+        for instrument_class in instrument_classes:
+            self.register(instrument_class)
+
+    def register(self, instrument_class, first=False):
+        """
+        Registers an instrument class, replacing any registered class with the same
+        name. If first is True, it's matched before the other registered classes.
+        """
+        pattern = re.compile(instrument_class.ID_PATTERN)
+        with self._lock:
+            instruments = [(p, instrument) for p, instrument in self._instruments
+                           if type(instrument).__name__ != instrument_class.__name__]
+            entry = (pattern, instrument_class())
+            if first:
+                instruments.insert(0, entry)
+            else:
+                instruments.append(entry)
+            self._instruments = instruments
+            self._instrument_by_id = dict()
+            self._completed_marker_files = None
+
+    def register_from_config(self, instruments):
+        """
+        Registers the instruments described in the config value 'instruments', before
+        the already registered ones, e.g:
+
+            instruments:
+              - name: NextSeq2000
+                id_pattern: ^VH
+                completed_marker_file: CopyComplete.txt
+
+        :raises ValueError if an instrument description is not valid
+        """
+        for description in reversed(instruments or []):
+            try:
+                name = str(description["name"])
+                id_pattern = description["id_pattern"]
+                completed_marker_file = description.get("completed_marker_file",
+                                                        Instrument.COMPLETED_MARKER_FILE_RTA_COMPLETE)
+                re.compile(id_pattern)
+            except (KeyError, TypeError, AttributeError, re.error) as e:
+                raise ValueError("Invalid instrument {0}: {1!r}".format(description, e))
+
+            instrument_class = type(name, (Instrument,), {
+                "ID_PATTERN": id_pattern,
+                "completed_marker_file": staticmethod(lambda marker=completed_marker_file: marker)})
+            self.register(instrument_class, first=True)
+
+    def get_instrument(self, run_parameters):
+        """Returns the Instrument that wrote the run_parameters"""
         if not run_parameters:
-            return Instrument()
+            return self._default
 
         instrument_id = InstrumentFactory.get_id(run_parameters)
 
         if not instrument_id:
-            return Instrument()
-
-        if re.search(NovaSeq.ID_PATTERN, instrument_id):
-            return NovaSeq()
-        if re.search(NovaSeqXPlus.ID_PATTERN, instrument_id):
-            return NovaSeqXPlus()
-        if re.search(ISeq.ID_PATTERN, instrument_id):
-            return ISeq()
-        if re.search(MiSeq.ID_PATTERN, instrument_id):
-            return MiSeq()
-        if re.search(HiSeq.ID_PATTERN, instrument_id):
-            return HiSeq()
-        if re.search(HiSeqX.ID_PATTERN, instrument_id):
-            return HiSeqX()
-        return Instrument()
+            return self._default
+        return self.get_instrument_by_id(instrument_id)
+
+    def get_instrument_by_id(self, instrument_id):
+        instrument = self._instrument_by_id.get(instrument_id)
+        if instrument is not None:
+            return instrument
+
+        instrument = self._default
+        for pattern, candidate in self._instruments:
+            if pattern.search(instrument_id):
+                instrument = candidate
+                break
+
+        instrument_by_id = self._instrument_by_id
+        if len(instrument_by_id) >= self.MAX_REMEMBERED_IDS:
+            instrument_by_id.clear()
+        instrument_by_id[instrument_id] = instrument
+        return instrument
+
+    def completed_marker_files(self):
+        """Returns the names of all completed marker files used by the registered instruments"""
+        marker_files = self._completed_marker_files
+        if marker_files is None:
+            marker_files = frozenset([self._default.completed_marker_file()] +
+                                     [instrument.completed_marker_file() for _, instrument in self._instruments])
+            self._completed_marker_files = marker_files
+        return marker_files
 
 
 class Instrument():
@@ -88,3 +185,10 @@ class HiSeq(Instrument):
 
 class HiSeqX(HiSeq):
     ID_PATTERN = '^ST-E'
+
+
+# The instruments supported by the service, in the order they are matched. The first
+# instrument whose pattern matches an id is used.
+DEFAULT_INSTRUMENT_CLASSES = [NovaSeq, NovaSeqXPlus, ISeq, MiSeq, HiSeq, HiSeqX]
+
+_default_registry = InstrumentRegistry()
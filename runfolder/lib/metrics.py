@@ -0,0 +1,226 @@
+"""
+Minimal metrics in the Prometheus text exposition format, so that the service can be
+scraped without depending on a Prometheus client library.
+
+Usage example:
+    REQUESTS = registry.counter("requests_total", "Number of requests", ["handler"])
+    REQUESTS.inc(handler="list")
+
+    @timed(registry.histogram("scan_seconds", "Time to scan", ["root"]), root=lambda root: root)
+    def scan(self, root):
+        ...
+
+    registry.render()  # Returns the exposition text of all metrics
+"""
+
+import contextlib
+import functools
+import math
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Base class of the metrics, which hold one value per combination of label values"""
+
+    TYPE = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = dict()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError("Expected the labels {0} for {1}, got {2}".format(
+                self.label_names, self.name, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation),
+                 "# TYPE {0} {1}".format(self.name, self.TYPE)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ["{0}{1} {2}".format(self.name, _format_labels(self.label_names, key), _format_value(value))]
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def replace(self, values):
+        """Replaces all values with values, a dict of label value tuples to values"""
+        with self._lock:
+            self._values = dict((tuple(str(v) for v in key), value) for key, value in values.items())
+
+
+class CallbackMetric(Metric):
+    """
+    A metric whose values are read from a callback when it's rendered. The callback
+    returns the value if the metric has no labels, otherwise a dict of label value
+    tuples to values.
+    """
+
+    def __init__(self, name, documentation, metric_type, callback, label_names=()):
+        super(CallbackMetric, self).__init__(name, documentation, label_names)
+        self.TYPE = metric_type
+        self._callback = callback
+
+    def render(self):
+        values = self._callback()
+        if not self.label_names:
+            values = {(): values}
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation),
+                 "# TYPE {0} {1}".format(self.name, self.TYPE)]
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_value(tuple(str(v) for v in key), value))
+        return lines
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the time it takes to run the body of the with statement"""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            labels = _format_labels(self.label_names, key, ("le", _format_value(bound)))
+            lines.append("{0}_bucket{1} {2}".format(self.name, labels, count))
+        labels = _format_labels(self.label_names, key)
+        lines.append("{0}_sum{1} {2}".format(self.name, labels, _format_value(total)))
+        lines.append("{0}_count{1} {2}".format(self.name, labels, counts[-1]))
+        return lines
+
+
+class MetricsRegistry:
+    """Holds the metrics of the service and renders them for scraping"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = dict()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError("The metric {0} is already registered differently".format(metric.name))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def callback(self, name, documentation, metric_type, callback, label_names=()):
+        """
+        Registers a counter or gauge that is read from callback when rendered, replacing
+        any metric previously registered as name
+        """
+        metric = CallbackMetric(name, documentation, metric_type, callback, label_names)
+        with self._lock:
+            self._metrics[name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def timed(histogram, **label_functions):
+    """
+    Decorates a method so that its duration is observed in histogram. The label values
+    are computed by calling each of label_functions with the arguments of the method,
+    excluding self. A label function given by name is a method of self.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            labels = dict((name, (getattr(self, label_function) if isinstance(label_function, str)
+                                  else label_function)(*args, **kwargs))
+                          for name, label_function in label_functions.items())
+            with histogram.time(**labels):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+registry = MetricsRegistry()
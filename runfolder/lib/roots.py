@@ -0,0 +1,66 @@
+"""
+Finds the monitored directory that a path is in, with a trie of the monitored
+directories keyed by path component, so that checking a path costs the same however
+many directories are monitored.
+"""
+
+import os
+
+
+# Marks the trie nodes that are monitored directories, as no path component is None
+_ROOT = None
+
+# Path components that would make a path point outside of the directory it seems to be in
+_INVALID_COMPONENTS = frozenset(["", os.curdir, os.pardir])
+
+
+class MonitoredRoots:
+    """
+    The monitored directories, in which runfolders are found up to depth levels below
+    the directory. A runfolder belongs to the deepest monitored directory it's in.
+    """
+
+    def __init__(self, roots, depth=1):
+        """
+        :param roots: The absolute paths of the monitored directories
+        :param depth: The number of levels below a monitored directory that runfolders are in
+        """
+        self.roots = tuple(roots)
+        self.depth = depth
+        self._trie = dict()
+        for root in self.roots:
+            node = self._trie
+            for component in _components(os.path.normpath(root)):
+                node = node.setdefault(component, dict())
+            node[_ROOT] = root
+
+    def root_of(self, path):
+        """
+        Returns the monitored directory that the runfolder at path (potentially
+        non-existing) is in, or None if it's not in one
+        """
+        if not os.path.isabs(path):
+            return None
+        components = path.split(os.sep)[1:]
+        node = self._trie
+        root = None
+        root_level = None
+        for level, component in enumerate(components):
+            if _ROOT in node:
+                root, root_level = node[_ROOT], level
+            node = node.get(component)
+            if node is None:
+                break
+        if root is None:
+            return None
+        below = components[root_level:]
+        if not 1 <= len(below) <= self.depth or any(component in _INVALID_COMPONENTS for component in below):
+            return None
+        return root
+
+    def is_monitored(self, path):
+        return self.root_of(path) is not None
+
+
+def _components(path):
+    return [component for component in path.split(os.sep) if component]
@@ -0,0 +1,198 @@
+"""
+Reading and caching of the runParameters.xml files found in runfolders
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from xml.parsers import expat
+
+import xmltodict
+
+
+# The elements read from runParameters.xml, as paths below the root element. These
+# are the instrument ids looked up by InstrumentFactory.get_id and the barcodes in
+# the runfolder metadata.
+RUN_PARAMETERS_FIELDS = [
+    ("Setup", "ScannerID"),
+    ("InstrumentName",),
+    ("InstrumentId",),
+    ("ScannerID",),
+    ("InstrumentSerialNumber",),
+    ("ReagentKitBarcode",),
+    ("RfidsInfo", "LibraryTubeSerialBarcode"),
+]
+
+# The consumables are read as a list of records with these fields
+CONSUMABLE_PATH = ("ConsumableInfo", "ConsumableInfo")
+CONSUMABLE_FIELDS = ("SerialNumber", "Type")
+
+
+def parse_run_parameters(path):
+    """Parses the runParameters.xml file at path into a dict"""
+    with open(path) as f:
+        return xmltodict.parse(f.read())
+
+
+class _RunParametersExtractor:
+    """
+    Collects the fields of a runParameters.xml from the events of an expat parser.
+    Character data is only collected within the fields. The whole file is parsed, as
+    which fields a file has depends on the instrument, so that a missing field can't
+    be told apart from one further down.
+    """
+
+    FIELDS = frozenset(RUN_PARAMETERS_FIELDS)
+    CONSUMABLE_LEAVES = frozenset(CONSUMABLE_PATH + (field,) for field in CONSUMABLE_FIELDS)
+    MAX_DEPTH = max(len(path) for path in FIELDS | CONSUMABLE_LEAVES)
+
+    def __init__(self):
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.root = None
+        self.found = dict()
+        self.consumables = None
+        self._consumable = None
+        # The path of the current element below the root, as far down as MAX_DEPTH
+        self._path = []
+        self._depth = -1
+        self._text = None
+
+    def extract(self, f):
+        self.parser.ParseFile(f)
+        record = dict()
+        for field_path, value in self.found.items():
+            _set_path(record, field_path, value)
+        if self.consumables is not None:
+            _set_path(record, CONSUMABLE_PATH, self.consumables)
+        return {self.root: record}
+
+    def _start(self, name, attributes):
+        self._depth += 1
+        if self._depth == 0:
+            self.root = name
+            return
+        if self._depth > self.MAX_DEPTH:
+            return
+        self._path.append(name)
+        path = tuple(self._path)
+        if path in self.FIELDS or (self._consumable is not None and path in self.CONSUMABLE_LEAVES):
+            self._text = []
+            self.parser.CharacterDataHandler = self._text.append
+        elif path == CONSUMABLE_PATH:
+            self._consumable = dict()
+            if self.consumables is None:
+                self.consumables = []
+            self.consumables.append(self._consumable)
+
+    def _end(self, name):
+        depth = self._depth
+        self._depth -= 1
+        if depth == 0 or depth > self.MAX_DEPTH:
+            return
+        path = tuple(self._path)
+        self._path.pop()
+        if self._text is not None and (path in self.FIELDS or path in self.CONSUMABLE_LEAVES):
+            value = "".join(self._text).strip() or None
+            self._text = None
+            self.parser.CharacterDataHandler = None
+            if path in self.FIELDS:
+                self.found.setdefault(path, value)
+            else:
+                self._consumable.setdefault(path[-1], value)
+        elif path == CONSUMABLE_PATH:
+            self._consumable = None
+
+
+def _set_path(record, path, value):
+    for name in path[:-1]:
+        record = record.setdefault(name, dict())
+    record.setdefault(path[-1], value)
+
+
+def extract_run_parameters(path):
+    """
+    Reads the fields in RUN_PARAMETERS_FIELDS and the consumables from the
+    runParameters.xml file at path, without building the full document.
+
+    The file is parsed as a stream and only the text of the fields is kept. The result
+    has the same shape as parse_run_parameters, but only contains the fields that were
+    found, and the consumables are always a list, e.g:
+
+        {"RunParameters": {"InstrumentSerialNumber": "LH00123",
+                           "ConsumableInfo": {"ConsumableInfo": [{"SerialNumber": "LC1-LIB",
+                                                                   "Type": "SampleTube"}]}}}
+
+    :raises xml.parsers.expat.ExpatError if the file is not well-formed, like parse_run_parameters
+    """
+    with open(path, "rb") as f:
+        return _RunParametersExtractor().extract(f)
+
+
+class RunParametersCache:
+    """
+    A bounded LRU cache of parsed runParameters.xml files.
+
+    Entries are keyed by the path of the file and are only considered valid as long
+    as the (mtime, size, inode) of the file is unchanged, so a file that is rewritten
+    or replaced is parsed again on the next lookup.
+
+    The parsed run parameters are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_entries=1024, parser=extract_run_parameters):
+        """
+        :param max_entries: The maximum number of parsed files to keep. Set to 0
+                            to disable caching.
+        :param parser: Callable that parses the file at a path
+        """
+        self._max_entries = max_entries
+        self._parser = parser
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _signature(stat):
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def get(self, path, stat=None):
+        """
+        Returns the parsed run parameters at path, parsing the file only if it
+        is not cached or has changed since it was cached.
+
+        :param stat: The os.stat_result of path, if the caller has it already
+        :raises FileNotFoundError if there is no file at path
+        """
+        signature = self._signature(stat or os.stat(path))
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        run_parameters = self._parser(path)
+
+        if self._max_entries > 0:
+            with self._lock:
+                self._entries[path] = (signature, run_parameters)
+                self._entries.move_to_end(path)
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+        return run_parameters
+
+    def invalidate(self, path=None):
+        """Removes the entry for path from the cache, or all entries if path is None"""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def __len__(self):
+        return len(self._entries)
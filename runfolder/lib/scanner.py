@@ -0,0 +1,206 @@
+"""
+Directory scanning built on os.scandir, so that the existence and type of the files
+in a directory can be checked without a system call per file.
+"""
+
+import fnmatch
+import os
+import re
+import time
+
+
+def subdirectories(path, matcher=None):
+    """
+    Returns the names of the directories in path, skipping all other entries. If a
+    CandidateMatcher is given, only the directories it matches are returned, and the
+    names are matched before the type of an entry is checked.
+    """
+    with os.scandir(path) as entries:
+        if matcher is None:
+            return [entry.name for entry in entries if _is_dir(entry)]
+        return [entry.name for entry in entries
+                if matcher.matches_name(entry.name) and _is_dir(entry) and matcher.has_required_file(entry.path)]
+
+
+def find_runfolders(root, depth, matcher=None, marker_files=(), executor=None):
+    """
+    Returns the paths of the runfolders in root, which are looked for up to depth
+    levels below it. The walk doesn't descend into a directory that contains any of
+    the marker_files, which is a runfolder, and all directories at the deepest level
+    are runfolders, as they are in root when depth is 1. The runfolders are matched
+    with the CandidateMatcher, if one is given, and the other directories are only
+    skipped if the matcher excludes their name.
+
+    The directories of each level are listed concurrently in the executor, if one is
+    given, which mustn't be the one the walk itself runs in.
+
+    :raises OSError if root can't be listed. Directories below it that are removed or
+            can't be read while walking are skipped.
+    """
+    runfolders = []
+    level = [root]
+    for remaining in range(depth, 0, -1):
+        if remaining == 1:
+            listings = _map(executor, lambda path: _subdirectory_paths(path, root, matcher), level)
+            for found in listings:
+                runfolders.extend(found)
+        else:
+            listings = _map(executor, lambda path: _split_directory(path, root, matcher, marker_files), level)
+            level = []
+            for found, descend in listings:
+                runfolders.extend(found)
+                level.extend(descend)
+    return runfolders
+
+
+def _map(executor, fn, items):
+    if executor is None or len(items) < 2:
+        return [fn(item) for item in items]
+    return list(executor.map(fn, items))
+
+
+def _subdirectory_paths(path, root, matcher):
+    try:
+        return [os.path.join(path, name) for name in subdirectories(path, matcher)]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        if path == root:
+            raise
+        return []
+
+
+def _split_directory(path, root, matcher, marker_files):
+    """
+    Returns the paths of the runfolders in path, and those of the other directories
+    in it, which are to be walked further
+    """
+    found = []
+    descend = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if (matcher is not None and matcher.excludes(entry.name)) or not _is_dir(entry):
+                    continue
+                if any(os.path.isfile(os.path.join(entry.path, name)) for name in marker_files):
+                    if matcher is None or matcher.matches(entry.path):
+                        found.append(entry.path)
+                else:
+                    descend.append(entry.path)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        if path == root:
+            raise
+    return found, descend
+
+
+def _is_dir(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def _globs_pattern(globs):
+    """Compiles shell-style patterns into one regular expression that matches any of them"""
+    return re.compile("|".join("(?:{0})".format(fnmatch.translate(glob)) for glob in globs))
+
+
+class CandidateMatcher:
+    """
+    Tells which entries of a monitored directory are runfolders, so that the others
+    are never read. The name of an entry is matched first, which needs no system
+    call, and the required files are only looked for in directories whose name
+    matches.
+    """
+
+    def __init__(self, name_pattern=None, include=None, exclude=None, required_files=None):
+        r"""
+        :param name_pattern: A regular expression that the name must match, e.g.
+                             ^\d{6}_[^_]+_\d+_[^_]+$ for Illumina runfolders
+        :param include: Shell-style patterns, of which the name must match at least one
+        :param exclude: Shell-style patterns, of which the name must match none
+        :param required_files: Names of files, of which the runfolder must contain at least one
+
+        :raises re.error if a pattern is not valid
+        """
+        self._name_pattern = re.compile(name_pattern) if name_pattern else None
+        self._include = _globs_pattern(include) if include else None
+        self._exclude = _globs_pattern(exclude) if exclude else None
+        self.required_files = list(required_files or [])
+
+    def matches_name(self, name):
+        if self._name_pattern is not None and self._name_pattern.search(name) is None:
+            return False
+        if self._include is not None and self._include.match(name) is None:
+            return False
+        return not self.excludes(name)
+
+    def excludes(self, name):
+        """Returns True if the name matches any of the exclude patterns"""
+        return self._exclude is not None and self._exclude.match(name) is not None
+
+    def has_required_file(self, path):
+        """Returns True if the directory at path contains any of the required files, or none are required"""
+        if not self.required_files:
+            return True
+        return any(os.path.isfile(os.path.join(path, name)) for name in self.required_files)
+
+    def matches(self, path):
+        """Returns True if the directory at path, which is known to exist, is a runfolder"""
+        return self.matches_name(os.path.basename(path)) and self.has_required_file(path)
+
+
+class RunfolderEntries:
+    """
+    The entries directly in a runfolder, read with a single os.scandir.
+
+    Existence and type checks are answered from the directory listing. Modification
+    times require a stat, which is cached per entry, so asking again is free.
+    """
+
+    def __init__(self, path, entries):
+        """
+        :param path: The path of the runfolder
+        :param entries: A dict of entry names to os.DirEntry objects
+        """
+        self.path = path
+        self._entries = entries
+
+    @staticmethod
+    def read(path):
+        """
+        Reads the entries of the runfolder at path
+
+        :raises OSError if the runfolder can't be read, e.g. because it doesn't exist
+        """
+        with os.scandir(path) as entries:
+            return RunfolderEntries(path, dict((entry.name, entry) for entry in entries))
+
+    def get(self, name):
+        """Returns the os.DirEntry for name, or None if there is no such entry"""
+        return self._entries.get(name)
+
+    def has_file(self, name):
+        entry = self._entries.get(name)
+        try:
+            return entry is not None and entry.is_file()
+        except OSError:
+            return False
+
+    def has_dir(self, name):
+        entry = self._entries.get(name)
+        return entry is not None and _is_dir(entry)
+
+    def is_older_than(self, name, minutes):
+        """Returns True if the file name exists and was modified at least minutes ago"""
+        modification_time = self.modification_time(name)
+        if modification_time is None:
+            return False
+        return (time.time() - modification_time) >= minutes * 60
+
+    def modification_time(self, name):
+        """Returns the modification time of name, or None if there is no such file"""
+        if not self.has_file(name):
+            return None
+        try:
+            return self._entries[name].stat().st_mtime
+        except OSError:
+            return None
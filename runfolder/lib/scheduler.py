@@ -0,0 +1,83 @@
+"""
+Schedules the runfolders whose completed marker is still within the grace period, so
+that each becomes ready once, when its grace period ends, rather than having the age
+of its marker checked on every query
+"""
+
+import heapq
+import itertools
+import threading
+
+
+class GraceScheduler:
+    """
+    A heap of the times when runfolders become ready. Rescheduling or cancelling a
+    runfolder leaves its old entry in the heap, which is skipped when it comes up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        # The current deadline of each scheduled runfolder
+        self._deadlines = dict()
+        # Breaks ties between equal deadlines, so that paths are never compared
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, path):
+        return path in self._deadlines
+
+    def schedule(self, path, deadline):
+        """Schedules the runfolder at path to become ready at deadline, replacing any earlier schedule"""
+        with self._lock:
+            if self._deadlines.get(path) == deadline:
+                return
+            self._deadlines[path] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._counter), path))
+            self._compact()
+
+    def cancel(self, path):
+        with self._lock:
+            self._deadlines.pop(path, None)
+            self._compact()
+
+    def deadline(self, path):
+        """Returns the time when the runfolder at path becomes ready, or None if it's not scheduled"""
+        return self._deadlines.get(path)
+
+    def next_deadline(self):
+        """Returns the earliest deadline, or None if nothing is scheduled"""
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """
+        Removes and returns (path, deadline) of every runfolder whose deadline is
+        at or before now, earliest first. Each scheduled runfolder is returned once.
+        """
+        due = []
+        with self._lock:
+            while True:
+                self._drop_stale()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                deadline, _, path = heapq.heappop(self._heap)
+                del self._deadlines[path]
+                due.append((path, deadline))
+        return due
+
+    def _drop_stale(self):
+        while self._heap:
+            deadline, _, path = self._heap[0]
+            if self._deadlines.get(path) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        """Rebuilds the heap when most of its entries are stale"""
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._deadlines):
+            self._heap = [entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]]
+            heapq.heapify(self._heap)
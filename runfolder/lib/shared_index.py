@@ -0,0 +1,374 @@
+"""
+Shares the runfolder index between the processes of a multi-process service.
+
+One process, the scanner, owns the RunfolderIndex and writes it to an SQLite database,
+together with the state transitions of the runfolders and the health of the monitored
+directories. The other processes serve requests from the database, so that only the
+scanner reads the monitored directories.
+
+When a state is set in another process, it asks the scanner to refresh the runfolder,
+by adding it to the refresh requests in the database.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import tornado.concurrent
+import tornado.ioloop
+
+from runfolder.lib.events import RunfolderEvent
+from runfolder.lib.health import OPEN
+
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS runfolders (path TEXT PRIMARY KEY, host TEXT, state TEXT, metadata TEXT)",
+    "CREATE TABLE IF NOT EXISTS events (sequence INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, "
+    "previous_state TEXT, state TEXT, time REAL)",
+    "CREATE TABLE IF NOT EXISTS refresh_requests (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT)",
+]
+
+
+class SharedDatabase:
+    """The SQLite database shared by the processes, with a connection per thread"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def create(self):
+        """Creates the database, discarding the contents of any earlier one"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self.connection()
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+            for table in ("meta", "runfolders", "events", "refresh_requests"):
+                connection.execute("DELETE FROM {0}".format(table))
+
+    def meta(self, key):
+        try:
+            row = self.connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        except sqlite3.OperationalError:
+            # The scanner hasn't created the database yet
+            return None
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        connection = self.connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+
+class SharedIndexWriter:
+    """
+    Writes the runfolders of the scanner's RunfolderIndex to the shared database, and
+    refreshes the runfolders that other processes ask to be refreshed. The database is
+    updated by a background thread, at most flush_interval seconds after a change.
+    """
+
+    def __init__(self, index, database, flush_interval=0.05, logger=None):
+        self._index = index
+        self._database = database
+        self._flush_interval = flush_interval
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        # Held while flushing, so that flushes from request threads and the background
+        # thread don't write the same runfolder out of order
+        self._flush_lock = threading.Lock()
+        self._dirty = set()
+        self._stopped = threading.Event()
+        self._thread = None
+        # Written as the version of the shared index, and increased with every flush,
+        # as the index itself might have moved on from what has been written
+        self._started = int(time.time() * 1000)
+        self._flushes = 0
+
+    def start(self):
+        """
+        Writes all indexed runfolders to the database, which must have been created,
+        marks it ready and starts following changes
+        """
+        self._index.add_listener(self.mark)
+        connection = self._database.connection()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO runfolders VALUES (?, ?, ?, ?)",
+                                   [self._row(info) for info in self._index.runfolders()])
+            self._write_version(connection)
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('ready', '1')")
+        self._thread = threading.Thread(target=self._run, name="runfolder-shared-index-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def mark(self, path):
+        """Marks the runfolder at path as changed in the index"""
+        with self._lock:
+            self._dirty.add(path)
+
+    @staticmethod
+    def _row(info):
+        return info.path, info.host, info.state, json.dumps(info.metadata)
+
+    def _write_version(self, connection):
+        self._flushes += 1
+        version = "{0:x}.{1}".format(self._started, self._flushes)
+        connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            try:
+                self._refresh_requested()
+                self.flush()
+            except Exception:
+                self._logger.exception("Failed to update the shared runfolder index")
+
+    def _refresh_requested(self):
+        """
+        Refreshes the runfolders that other processes have asked to be refreshed, and
+        removes the requests once the refreshed runfolders have been written, which
+        tells the processes that they're done
+        """
+        connection = self._database.connection()
+        rows = connection.execute("SELECT id, path FROM refresh_requests ORDER BY id").fetchall()
+        if not rows:
+            return
+        for path in sorted(set(path for _, path in rows)):
+            self._index.refresh(path)
+        self.flush()
+        with connection:
+            connection.execute("DELETE FROM refresh_requests WHERE id <= ?", (rows[-1][0],))
+
+    def flush(self):
+        """Writes the runfolders that have changed since the last flush"""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return
+        changed = []
+        removed = []
+        for path in dirty:
+            info = self._index.get(path)
+            if info is None:
+                removed.append((path,))
+            else:
+                changed.append(self._row(info))
+        connection = self._database.connection()
+        with connection:
+            connection.executemany("DELETE FROM runfolders WHERE path = ?", removed)
+            connection.executemany("INSERT OR REPLACE INTO runfolders VALUES (?, ?, ?, ?)", changed)
+            self._write_version(connection)
+
+
+class SharedIndexReader:
+    """
+    Serves the runfolders written by a SharedIndexWriter in another process. It has
+    the same interface as the RunfolderIndex, so that the RunfolderService can use it
+    in its place.
+
+    The runfolders are decoded once per version of the index.
+    """
+
+    def __init__(self, database, make_info, logger=None):
+        """
+        :param database: The SharedDatabase
+        :param make_info: Creates a RunfolderInfo from host, path, state and metadata
+        """
+        self._database = database
+        self._make_info = make_info
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._snapshot_version = None
+        self._snapshot = []
+        self._snapshot_by_path = dict()
+
+    def start(self, timeout=600):
+        """Waits until the scanner has written the index"""
+        deadline = time.time() + timeout
+        while self._database.meta("ready") is None:
+            if time.time() > deadline:
+                raise RuntimeError("The shared runfolder index at {0} wasn't written within {1}s".format(
+                    self._database.path, timeout))
+            time.sleep(0.1)
+
+    def stop(self):
+        pass
+
+    @property
+    def version(self):
+        return self._database.meta("version")
+
+    def _runfolders(self):
+        """Returns all runfolders, ordered by path, reading them only if the index has changed"""
+        version = self.version
+        with self._lock:
+            if version != self._snapshot_version:
+                rows = self._database.connection().execute(
+                    "SELECT host, path, state, metadata FROM runfolders ORDER BY path").fetchall()
+                self._snapshot = [self._make_info(host, path, state, json.loads(metadata))
+                                  for host, path, state, metadata in rows]
+                self._snapshot_by_path = dict((info.path, info) for info in self._snapshot)
+                self._snapshot_version = version
+            return self._snapshot
+
+    def runfolders(self, state=None, after=None):
+        """Yields the RunfolderInfos in the given state, or all of them if state is None, ordered by path"""
+        return iter([info for info in self._runfolders()
+                     if (state is None or info.state == state) and (after is None or info.path > after)])
+
+    def get(self, path):
+        self._runfolders()
+        return self._snapshot_by_path.get(path)
+
+    def counts(self):
+        counts = dict()
+        for info in self._runfolders():
+            counts[info.state] = counts.get(info.state, 0) + 1
+        return counts
+
+    def refresh(self, path, timeout=10):
+        """
+        Asks the scanner to refresh the runfolder at path, and waits until it has, so
+        that the change is seen by the next request. Gives up waiting after timeout
+        seconds, in which case the change is seen later.
+        """
+        connection = self._database.connection()
+        with connection:
+            request_id = connection.execute("INSERT INTO refresh_requests (path) VALUES (?)", (path,)).lastrowid
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if connection.execute("SELECT 1 FROM refresh_requests WHERE id = ?", (request_id,)).fetchone() is None:
+                return
+            time.sleep(0.01)
+        self._logger.warning("The scanner didn't refresh {0} within {1}s".format(path, timeout))
+
+
+class SharedDirectoryHealth:
+    """
+    The health of the monitored directories, as last written by the scanner. It has
+    the same interface as the MonitoredDirectoryHealth for reading the health.
+    """
+
+    META_KEY = "monitored_directories"
+
+    def __init__(self, database):
+        self._database = database
+
+    def status(self):
+        status = self._database.meta(self.META_KEY)
+        return json.loads(status) if status else []
+
+    def is_open(self, path):
+        return any(health["path"] == path and health["circuit"] == OPEN for health in self.status())
+
+    def stale_directories(self):
+        return sorted(health["path"] for health in self.status() if health["stale"])
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SharedEventLog:
+    """
+    A RunfolderEventLog kept in the shared database. Only the scanner publishes
+    events, the other processes poll the database for new events while clients are
+    waiting for them.
+    """
+
+    POLL_INTERVAL_SECONDS = 0.2
+
+    def __init__(self, database, capacity=10000, publisher=False):
+        self._database = database
+        self._capacity = capacity
+        self._publisher = publisher
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._poller = None
+
+    @property
+    def last_sequence(self):
+        try:
+            row = self._database.connection().execute("SELECT MAX(sequence) FROM events").fetchone()
+        except sqlite3.OperationalError:
+            return 0
+        return row[0] or 0
+
+    def publish(self, path, previous_state, state):
+        """Adds a transition to the log, if this is the scanner's log"""
+        if not self._publisher:
+            return None
+        connection = self._database.connection()
+        with connection:
+            sequence = connection.execute(
+                "INSERT INTO events (path, previous_state, state, time) VALUES (?, ?, ?, ?)",
+                (path, previous_state, state, time.time())).lastrowid
+            connection.execute("DELETE FROM events WHERE sequence <= ?", (sequence - self._capacity,))
+        self._wake(sequence)
+        return sequence
+
+    def since(self, sequence, limit=None):
+        connection = self._database.connection()
+        rows = connection.execute(
+            "SELECT sequence, path, previous_state, state, time FROM events WHERE sequence > ? "
+            "ORDER BY sequence LIMIT ?", (sequence, -1 if limit is None else limit)).fetchall()
+        if not rows:
+            return [], False
+        first = connection.execute("SELECT MIN(sequence) FROM events").fetchone()[0]
+        return [RunfolderEvent(*row) for row in rows], sequence + 1 < first
+
+    def wait(self, sequence):
+        future = tornado.concurrent.Future()
+        if sequence < self.last_sequence:
+            future.set_result(None)
+            return future
+        io_loop = tornado.ioloop.IOLoop.current()
+        with self._lock:
+            self._waiters.append((io_loop, future, sequence))
+            if self._poller is None:
+                self._poller = tornado.ioloop.PeriodicCallback(self._poll, self.POLL_INTERVAL_SECONDS * 1000)
+                self._poller.start()
+        return future
+
+    def cancel(self, future):
+        with self._lock:
+            self._waiters = [waiter for waiter in self._waiters if waiter[1] is not future]
+
+    def _poll(self):
+        """Wakes the clients waiting for events published by other processes, on the IOLoop"""
+        self._wake(self.last_sequence)
+        with self._lock:
+            if not self._waiters and self._poller is not None:
+                self._poller.stop()
+                self._poller = None
+
+    def _wake(self, last_sequence):
+        with self._lock:
+            woken = [waiter for waiter in self._waiters if waiter[2] < last_sequence]
+            self._waiters = [waiter for waiter in self._waiters if waiter[2] >= last_sequence]
+        for io_loop, future, _ in woken:
+            io_loop.add_callback(_resolve, future)
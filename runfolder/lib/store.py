@@ -0,0 +1,150 @@
+"""
+A persistent store of what is known about each runfolder, so that a restarted service
+doesn't have to read every runfolder from disk again
+"""
+
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+# What is stored about a runfolder. The modification times are those of the runfolder
+# directory and its state file when the runfolder was read, and are used to check
+# that the record is still valid:
+#   dir_mtime_ns: Modification time of the runfolder directory, or None if the record
+#                 should not be trusted
+#   has_state_dir: If the runfolder had a .arteria directory
+#   state_mtime_ns: Modification time of .arteria/state, or None if there was none
+#   marker_mtime: Modification time of the completed marker, only for runfolders
+#                 without a state file
+#   instrument: The name of the instrument class, if the metadata was read
+#   metadata: The metadata of the runfolder, or None if it wasn't read
+RunfolderRecord = collections.namedtuple("RunfolderRecord", [
+    "path", "state", "dir_mtime_ns", "has_state_dir", "state_mtime_ns", "marker_mtime",
+    "instrument", "metadata"])
+
+
+class RunfolderStore:
+    """
+    Keeps RunfolderRecords in memory, backed by an SQLite database.
+
+    All records are loaded when the store is opened. Changes are written to the
+    database in batches, by flush, which is also called by put and remove when
+    flush_interval seconds have passed since the last flush.
+    """
+
+    SCHEMA_VERSION = 1
+    FILE_NAME = "runfolders.sqlite"
+
+    def __init__(self, directory, fingerprint="", flush_interval=1.0, logger=None):
+        """
+        :param directory: The directory of the database file, created if it doesn't exist
+        :param fingerprint: Identifies the config that the records depend on. If it
+                            differs from the one the records were stored with, they
+                            are discarded when the store is opened.
+        :param flush_interval: The maximum number of seconds between writes to the database
+        """
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self._directory = directory
+        self._fingerprint = "{0}:{1}".format(self.SCHEMA_VERSION, fingerprint)
+        self._flush_interval = flush_interval
+        self._logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._records = dict()
+        # Paths changed since the last flush, mapped to their record or None if removed
+        self._pending = dict()
+        self._last_flush = time.time()
+
+    def open(self):
+        """Opens the database, creating it if needed, and loads all records"""
+        os.makedirs(self._directory, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value TEXT)")
+            row = self._connection.execute("SELECT value FROM store WHERE key = 'fingerprint'").fetchone()
+            if row is None or row[0] != self._fingerprint:
+                if row is not None:
+                    self._logger.info("The runfolder store was written with another config, discarding it")
+                self._connection.execute("DROP TABLE IF EXISTS runfolders")
+                self._connection.execute("INSERT OR REPLACE INTO store VALUES ('fingerprint', ?)",
+                                         (self._fingerprint,))
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS runfolders (path TEXT PRIMARY KEY, state TEXT, "
+                "dir_mtime_ns INTEGER, has_state_dir INTEGER, state_mtime_ns INTEGER, "
+                "marker_mtime REAL, instrument TEXT, metadata TEXT)")
+            rows = self._connection.execute("SELECT * FROM runfolders").fetchall()
+
+        self._records = dict()
+        for row in rows:
+            path, state, dir_mtime_ns, has_state_dir, state_mtime_ns, marker_mtime, instrument, metadata = row
+            self._records[path] = RunfolderRecord(
+                path, state, dir_mtime_ns, bool(has_state_dir), state_mtime_ns, marker_mtime, instrument,
+                None if metadata is None else json.loads(metadata))
+        self._logger.info("Loaded {0} runfolders from {1}".format(len(self._records), self.path))
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def get(self, path):
+        """Returns the record of the runfolder at path, or None if there is none"""
+        return self._records.get(path)
+
+    def put(self, record):
+        with self._lock:
+            self._records[record.path] = record
+            self._pending[record.path] = record
+        self._flush_if_due()
+
+    def remove(self, path):
+        with self._lock:
+            if self._records.pop(path, None) is not None:
+                self._pending[path] = None
+        self._flush_if_due()
+
+    def retain(self, paths):
+        """Removes the records of all runfolders that are not in paths"""
+        paths = set(paths)
+        with self._lock:
+            for path in [path for path in self._records if path not in paths]:
+                del self._records[path]
+                self._pending[path] = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def _flush_if_due(self):
+        if time.time() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes all changes since the last flush to the database"""
+        with self._lock:
+            self._last_flush = time.time()
+            if not self._pending or self._connection is None:
+                return
+            pending, self._pending = self._pending, dict()
+            removed = [(path,) for path, record in pending.items() if record is None]
+            changed = [(record.path, record.state, record.dir_mtime_ns, int(record.has_state_dir),
+                        record.state_mtime_ns, record.marker_mtime, record.instrument,
+                        None if record.metadata is None else json.dumps(record.metadata))
+                       for record in pending.values() if record is not None]
+            try:
+                with self._connection:
+                    self._connection.executemany("DELETE FROM runfolders WHERE path = ?", removed)
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO runfolders VALUES (?, ?, ?, ?, ?, ?, ?, ?)", changed)
+            except sqlite3.Error as e:
+                # The store is only an optimization, so the service carries on with the
+                # records in memory
+                self._logger.warning("Could not write the runfolder store {0}: {1}".format(self.path, e))
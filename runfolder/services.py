@@ -1,33 +1,155 @@
+import collections
+import concurrent.futures
+import json
 import os.path
+import re
 import socket
 import logging
+import threading
 import time
 import xmltodict
 from runfolder import __version__ as version
 
 from arteria.web.state import State
 from arteria.web.state import validate_state
-from runfolder.lib.instrument import InstrumentFactory
+from arteria.exceptions import InvalidArteriaStateException
+from runfolder.lib.events import RunfolderEventLog
+from runfolder.lib.health import OPEN, DirectoryHealth, MonitoredDirectoryHealth
+from runfolder.lib.index import RunfolderIndex
+from runfolder.lib.instrument import InstrumentRegistry
+from runfolder.lib import metrics
+from runfolder.lib.run_parameters import RunParametersCache, extract_run_parameters
+from runfolder.lib.roots import MonitoredRoots
+from runfolder.lib.scanner import CandidateMatcher, RunfolderEntries, find_runfolders, subdirectories
+from runfolder.lib.shared_index import SharedDatabase, SharedDirectoryHealth, SharedEventLog, SharedIndexReader, \
+    SharedIndexWriter
+from runfolder.lib.store import RunfolderRecord, RunfolderStore
+
+
+LIST_ROOT_DURATION = metrics.registry.histogram(
+    "runfolder_list_monitored_directory_seconds",
+    "Time to list the potential runfolders in a monitored directory", ["root"])
+READ_RUNFOLDER_DURATION = metrics.registry.histogram(
+    "runfolder_read_runfolder_seconds",
+    "Time to read the state and metadata of a runfolder, by monitored directory", ["root"])
+ENUMERATE_DURATION = metrics.registry.histogram(
+    "runfolder_enumerate_seconds", "Time to enumerate the runfolders of all monitored directories")
+SCAN_TIMEOUTS = metrics.registry.counter(
+    "runfolder_scan_timeouts_total", "Number of times scanning a monitored directory timed out", ["root"])
+RUN_PARAMETERS_PARSE_DURATION = metrics.registry.histogram(
+    "runfolder_run_parameters_parse_seconds", "Time to read the fields of a runParameters.xml file")
+
+
+def _parse_run_parameters(path):
+    with RUN_PARAMETERS_PARSE_DURATION.time():
+        return extract_run_parameters(path)
+
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def _encode_value(value):
+    if isinstance(value, str):
+        return _encode_string(value)
+    return json.dumps(value)
+
+
+def _encode_metadata(metadata):
+    if not metadata:
+        return "{}"
+    return "{" + ", ".join([_encode_value(key) + ": " + _encode_value(value)
+                            for key, value in metadata.items()]) + "}"
+
+
+def _escape_json(encoded):
+    # As tornado.escape.json_encode, so that the JSON can be embedded in HTML
+    return encoded.replace("</", "<\\/")
+
 
 class RunfolderInfo:
     """
-    Information about a runfolder. Status must be defined in RunfolderState:
+    Information about a runfolder. Status must be defined in RunfolderState.
+
+    Instances can't be modified, so that they can be shared, e.g. by the runfolder
+    index. Use replace to get a copy with some fields changed.
     """
 
-    def __init__(self, host, path, state, metadata):
+    __slots__ = ("host", "path", "state", "service_version", "metadata", "link", "_json")
+
+    FIELDS = ("host", "path", "state", "service_version", "metadata", "link")
+
+    def __init__(self, host, path, state, metadata, link=None, service_version=version):
         """
         Initializes the object
 
         :param host: The host where the runfolder exists
         :param path: The file system path to the runfolder on the host
         :param state: The state of the runfolder (see RunfolderState)
+        :param metadata: A dict with the barcodes of the runfolder. It must not be
+                         modified once the RunfolderInfo is created.
+        :param link: The HTTP endpoint of the runfolder, if it's known
         """
+        set_field = object.__setattr__
+        set_field(self, "host", host)
+        set_field(self, "path", path)
+        set_field(self, "state", state)
+        set_field(self, "service_version", service_version)
+        set_field(self, "metadata", metadata)
+        set_field(self, "link", link)
+        # The JSON of all fields except the link, encoded the first time it's needed
+        set_field(self, "_json", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RunfolderInfo can't be modified, use replace to change '{0}'".format(name))
+
+    def replace(self, **changes):
+        """Returns a copy of the RunfolderInfo with the fields in changes replaced"""
+        fields = dict((name, getattr(self, name)) for name in self.FIELDS)
+        fields.update(changes)
+        return RunfolderInfo(**fields)
+
+    def to_dict(self):
+        fields = dict((name, getattr(self, name)) for name in self.FIELDS)
+        if self.link is None:
+            del fields["link"]
+        return fields
+
+    def to_json(self, link=None, fields=None):
+        """
+        Returns the RunfolderInfo encoded as JSON, the same as json_encode(self.to_dict())
+        but without going through the generic encoder.
 
-        self.host = host
-        self.path = path
-        self.state = state
-        self.service_version = version
-        self.metadata = metadata
+        :param link: Include this link rather than the link of the RunfolderInfo, which
+                     saves replacing the RunfolderInfo just to encode it with a link
+        :param fields: Only include these of the FIELDS, in the order of FIELDS
+        """
+        if fields is not None:
+            return self._fields_json(link or self.link, fields)
+        encoded = self._json
+        if encoded is None:
+            encoded = _escape_json(
+                '{"host": ' + _encode_value(self.host) +
+                ', "path": ' + _encode_value(self.path) +
+                ', "state": ' + _encode_value(self.state) +
+                ', "service_version": ' + _encode_value(self.service_version) +
+                ', "metadata": ' + _encode_metadata(self.metadata))
+            object.__setattr__(self, "_json", encoded)
+        link = link or self.link
+        if link is None:
+            return encoded + "}"
+        return encoded + ', "link": ' + _escape_json(_encode_value(link)) + "}"
+
+    def _fields_json(self, link, fields):
+        encoded = []
+        for name in self.FIELDS:
+            if name not in fields:
+                continue
+            value = link if name == "link" else getattr(self, name)
+            if name == "link" and value is None:
+                continue
+            encoded.append(_encode_value(name) + ": " +
+                           (_encode_metadata(value) if name == "metadata" else _encode_value(value)))
+        return _escape_json("{" + ", ".join(encoded) + "}")
 
     def __repr__(self):
         return "{0}: {1}@{2}".format(self.state, self.path, self.host)
@@ -37,9 +159,214 @@ class RunfolderService:
     """Watches a set of directories on the server and reacts when one of them
        has a runfolder that's ready for processing"""
 
+    RUN_PARAMETERS_FILE_NAMES = ["runParameters.xml", "RunParameters.xml"]
+
+    # A claim file older than this is assumed to be left behind by a process that
+    # died while picking up the runfolder
+    STALE_CLAIM_SECONDS = 60
+
     def __init__(self, configuration_svc, logger=None):
         self._configuration_svc = configuration_svc
         self._logger = logger or logging.getLogger(__name__)
+        self._run_parameters_cache = RunParametersCache(
+            self._config_value("run_parameters_cache_size", 1024), parser=_parse_run_parameters)
+        self._instruments = InstrumentRegistry()
+        try:
+            self._instruments.register_from_config(self._config_value("instruments", []))
+        except ValueError as e:
+            raise ConfigurationError(str(e))
+        try:
+            self._candidate_matcher = CandidateMatcher(
+                name_pattern=self._config_value("runfolder_name_pattern", None),
+                include=self._config_list("runfolder_include"),
+                exclude=self._config_list("runfolder_exclude"),
+                required_files=self._config_list("runfolder_required_files"))
+        except re.error as e:
+            raise ConfigurationError("runfolder_name_pattern is not a valid regular expression: {0}".format(e))
+        self._index = None
+        self._shared_index_writer = None
+        self._store = None
+        self._ready_queue = collections.deque()
+        self._ready_queue_lock = threading.Lock()
+        scan_workers = self._config_value("scan_workers", 1)
+        self._scan_workers = max(1, scan_workers)
+        self._scan_window = self._scan_workers * 4
+        self._monitored_depth = self._config_value("monitored_directory_depth", 1)
+        if not isinstance(self._monitored_depth, int) or self._monitored_depth < 1:
+            raise ConfigurationError("monitored_directory_depth must be a positive integer")
+        # The thread pools that list the directories of each level of a nested monitored
+        # directory, one per monitored directory. They're separate from the scan threads,
+        # as the walks run in those.
+        self._walk_executors = dict()
+        self._roots = None
+        self._state_fsync = self._config_value("state_fsync", "file")
+        if self._state_fsync not in self.STATE_FSYNC_POLICIES:
+            raise ConfigurationError("state_fsync must be one of {0}".format(", ".join(self.STATE_FSYNC_POLICIES)))
+        # Reads and writes the runfolders of batch requests
+        self._batch_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, self._config_value("batch_workers", 8)))
+        self._scan_root_timeout = self._config_value("scan_root_timeout_seconds", None)
+        # The monitored directories are listed in threads if there's more than one scan
+        # worker or a timeout, so that one that hangs can't block the requests. Each
+        # monitored directory has its own pool of scan_workers threads, so that one that
+        # hangs only holds up its own threads.
+        self._threaded_scan = scan_workers > 1 or self._scan_root_timeout is not None
+        self._root_executors = dict()
+        # The listings and reads of each monitored directory that timed out and haven't
+        # returned yet. No new ones are started for a directory while there are any.
+        self._unfinished = dict()
+        self._root_executors_lock = threading.Lock()
+        self._directory_health = MonitoredDirectoryHealth(
+            failure_threshold=self._config_value("scan_root_failure_threshold", 3),
+            probe_interval=self._config_value("scan_root_probe_interval_seconds", 30),
+            logger=self._logger)
+        # The runfolders last read in each monitored directory, by path, which are
+        # listed while the directory can't be
+        self._last_seen = dict()
+        self._last_seen_lock = threading.Lock()
+        self._runfolder_counts = dict()
+        self.events = RunfolderEventLog(self._config_value("runfolder_events_history", 10000))
+        # The last seen state of each runfolder, to tell when it changes
+        self._known_states = dict()
+        self._known_states_lock = threading.Lock()
+
+    def start(self, index_enabled=False):
+        """
+        Starts the background services that are enabled in the config. Currently
+        these are the runfolder store, the runfolder index and the probing of the
+        monitored directories whose circuit is open.
+
+        The metrics that are read from the service, like the cache counts, are
+        registered for the started service.
+
+        :param index_enabled: Keep the runfolder index, also if it's not enabled in the config
+        """
+        self._register_metrics()
+        self._directory_health.start_probing(self._probe_monitored_directory)
+        store_dir = self._config_value("runfolder_store_dir", None)
+        if store_dir:
+            # Ready states are stored as they were when the runfolder was read, so
+            # they depend on the grace period as well as on the instruments
+            fingerprint = json.dumps({"instruments": self._config_value("instruments", []),
+                                      "completed_marker_grace_minutes": self._completed_marker_grace_minutes()},
+                                     sort_keys=True)
+            self._store = RunfolderStore(store_dir, fingerprint, logger=self._logger)
+            self._store.open()
+        if index_enabled or self._config_value("runfolder_index_enabled", False):
+            self._index = RunfolderIndex(
+                self,
+                reconcile_interval=self._config_value("runfolder_index_reconcile_interval_seconds", 300),
+                use_inotify=self._config_value("runfolder_index_use_inotify", True),
+                logger=self._logger)
+            self._index.start()
+            self._logger.info("Started the runfolder index")
+
+    def start_scanner(self, shared_index_path):
+        """
+        Starts the service in the scanner process of a multi-process service. The
+        scanner keeps the runfolder index, and shares it and the state transitions
+        with the other processes through the database at shared_index_path.
+        """
+        database = SharedDatabase(shared_index_path)
+        database.create()
+        self._directory_health.add_listener(
+            lambda status: database.set_meta(SharedDirectoryHealth.META_KEY, json.dumps(status)))
+        self.events = SharedEventLog(database, self._config_value("runfolder_events_history", 10000),
+                                     publisher=True)
+        self.start(index_enabled=True)
+        self._shared_index_writer = SharedIndexWriter(self._index, database, logger=self._logger)
+        self._shared_index_writer.start()
+        self._logger.info("Sharing the runfolder index at {0}".format(shared_index_path))
+
+    def start_worker(self, shared_index_path):
+        """
+        Starts the service in a worker process of a multi-process service. The
+        runfolders are listed from the index shared by the scanner process, and the
+        states set in the worker are refreshed by the scanner. Waits until the scanner
+        has shared the index.
+        """
+        database = SharedDatabase(shared_index_path)
+        self._register_metrics()
+        self._directory_health = SharedDirectoryHealth(database)
+        self.events = SharedEventLog(database, self._config_value("runfolder_events_history", 10000))
+        self._index = SharedIndexReader(database, RunfolderInfo, logger=self._logger)
+        self._index.start()
+
+    def _register_metrics(self):
+        cache = self._run_parameters_cache
+        metrics.registry.callback(
+            "runfolder_run_parameters_cache_hits_total", "Number of run parameters read from the cache",
+            "counter", lambda: cache.hits)
+        metrics.registry.callback(
+            "runfolder_run_parameters_cache_misses_total", "Number of run parameters not in the cache",
+            "counter", lambda: cache.misses)
+        metrics.registry.callback(
+            "runfolder_runfolders", "Number of runfolders per state, as of the last full listing "
+            "unless the runfolder index is enabled", "gauge",
+            lambda: dict(((state,), count) for state, count in self.runfolder_counts().items()),
+            ["state"])
+        metrics.registry.callback(
+            "runfolder_monitored_directory_circuit_open", "1 if the circuit of the monitored directory "
+            "is open, i.e. it's not listed and its last known runfolders are served", "gauge",
+            lambda: dict(((status["path"],), int(status["circuit"] == OPEN))
+                         for status in self.monitored_directory_status()),
+            ["root"])
+
+    def listing_version(self):
+        """
+        Returns a token that changes whenever the listing of the runfolders might,
+        or None if that can't be told without listing them. It's only available when
+        the runfolder index is enabled, as otherwise runfolders become ready as their
+        completed markers age, without anything changing on disk.
+        """
+        if self._index:
+            return self._index.version
+        return None
+
+    def stale_directories(self):
+        """
+        Returns the monitored directories whose runfolders might not be current, as
+        they couldn't be listed the last time they were tried
+        """
+        return self._directory_health.stale_directories()
+
+    def monitored_directory_status(self):
+        """Returns the health of each monitored directory as a dict, ordered by path"""
+        status = dict((health["path"], health) for health in self._directory_health.status())
+        for root in self._monitored_directories():
+            if root not in status:
+                status[root] = DirectoryHealth(root).to_dict()
+        return [status[root] for root in sorted(status)]
+
+    def _probe_monitored_directory(self, monitored_root):
+        """Lists the monitored directory, raising OSError if it can't be"""
+        self._subdirectories(monitored_root)
+
+    def runfolder_counts(self):
+        """
+        Returns the number of runfolders per state. These are read from the runfolder
+        index if it's enabled, otherwise they are from the last listing of all runfolders.
+        """
+        if self._index:
+            return self._index.counts()
+        return dict(self._runfolder_counts)
+
+    def _config_value(self, key, default):
+        """Returns the config value for key, or default if it's not set"""
+        try:
+            value = self._configuration_svc[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def _config_list(self, key):
+        """Returns the config value for key as a list, which is empty if it's not set"""
+        value = self._config_value(key, [])
+        if isinstance(value, str):
+            return [value]
+        if not isinstance(value, list):
+            raise ConfigurationError("{0} must be a list".format(key))
+        return [str(item) for item in value]
 
     # NOTE: These methods were added so that they could be easily mocked out.
     #       It would probably be nicer to move them inline and mock the system calls
@@ -49,43 +376,67 @@ class RunfolderService:
         return socket.gethostname()
 
     @staticmethod
-    def _file_exists(path):
-        return os.path.isfile(path)
+    def _dir_exists(path):
+        return os.path.isdir(path)
 
-    @staticmethod
-    def _file_exists_and_is_older_than(path, minutes):
-        if not os.path.isfile(path):
-            return False
+    def _subdirectories(self, path):
+        """Returns the names of the runfolder candidates in the monitored directory at path"""
+        return subdirectories(path, self._candidate_matcher)
 
-        modification_time = os.path.getmtime(path)
-        return (time.time() - modification_time) >= minutes * 60
+    def _is_candidate(self, path):
+        """Returns True if the existing directory at path passes the runfolder candidate rules"""
+        return self._candidate_matcher.matches(path)
 
-    @staticmethod
-    def _dir_exists(path):
-        return os.path.isdir(path)
+    def _is_candidate_name(self, name):
+        return self._candidate_matcher.matches_name(name)
 
     @staticmethod
-    def _subdirectories(path):
-        return os.listdir(path)
+    def _runfolder_entries(path):
+        """
+        Reads the entries of the runfolder at path with a single directory read. A
+        runfolder that doesn't exist has no entries.
+        """
+        try:
+            return RunfolderEntries.read(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return RunfolderEntries(path, dict())
 
     def _validate_is_being_monitored(self, path):
         """
-        Validate that this is a subdirectory (potentially non-existing)
-        of a monitored path
+        Validate that this is a subdirectory (potentially non-existing) of a
+        monitored path, at most monitored_directory_depth levels below it
 
         :raises PathNotMonitored
         """
-        def is_parent_dir(parent_dir, child_dir):
-            actual_parent = os.path.split(child_dir)[0]
-            return os.path.normpath(parent_dir) == actual_parent
-
-        monitored = list(self._monitored_directories())
-        is_monitored = any([is_parent_dir(mon, path) for mon in monitored])
-        if not is_monitored:
-            self._logger.warn("Validation error: {} is not monitored {}".format(path, monitored))
+        roots = self._monitored_roots()
+        if not roots.is_monitored(path):
+            self._logger.warn("Validation error: {} is not monitored {}".format(path, sorted(roots.roots)))
             raise PathNotMonitored(
                 "The path '{}' is not being monitored.".format(path))
 
+    def _monitored_parents(self):
+        """Returns the set of monitored directories"""
+        return set(os.path.normpath(directory) for directory in self._monitored_directories())
+
+    def _monitored_roots(self):
+        """
+        Returns the MonitoredRoots of the monitored directories, to check many paths
+        against. It's only built again when the monitored directories change.
+        """
+        roots = self._roots
+        monitored = tuple(self._monitored_directories())
+        if roots is None or roots.roots != monitored:
+            roots = self._roots = MonitoredRoots(monitored, self._monitored_depth)
+        return roots
+
+    def _root_label(self, runfolder, *args, **kwargs):
+        """
+        The root label of the metrics on reading the runfolder, found with the monitored
+        directories as they were last checked, as it's computed for every runfolder read
+        """
+        roots = self._roots or self._monitored_roots()
+        return roots.root_of(runfolder) or os.path.dirname(runfolder)
+
     def create_runfolder(self, path):
         """
         Creates a runfolder at the path.
@@ -124,6 +475,7 @@ class RunfolderService:
 
         self._logger.info(
             "Added 'runParameters.xml' to '{0}' - intended for tests only".format(runparameters_path))
+        self._refresh_index(path)
 
 
     def add_sequencing_finished_marker(self, path):
@@ -149,6 +501,7 @@ class RunfolderService:
         open(full_path, 'a').close()
         self._logger.info(
             "Added the 'RTAComplete.txt' marker to '{0}' - intended for tests only".format(full_path))
+        self._refresh_index(path)
 
     def get_runfolder_by_path(self, path):
         """
@@ -162,72 +515,244 @@ class RunfolderService:
 
         if not self._dir_exists(path):
             raise DirectoryDoesNotExist("Directory does not exist: '{0}'".format(path))
-        info = RunfolderInfo(self._host(), path, self.get_runfolder_state(path),
-                             self.get_metadata(path))
-        return info
+        return self._runfolder_info(path)
+
+    def get_runfolders_by_path(self, paths):
+        """
+        Returns the RunfolderInfos of the runfolders at paths, in the same order. The
+        monitored directories are listed once for all paths, and the runfolders are
+        read in parallel.
 
-    def _get_runfolder_state_from_state_file(self, runfolder):
+        :return: A list with, for each path, its RunfolderInfo, or the PathNotMonitored or
+                 DirectoryDoesNotExist that get_runfolder_by_path would have raised
+        """
+        roots = self._monitored_roots()
+
+        def lookup(path):
+            if not roots.is_monitored(path):
+                return PathNotMonitored("The path '{}' is not being monitored.".format(path))
+            if not self._dir_exists(path):
+                return DirectoryDoesNotExist("Directory does not exist: '{0}'".format(path))
+            return self._runfolder_info(path)
+
+        unique_paths = list(collections.OrderedDict.fromkeys(paths))
+        found = dict(zip(unique_paths, self._batch_executor.map(lookup, unique_paths)))
+        return [found[path] for path in paths]
+
+    def _get_runfolder_state_from_state_file(self, runfolder, entries):
         """
         Reads the state in the state file at .arteria/state, returns
         State.NONE if nothing is available
         """
+        if not entries.has_dir(".arteria"):
+            return State.NONE
         state_file = os.path.join(runfolder, ".arteria", "state")
-        if self._file_exists(state_file):
+        try:
             with open(state_file, 'r') as f:
                 state = f.read()
                 state = state.strip()
                 return state
-        else:
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
             return State.NONE
 
-    def get_runfolder_state(self, runfolder):
+    def _completed_marker_file(self, runfolder, entries):
+        """Returns the name of the completed marker file used by the runfolder's instrument"""
+        instrument = self._instruments.get_instrument(self.read_run_parameters(runfolder, entries))
+        return instrument.completed_marker_file()
+
+    def _completed_marker_grace_minutes(self):
+        return self._config_value("completed_marker_grace_minutes", 0)
+
+    def get_runfolder_state(self, runfolder, entries=None):
         """
         Returns the state of a runfolder. The possible states are defined in
         State
 
         If the file .arteria/state exists, it will determine the state. If it doesn't
         exist, the existence of the marker file RTAComplete.txt determines the state.
-        """
-        instrument = InstrumentFactory.get_instrument(self.read_run_parameters(runfolder))
-        completed_marker_file = instrument.completed_marker_file()
-        completed_grace_minutes = None
-        try:
-            completed_grace_minutes = self._configuration_svc["completed_marker_grace_minutes"]
-        except KeyError:
-            pass
 
-        if completed_grace_minutes is None:
-            completed_grace_minutes = 0
-        state = self._get_runfolder_state_from_state_file(runfolder)
-        if state == State.NONE:
-            ready = True
-            completed_marker = os.path.join(runfolder, completed_marker_file)
-            if not self._file_exists_and_is_older_than(completed_marker, completed_grace_minutes):
-                ready = False
-            if ready:
-                state = State.READY
+        :param entries: The RunfolderEntries of the runfolder, if they have already been read
+        """
+        if entries is None:
+            entries = self._runfolder_entries(runfolder)
+        state = self._get_runfolder_state_from_state_file(runfolder, entries)
+        if state != State.NONE:
+            return state
+
+        # Reading runParameters.xml to find out which marker the instrument uses is
+        # only worth it if there is a marker at all
+        marker_files = self._instruments.completed_marker_files()
+        if not any(entries.has_file(marker_file) for marker_file in marker_files):
+            return state
+
+        completed_marker_file = self._completed_marker_file(runfolder, entries)
+        completed_grace_minutes = self._completed_marker_grace_minutes()
+        if entries.is_older_than(completed_marker_file, completed_grace_minutes):
+            state = State.READY
         return state
 
-    @staticmethod
-    def set_runfolder_state(runfolder, state):
+    def _ready_deadline(self, runfolder, entries=None):
+        """
+        Returns the time when the completed marker of a runfolder will have aged past
+        the grace period, or None if there is no marker
+        """
+        if entries is None:
+            entries = self._runfolder_entries(runfolder)
+        return self._deadline_of_marker(self._completed_marker_mtime(runfolder, entries))
+
+    def _deadline_of_marker(self, marker_mtime):
+        if marker_mtime is None:
+            return None
+        return marker_mtime + self._completed_marker_grace_minutes() * 60
+
+    def _completed_marker_mtime(self, runfolder, entries):
+        """Returns the modification time of the completed marker, or None if there is none"""
+        if not any(entries.has_file(marker_file) for marker_file in self._instruments.completed_marker_files()):
+            return None
+        return entries.modification_time(self._completed_marker_file(runfolder, entries))
+
+    def set_runfolder_state(self, runfolder, state):
         """
         Sets the state of a runfolder
 
         :raises DirectoryDoesNotExist
         """
         validate_state(state)
-        arteria_dir = os.path.join(runfolder, ".arteria")
-        state_file = os.path.join(arteria_dir, "state")
-
         if not os.path.exists(runfolder):
             raise DirectoryDoesNotExist(
                     "Directory does not exist: '{0}'".format(runfolder))
 
-        if not os.path.exists(arteria_dir):
-            os.makedirs(arteria_dir)
+        self._write_state_file(runfolder, state)
+        self._state_changed(runfolder, state)
 
-        with open(state_file, 'w') as f:
-            f.write(state)
+    def set_runfolder_states(self, updates):
+        """
+        Sets the states of several runfolders. All updates are validated before any
+        state is written, and the states are then written in parallel.
+
+        :param updates: A list of (runfolder, state)
+        :return: A list with, for each update, None if the state was written, or why
+                 it couldn't be
+        :raises InvalidStateUpdates if any of the updates is invalid, in which case
+                no state is written
+        """
+        seen = set()
+        errors = []
+        for runfolder, state in updates:
+            errors.append(self._state_update_error(runfolder, state, seen))
+            seen.add(runfolder)
+        if any(errors):
+            raise InvalidStateUpdates("{0} of {1} state updates are invalid".format(
+                len([error for error in errors if error]), len(updates)), errors)
+        return list(self._batch_executor.map(lambda update: self._apply_state_update(*update), updates))
+
+    def _state_update_error(self, runfolder, state, seen):
+        """Returns why the state of runfolder can't be set to state, or None if it can"""
+        try:
+            validate_state(state)
+            self._validate_is_being_monitored(runfolder)
+        except (InvalidArteriaStateException, PathNotMonitored) as e:
+            return str(e)
+        if runfolder in seen:
+            return "The runfolder '{0}' is listed more than once".format(runfolder)
+        if not self._dir_exists(runfolder):
+            return "Directory does not exist: '{0}'".format(runfolder)
+        return None
+
+    def _apply_state_update(self, runfolder, state):
+        try:
+            self._write_state_file(runfolder, state)
+        except OSError as e:
+            self._logger.warning("Could not set the state of {0} to {1}: {2}".format(runfolder, state, e))
+            return str(e)
+        self._state_changed(runfolder, state)
+        return None
+
+    # When state files are flushed to disk: never, leaving it to the operating
+    # system, after the file is written, or also after it has replaced the old
+    # state file, which makes the new state survive a crash
+    STATE_FSYNC_POLICIES = ("none", "file", "directory")
+
+    def _write_state_file(self, runfolder, state):
+        """
+        Writes the state file of the runfolder. The state is written to a temporary
+        file that then replaces the state file, so that readers see either the old or
+        the new state, never a partly written one. The files are flushed to disk as
+        set by the state_fsync config value.
+        """
+        arteria_dir = os.path.join(runfolder, ".arteria")
+        created = not os.path.isdir(arteria_dir)
+        os.makedirs(arteria_dir, exist_ok=True)
+        state_file = os.path.join(arteria_dir, "state")
+        temp_file = "{0}.{1}.{2}.tmp".format(state_file, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_file, 'w') as f:
+                f.write(state)
+                if self._state_fsync != "none":
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_file, state_file)
+        except BaseException:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+            raise
+        if self._state_fsync == "directory":
+            self._fsync_directory(arteria_dir)
+            if created:
+                self._fsync_directory(runfolder)
+
+    @staticmethod
+    def _fsync_directory(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _state_changed(self, runfolder, state):
+        """Updates the store, events and index after the state of runfolder was set"""
+        if self._store is not None:
+            self._store.remove(runfolder)
+        self._observe_state(runfolder, state, publish_unknown=True)
+        self._update_last_seen(runfolder, state)
+        self._refresh_index(runfolder)
+
+    def _refresh_index(self, runfolder):
+        """
+        Refreshes the runfolder in the index, if there is one. In the scanner of a
+        multi-process service, the shared index is written before returning, so that
+        the other processes see the change in the next request.
+        """
+        if self._index:
+            self._index.refresh(runfolder)
+        if self._shared_index_writer is not None:
+            self._shared_index_writer.flush()
+
+    def _observe_state(self, runfolder, state, publish_unknown=False):
+        """
+        Records the state the runfolder was seen in, and publishes an event if it
+        differs from the state it was last seen in. If the runfolder hasn't been seen
+        before, an event is only published if publish_unknown is True.
+        """
+        with self._known_states_lock:
+            previous_state = self._known_states.get(runfolder)
+            self._known_states[runfolder] = state
+        if previous_state != state and (previous_state is not None or publish_unknown):
+            self._logger.debug("Runfolder {0} changed state from {1} to {2}".format(
+                runfolder, previous_state, state))
+            self.events.publish(runfolder, previous_state, state)
+
+    def _forget_states(self, existing):
+        """Forgets the last seen states of all runfolders that are not in existing"""
+        with self._known_states_lock:
+            self._known_states = dict((path, state) for path, state in self._known_states.items()
+                                      if path in existing)
+
+    def _forget_state(self, runfolder):
+        with self._known_states_lock:
+            self._known_states.pop(runfolder, None)
 
     def is_runfolder_ready(self, directory):
         """Returns True if the runfolder is ready"""
@@ -256,40 +781,633 @@ class RunfolderService:
             "Searching for next available runfolder, found: {0}".format(first))
         return first
 
+    def pickup_runfolder(self):
+        """
+        Claims the next ready runfolder, sets its state to PENDING and returns it.
+        Returns None if there is no ready runfolder.
+
+        Each ready runfolder is handed out only once, also when several processes
+        pick up runfolders from the same file system. Within the process, ready
+        runfolders are taken from a queue that is only refilled when it's empty.
+        Across processes, a runfolder is claimed by exclusively creating the file
+        .arteria/claim, after which its state is checked again before it's changed.
+        Each runfolder is tried once per call, so None is also returned when the
+        ready runfolders are all claimed by others or can't be claimed at all.
+        """
+        tried = set()
+        while True:
+            candidate = self._next_pickup_candidate(tried)
+            if candidate is None:
+                self._logger.info("Picking up the next available runfolder, found none")
+                return None
+            tried.add(candidate.path)
+            if not self._claim(candidate.path):
+                continue
+            try:
+                # The state might have changed since the candidate was listed, in which
+                # case the index is out of date too
+                if self.get_runfolder_state(candidate.path) != State.READY:
+                    self._refresh_index(candidate.path)
+                    continue
+                self.set_runfolder_state(candidate.path, State.PENDING)
+            finally:
+                self._release_claim(candidate.path)
+            candidate = candidate.replace(state=State.PENDING)
+            self._logger.info("Picked up runfolder {0}".format(candidate))
+            return candidate
+
+    def _next_pickup_candidate(self, tried):
+        """
+        Returns the next ready runfolder that isn't in tried, refilling the queue if
+        it's empty, or None if there's none
+        """
+        with self._ready_queue_lock:
+            while self._ready_queue:
+                candidate = self._ready_queue.popleft()
+                if candidate.path not in tried:
+                    return candidate
+            # Claiming a runfolder in a monitored directory that doesn't respond
+            # would hang, so those are left until it does
+            stale = set(self.stale_directories())
+            roots = self._monitored_roots()
+            self._ready_queue.extend(info for info in self.list_runfolders(State.READY)
+                                     if roots.root_of(info.path) not in stale and info.path not in tried)
+            if self._ready_queue:
+                return self._ready_queue.popleft()
+            return None
+
+    def _claim(self, runfolder):
+        """
+        Exclusively creates the claim file of the runfolder. Returns False if someone
+        else holds the claim or the runfolder is gone.
+        """
+        arteria_dir = os.path.join(runfolder, ".arteria")
+        claim_file = os.path.join(arteria_dir, "claim")
+        try:
+            os.makedirs(arteria_dir, exist_ok=True)
+        except OSError:
+            return False
+
+        for _ in range(2):
+            try:
+                fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._break_stale_claim(claim_file):
+                    return False
+                continue
+            except OSError:
+                return False
+            try:
+                os.write(fd, "{0}:{1}".format(self._host(), os.getpid()).encode())
+            finally:
+                os.close(fd)
+            return True
+        return False
+
+    def _break_stale_claim(self, claim_file):
+        """
+        Removes the claim file if it's stale. The claim is moved away with a rename,
+        so that only one of several processes can break it, and its age is checked
+        again once it has been moved, as it might have been renewed since it was
+        found stale. Such a claim is put back, unless the runfolder has been claimed
+        again in the meantime.
+        """
+        try:
+            if not self._is_stale_claim(claim_file):
+                return False
+            stale = "{0}.stale.{1}.{2}".format(claim_file, os.getpid(), threading.get_ident())
+            os.rename(claim_file, stale)
+        except OSError:
+            return False
+        broken = False
+        try:
+            broken = self._is_stale_claim(stale)
+            if not broken:
+                os.link(stale, claim_file)
+        except OSError:
+            pass
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
+        if not broken:
+            return False
+        self._logger.warning("Broke the stale claim {0}".format(claim_file))
+        return True
+
+    def _is_stale_claim(self, claim_file):
+        return time.time() - os.path.getmtime(claim_file) >= self.STALE_CLAIM_SECONDS
+
+    @staticmethod
+    def _release_claim(runfolder):
+        try:
+            os.remove(os.path.join(runfolder, ".arteria", "claim"))
+        except OSError:
+            pass
+
     def list_available_runfolders(self):
         return self.list_runfolders(State.READY)
 
-    def list_runfolders(self, state):
+    def list_runfolders(self, state, after=None, filters=None, with_metadata=True):
         """
         Lists all the runfolders on the host, filtered by state. State
         can be any of the values in RunfolderState. Specify None for no filtering.
+
+        The runfolders are ordered by path. If after is specified, only runfolders
+        with a path after it are listed, which can be used to page through the list.
+
+        If the runfolder index is enabled, the runfolders are read from it rather
+        than from disk.
+
+        :param filters: A RunfolderFilter with further filters. The runfolders that it
+                        doesn't match aren't read any further than needed to tell.
+        :param with_metadata: If False, the metadata of runfolders read from disk isn't
+                              read, and might be None
+        :raises PathNotMonitored if the filters are on a root that isn't monitored
         """
-        runfolders = self._enumerate_runfolders()
         if state:
             validate_state(state)
-            return (runfolder for runfolder in runfolders if runfolder.state == state)
+        if filters is not None and filters.roots is not None:
+            unknown = filters.roots - self._monitored_parents()
+            if unknown:
+                raise PathNotMonitored("The path '{}' is not being monitored.".format(sorted(unknown)[0]))
+        if self._index:
+            runfolders = self._index.runfolders(state, after)
+            if filters is None:
+                return runfolders
+            return self._filter_runfolders(runfolders, filters)
+
+        return self._enumerate_runfolders(state, after, filters, with_metadata)
+
+    def _filter_runfolders(self, runfolders, filters):
+        """Yields the runfolders that match the filters"""
+        roots = self._monitored_roots()
+        for info in runfolders:
+            if filters.matches_path(info.path, roots.root_of(info.path)) and \
+                    self._matches_filters(info.path, filters):
+                yield info
+
+    def _matches_filters(self, directory, filters, entries=None):
+        """
+        Returns True if the runfolder at directory matches the filters that require
+        reading it. The age of the completed marker is checked first, as runfolders
+        without a marker are told apart without reading runParameters.xml.
+        """
+        if not filters.reads_runfolder:
+            return True
+        if entries is None:
+            entries = self._runfolder_entries(directory)
+        if filters.depends_on_time and \
+                not filters.matches_marker_mtime(self._completed_marker_mtime(directory, entries)):
+            return False
+        if filters.instruments is not None:
+            run_parameters = self.read_run_parameters(directory, entries)
+            instrument = self._instruments.get_instrument(run_parameters)
+            return filters.matches_instrument(type(instrument).__name__)
+        return True
+
+    @metrics.timed(LIST_ROOT_DURATION, root=lambda monitored_root: monitored_root)
+    def _list_monitored_directory(self, monitored_root):
+        """
+        Returns the paths of all potential runfolders in a monitored directory, which
+        are up to monitored_directory_depth levels below it
+        """
+        self._logger.debug("Checking subdirectories of {0}".format(monitored_root))
+        if self._monitored_depth == 1:
+            candidates = [os.path.join(monitored_root, subdir) for subdir in self._subdirectories(monitored_root)]
         else:
-            return runfolders
-
-    def _enumerate_runfolders(self):
-        """Enumerates all runfolders in any monitored directory"""
-        for monitored_root in self._monitored_directories():
-            self._logger.debug("Checking subdirectories of {0}".format(monitored_root))
-            for subdir in self._subdirectories(monitored_root):
-                directory = os.path.join(monitored_root, subdir)
-                self._logger.debug("Found potential runfolder {0}".format(directory))
-                state = self.get_runfolder_state(directory)
-                info = RunfolderInfo(self._host(), directory, state,
-                                     self.get_metadata(directory))
+            candidates = find_runfolders(monitored_root, self._monitored_depth, self._candidate_matcher,
+                                         self.RUN_PARAMETERS_FILE_NAMES, self._walk_executor(monitored_root))
+        for directory in candidates:
+            self._logger.debug("Found potential runfolder {0}".format(directory))
+        return candidates
+
+    def _scan_monitored_directories(self, filters=None):
+        """
+        Lists the potential runfolders in each monitored directory, or in those that
+        the filters match. Returns a list of (monitored_root, paths) tuples.
+
+        paths is None for the monitored directories that couldn't be listed, because
+        listing them failed or took longer than scan_root_timeout_seconds, and for
+        those whose circuit is open, which aren't listed at all. If there's a timeout,
+        the monitored directories are listed concurrently, in threads.
+        """
+        monitored_roots = [root for root in self._monitored_directories()
+                           if filters is None or filters.matches_root(root)]
+        listed_roots = [root for root in monitored_roots if not self._directory_health.is_open(root)]
+        if not self._threaded_scan:
+            listings = dict((root, self._list_and_record(root)) for root in listed_roots)
+            return [(root, listings.get(root)) for root in monitored_roots]
+
+        futures = []
+        for root in listed_roots:
+            if self._has_unfinished_work(root):
+                self._skip_hung_directory(root)
+            else:
+                futures.append((root, self._root_executor(root).submit(self._list_and_record, root)))
+        deadline = None
+        if self._scan_root_timeout is not None:
+            deadline = time.time() + self._scan_root_timeout
+
+        listings = dict()
+        for root, future in futures:
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                listings[root] = future.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                self._track_unfinished(root, future)
+                self._logger.warning("Listing the monitored directory {0} timed out after {1}s, "
+                                     "skipping it".format(root, self._scan_root_timeout))
+                SCAN_TIMEOUTS.inc(root=root)
+                self._directory_health.record_failure(
+                    root, "listing timed out after {0}s".format(self._scan_root_timeout))
+        return [(root, listings.get(root)) for root in monitored_roots]
+
+    def _root_executor(self, monitored_root):
+        """Returns the thread pool that lists and reads the monitored directory"""
+        with self._root_executors_lock:
+            executor = self._root_executors.get(monitored_root)
+            if executor is None:
+                executor = self._root_executors[monitored_root] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._scan_workers)
+            return executor
+
+    def _walk_executor(self, monitored_root):
+        """
+        Returns the thread pool that lists the levels of the nested monitored directory,
+        or None if they're listed in the thread of the walk
+        """
+        if self._monitored_depth == 1 or self._scan_workers == 1:
+            return None
+        with self._root_executors_lock:
+            executor = self._walk_executors.get(monitored_root)
+            if executor is None:
+                executor = self._walk_executors[monitored_root] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._scan_workers)
+            return executor
+
+    def _track_unfinished(self, monitored_root, future):
+        """Remembers a listing or read of the monitored directory that timed out, until it returns"""
+        if future.done():
+            return
+        with self._root_executors_lock:
+            self._unfinished.setdefault(monitored_root, set()).add(future)
+        future.add_done_callback(lambda done: self._forget_unfinished(monitored_root, done))
+
+    def _forget_unfinished(self, monitored_root, future):
+        with self._root_executors_lock:
+            self._unfinished.get(monitored_root, set()).discard(future)
+
+    def _has_unfinished_work(self, monitored_root):
+        with self._root_executors_lock:
+            return bool(self._unfinished.get(monitored_root))
+
+    def _skip_hung_directory(self, monitored_root):
+        """Records that the monitored directory is skipped, as an earlier listing or read of it hasn't returned"""
+        self._logger.warning("An earlier listing or read of the monitored directory {0} hasn't returned, "
+                             "skipping it".format(monitored_root))
+        self._directory_health.record_failure(monitored_root, "an earlier listing or read hasn't returned")
+
+    def _list_and_record(self, monitored_root):
+        """
+        Lists the monitored directory and records the outcome in its health. Returns
+        None if it couldn't be listed.
+        """
+        started = time.time()
+        try:
+            candidates = self._list_monitored_directory(monitored_root)
+        except OSError as e:
+            self._logger.warning("Could not list the monitored directory {0}: {1}".format(monitored_root, e))
+            self._directory_health.record_failure(monitored_root, str(e))
+            return None
+        duration = time.time() - started
+        # A listing that took longer has been recorded as timed out by the scan
+        if self._scan_root_timeout is None or duration <= self._scan_root_timeout:
+            self._directory_health.record_success(monitored_root, duration)
+        return candidates
+
+    def _runfolder_candidates(self):
+        """
+        Returns the paths of all potential runfolders in the monitored directories,
+        ordered by path
+        """
+        return [path for _, path in self._runfolder_candidates_by_root()]
+
+    def _runfolder_candidates_by_root(self):
+        """
+        Returns (monitored_root, path) for all potential runfolders in the monitored
+        directories, ordered by path
+        """
+        return self._candidates_by_root(self._scan_monitored_directories())
+
+    @staticmethod
+    def _candidates_by_root(scan):
+        """Returns (monitored_root, path) for the runfolders in a scan, ordered by path"""
+        candidates = []
+        for root, paths in scan:
+            if paths is not None:
+                candidates.extend((root, path) for path in paths)
+        candidates.sort(key=lambda candidate: candidate[1])
+        return candidates
+
+    def _runfolder_info(self, directory, entries=None):
+        """Reads the RunfolderInfo of the runfolder at directory from disk"""
+        return self._read_runfolder(directory, entries=entries)
+
+    def _runfolder_info_and_deadline(self, directory):
+        """
+        Returns the RunfolderInfo of the runfolder at directory, and the time when it
+        will become ready if its completed marker is still within the grace period
+        """
+        if self._store is not None:
+            record = self._runfolder_record(directory)
+            if record is not None:
+                deadline = self._deadline_of_marker(record.marker_mtime) if record.state == State.NONE else None
+                return RunfolderInfo(self._host(), directory, record.state, record.metadata), deadline
+
+        entries = self._runfolder_entries(directory)
+        info = self._runfolder_info(directory, entries)
+        deadline = None
+        if info.state == State.NONE:
+            deadline = self._ready_deadline(directory, entries)
+        return info, deadline
+
+    @metrics.timed(READ_RUNFOLDER_DURATION, root="_root_label")
+    def _read_runfolder(self, directory, state=None, entries=None, filters=None, with_metadata=True):
+        """
+        Reads the RunfolderInfo of the runfolder at directory from disk. If state is
+        specified and the runfolder is in another state, or it doesn't match the
+        filters, None is returned.
+
+        The state is determined first, from the directory entries and the state file,
+        then the filters are checked, so that the metadata is only read for runfolders
+        that are returned. If with_metadata is False, it's not read at all.
+
+        If the runfolder store is enabled, the runfolder is only read from disk if it
+        has changed since it was stored.
+        """
+        if self._store is not None and entries is None:
+            filtered = filters is not None and filters.reads_runfolder
+            record = self._runfolder_record(directory, state, with_metadata and not filtered)
+            if record is not None:
+                if state and record.state != state:
+                    return None
+                if filtered and not self._matches_filters(directory, filters):
+                    return None
+                if with_metadata and record.metadata is None:
+                    record = self._runfolder_record(directory, state) or record
+                return RunfolderInfo(self._host(), directory, record.state, record.metadata)
+
+        if entries is None:
+            entries = self._runfolder_entries(directory)
+        runfolder_state = self.get_runfolder_state(directory, entries)
+        if state and runfolder_state != state:
+            return None
+        if filters is not None and not self._matches_filters(directory, filters, entries):
+            return None
+        metadata = self.get_metadata(directory, entries) if with_metadata else None
+        return RunfolderInfo(self._host(), directory, runfolder_state, metadata)
+
+    # A runfolder that was modified this recently when it was read is read again the
+    # next time, as further changes within the resolution of the file system's
+    # modification times would go unnoticed
+    STORE_RACY_SECONDS = 2
+
+    def _runfolder_record(self, directory, state=None, with_metadata=True):
+        """
+        Returns the stored record of the runfolder at directory, reading it from disk
+        and storing it if it has changed. The metadata is only read if with_metadata
+        is True and the runfolder is in state, or state is None. Returns None if the
+        runfolder doesn't exist.
+        """
+        record = self._store.get(directory)
+        try:
+            directory_stat = os.stat(directory)
+            if record is not None and not self._is_stored_record_valid(record, directory_stat):
+                record = None
+            if record is None:
+                record = self._read_runfolder_record(directory, directory_stat, state, with_metadata)
+                self._store.put(record)
+        except (FileNotFoundError, NotADirectoryError):
+            self._store.remove(directory)
+            return None
+
+        if with_metadata and record.metadata is None and (not state or record.state == state):
+            entries = self._runfolder_entries(directory)
+            run_parameters = self.read_run_parameters(directory, entries)
+            record = record._replace(metadata=self.get_metadata(directory, entries),
+                                     instrument=type(self._instruments.get_instrument(run_parameters)).__name__)
+            self._store.put(record)
+        return record
+
+    def _is_stored_record_valid(self, record, directory_stat):
+        if record.dir_mtime_ns is None or record.dir_mtime_ns != directory_stat.st_mtime_ns:
+            return False
+        # Creating the .arteria directory changes the modification time of the runfolder,
+        # but writing the state file only changes that of the state file
+        if record.has_state_dir and record.state_mtime_ns != self._state_file_mtime_ns(record.path):
+            return False
+        if record.state == State.NONE:
+            deadline = self._deadline_of_marker(record.marker_mtime)
+            if deadline is not None and deadline <= time.time():
+                return False
+        return True
+
+    @staticmethod
+    def _state_file_mtime_ns(runfolder):
+        try:
+            return os.stat(os.path.join(runfolder, ".arteria", "state")).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def _read_runfolder_record(self, directory, directory_stat, state=None, with_metadata=True):
+        """
+        Reads a RunfolderRecord from disk, with the metadata only if it's in state and
+        with_metadata is True
+        """
+        entries = self._runfolder_entries(directory)
+        runfolder_state = self.get_runfolder_state(directory, entries)
+        has_state_dir = entries.has_dir(".arteria")
+        state_mtime_ns = self._state_file_mtime_ns(directory) if has_state_dir else None
+        marker_mtime = None
+        if runfolder_state == State.NONE:
+            marker_mtime = self._completed_marker_mtime(directory, entries)
+        metadata = None
+        instrument = None
+        if with_metadata and (not state or runfolder_state == state):
+            metadata = self.get_metadata(directory, entries)
+            run_parameters = self.read_run_parameters(directory, entries)
+            instrument = type(self._instruments.get_instrument(run_parameters)).__name__
+
+        dir_mtime_ns = directory_stat.st_mtime_ns
+        newest_ns = max(dir_mtime_ns, state_mtime_ns or 0)
+        if time.time() - newest_ns / 1e9 < self.STORE_RACY_SECONDS:
+            dir_mtime_ns = None
+        return RunfolderRecord(directory, runfolder_state, dir_mtime_ns, has_state_dir, state_mtime_ns,
+                               marker_mtime, instrument, metadata)
+
+    def _enumerate_runfolders(self, state=None, after=None, filters=None, with_metadata=True):
+        """
+        Enumerates all runfolders in any monitored directory that are in state, or all
+        of them if state is None, ordered by path and starting after the path `after`
+        if it's specified. Only the monitored directories and paths that the filters
+        match are read.
+
+        The runfolders are counted per state when all of them are enumerated.
+        """
+        started = time.time()
+        scan = self._scan_monitored_directories(filters)
+        all_candidates = self._candidates_by_root(scan)
+        stale = self._last_seen_runfolders(scan, filters)
+        candidates = [(root, path) for root, path in all_candidates + list(stale.keys())
+                      if (after is None or path > after) and (filters is None or filters.matches_path(path, root))]
+        candidates.sort(key=lambda candidate: candidate[1])
+
+        unlisted = set(root for root, paths in scan if paths is None)
+
+        def last_seen(root, path):
+            # The runfolder as it was last read, for those in monitored directories that
+            # can't be read now. Filters that require reading it can't be checked.
+            if filters is not None and filters.reads_runfolder:
+                return None
+            with self._last_seen_lock:
+                info = self._last_seen.get(root, dict()).get(path)
+            return info if info is not None and (not state or info.state == state) else None
+
+        def read(root, path):
+            if root in unlisted:
+                return last_seen(root, path)
+            info = self._read_runfolder(path, state, filters=filters, with_metadata=with_metadata)
+            if info is not None:
+                self._remember_runfolder(root, info)
+            return info
+
+        if self._scan_workers > 1:
+            runfolders = self._read_runfolders_in_parallel(candidates, read, last_seen, unlisted)
+        else:
+            runfolders = (read(root, path) for root, path in candidates)
+        counts = collections.Counter()
+        for info in runfolders:
+            if info is not None:
+                counts[info.state] += 1
+                self._observe_state(info.path, info.state)
                 yield info
+        ENUMERATE_DURATION.observe(time.time() - started)
+        if state is None and after is None and filters is None:
+            self._runfolder_counts = dict(counts)
+        if after is None and (filters is None or filters.roots is None) and \
+                all(paths is not None for _, paths in scan):
+            existing = set(path for _, path in all_candidates)
+            self._forget_states(existing)
+            self._flush_store(existing)
+        else:
+            self._flush_store()
+
+    def _last_seen_runfolders(self, scan, filters=None):
+        """
+        Returns the runfolders last read in the monitored directories that couldn't be
+        listed in the scan, as a dict of (monitored_root, path) to RunfolderInfo, and
+        forgets those no longer in the directories that could. The runfolders can't
+        be checked against filters that require reading them, so none are returned
+        for those.
+        """
+        stale = dict()
+        with self._last_seen_lock:
+            for root, paths in scan:
+                last_seen = self._last_seen.get(root)
+                if not last_seen:
+                    continue
+                if paths is not None:
+                    listed = set(paths)
+                    for path in [path for path in last_seen if path not in listed]:
+                        del last_seen[path]
+                elif filters is None or not filters.reads_runfolder:
+                    stale.update(((root, path), info) for path, info in last_seen.items())
+        return stale
+
+    def _remember_runfolder(self, root, info):
+        with self._last_seen_lock:
+            self._last_seen.setdefault(root, dict())[info.path] = info
+
+    def _update_last_seen(self, runfolder, state):
+        """Updates the state of a runfolder that has been seen, after it was set"""
+        with self._last_seen_lock:
+            for last_seen in self._last_seen.values():
+                info = last_seen.get(runfolder)
+                if info is not None:
+                    last_seen[runfolder] = info.replace(state=state)
+
+    def _flush_store(self, existing=None):
+        """
+        Writes the changes to the runfolder store, if it's enabled. If existing is
+        specified, it's all runfolders there are, and the others are removed first.
+        """
+        if self._store is None:
+            return
+        if existing is not None:
+            self._store.retain(existing)
+        self._store.flush()
+
+    def _read_runfolders_in_parallel(self, candidates, read, last_seen, skipped_roots=()):
+        """
+        Reads the runfolders in the thread pools of their monitored directories, by
+        calling read with the monitored root and path of each candidate, and yields
+        the results in the order of candidates. At most scan_workers * 4 runfolders
+        are read ahead, so that consumers that stop early don't cause every runfolder
+        to be read.
+
+        The runfolders in skipped_roots aren't read, and neither are the rest of the
+        runfolders in a monitored directory once reading one of them has timed out,
+        or if an earlier listing or read of it hasn't returned. last_seen is called
+        with their monitored root and path instead.
+        """
+        candidates = iter(candidates)
+        skipped_roots = set(skipped_roots)
+        pending = collections.deque()
+
+        def submit_next():
+            for root, path in candidates:
+                if root not in skipped_roots and self._has_unfinished_work(root):
+                    self._skip_hung_directory(root)
+                    skipped_roots.add(root)
+                if root in skipped_roots:
+                    pending.append((root, path, None))
+                    continue
+                pending.append((root, path, self._root_executor(root).submit(read, root, path)))
+                return
+
+        for _ in range(self._scan_window):
+            submit_next()
+
+        while pending:
+            root, path, future = pending.popleft()
+            submit_next()
+            if root in skipped_roots:
+                if future is not None and not future.cancel():
+                    self._track_unfinished(root, future)
+                yield last_seen(root, path)
+                continue
+            try:
+                info = future.result(timeout=self._scan_root_timeout)
+            except concurrent.futures.TimeoutError:
+                self._track_unfinished(root, future)
+                self._logger.warning("Reading the runfolder {0} timed out after {1}s, skipping the rest "
+                                     "of {2}".format(path, self._scan_root_timeout, root))
+                SCAN_TIMEOUTS.inc(root=root)
+                self._directory_health.record_failure(root, "reading {0} timed out after {1}s".format(
+                    path, self._scan_root_timeout))
+                skipped_roots.add(root)
+                yield last_seen(root, path)
+                continue
+            yield info
 
     def _requires_enabled(self, config_key):
         """Raises an ActionNotEnabled exception if the specified config value is false"""
         if not self._configuration_svc[config_key]:
             raise ActionNotEnabled("The action {0} is not enabled".format(config_key))
 
-    def get_metadata(self, path):
-        run_parameters = self.read_run_parameters(path)
+    def get_metadata(self, path, entries=None):
+        run_parameters = self.read_run_parameters(path, entries)
         reagent_kit_barcode = self.get_reagent_kit_barcode(path, run_parameters)
         library_tube_barcode = self.get_library_tube_barcode(path, run_parameters)
         metadata = {}
@@ -338,18 +1456,38 @@ class RunfolderService:
             return None
         return barcode
 
-    def read_run_parameters(self, path):
-        alt_1 = os.path.join(path, "runParameters.xml")
-        alt_2 = os.path.join(path, "RunParameters.xml")
-        if os.path.exists(alt_1):
-            with open(alt_1) as f:
-                return xmltodict.parse(f.read())
-        elif os.path.exists(alt_2):
-            with open(alt_2) as f:
-                return xmltodict.parse(f.read())
-        else:
+    def read_run_parameters(self, path, entries=None):
+        """
+        Returns the parsed [Rr]unParameters.xml of the runfolder at path, or None if
+        there is none. Parsed files are cached until they change on disk.
+
+        :param entries: The RunfolderEntries of the runfolder, if they have already been
+                        read. The files are then looked up in them rather than on disk.
+        """
+        if entries is not None:
+            for file_name in self.RUN_PARAMETERS_FILE_NAMES:
+                if entries.has_file(file_name):
+                    entry = entries.get(file_name)
+                    try:
+                        return self._run_parameters_cache.get(entry.path, entry.stat())
+                    except FileNotFoundError:
+                        continue
             return None
 
+        for file_name in self.RUN_PARAMETERS_FILE_NAMES:
+            try:
+                return self._run_parameters_cache.get(os.path.join(path, file_name))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return None
+
+    def invalidate_run_parameters(self, path):
+        """Drops any cached run parameters, and the stored record, of the runfolder at path"""
+        if self._store is not None:
+            self._store.remove(path)
+        for file_name in self.RUN_PARAMETERS_FILE_NAMES:
+            self._run_parameters_cache.invalidate(os.path.join(path, file_name))
+
 class CannotOverrideFile(Exception):
     pass
 
@@ -376,3 +1514,11 @@ class InvalidRunfolderState(Exception):
 
 class ConfigurationError(Exception):
     pass
+
+
+class InvalidStateUpdates(Exception):
+    """Raised when some of a batch of state updates are invalid, with why for each of them"""
+
+    def __init__(self, message, errors):
+        super(InvalidStateUpdates, self).__init__(message)
+        self.errors = errors
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Measures request latencies while several clients poll the service concurrently
+and the file system is slow, e.g. a congested NFS mount.
+
+Every client alternates between listing the runfolders, which is slowed down by
+the simulated file system latency, and a trivial health check. The benchmark is
+run once with the handlers accessing the file system directly on the IOLoop
+(thread_pool_size: 0) and once with a thread pool, and prints the p50/p99
+latencies of both as JSON.
+
+Usage:
+    python -m runfolder_tests.benchmarks.concurrency_benchmark [--clients 8] [--requests 20]
+                                                               [--latency 0.05] [--thread-pool-size 8]
+"""
+
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import socket
+import threading
+import time
+
+import tornado.ioloop
+import tornado.web
+
+from runfolder.app import create_executor, routes
+from runfolder.services import RunfolderService
+from runfolder_tests.unit.helpers import RunfolderTree
+
+
+class HealthCheckHandler(tornado.web.RequestHandler):
+    """Stands in for any request that doesn't touch the file system"""
+    def get(self):
+        self.write({"status": "ok"})
+
+
+def find_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('localhost', 0))
+    _, port = s.getsockname()
+    s.close()
+    return port
+
+
+def wait_for_listening(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if sock.connect_ex(('localhost', port)) == 0:
+                return
+        finally:
+            sock.close()
+        time.sleep(0.05)
+    raise RuntimeError("The service did not start listening on port {0}".format(port))
+
+
+def serve(port, thread_pool_size, monitored_directories, latency):
+    """Runs the service in the current process, with latency added to every directory listing"""
+    config = {"monitored_directories": monitored_directories, "thread_pool_size": thread_pool_size}
+    runfolder_svc = RunfolderService(config)
+    subdirectories = runfolder_svc._subdirectories
+
+    def slow_subdirectories(path):
+        time.sleep(latency)
+        return subdirectories(path)
+    runfolder_svc._subdirectories = slow_subdirectories
+
+    args = dict(app_svc=None, runfolder_svc=runfolder_svc, config_svc=config,
+                executor=create_executor(config))
+    application = tornado.web.Application(
+        routes(**args) + [(r"/api/1.0/health", HealthCheckHandler)])
+    application.listen(port)
+    tornado.ioloop.IOLoop.current().start()
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+def run_clients(port, clients, requests):
+    """Runs the clients against the service and returns the latencies per endpoint"""
+    latencies = {"/api/1.0/runfolders": [], "/api/1.0/health": []}
+    lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection("localhost", port)
+        for i in range(requests):
+            for url in latencies:
+                started = time.time()
+                connection.request("GET", url)
+                connection.getresponse().read()
+                elapsed = time.time() - started
+                with lock:
+                    latencies[url].append(elapsed)
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def benchmark(thread_pool_size, monitored_directories, clients, requests, latency):
+    port = find_port()
+    server = multiprocessing.Process(target=serve,
+                                     args=(port, thread_pool_size, monitored_directories, latency))
+    server.start()
+    try:
+        wait_for_listening(port)
+        latencies = run_clients(port, clients, requests)
+    finally:
+        server.terminate()
+        server.join()
+
+    return {url: {"p50_ms": round(percentile(values, 50) * 1000, 2),
+                  "p99_ms": round(percentile(values, 99) * 1000, 2),
+                  "requests": len(values)}
+            for url, values in latencies.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=20, help="Requests per client and endpoint")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds added to every listing of a monitored directory")
+    parser.add_argument("--thread-pool-size", type=int, default=8)
+    args = parser.parse_args()
+
+    tree = RunfolderTree(monitored=("mon1", "mon2"))
+    try:
+        for i in range(10):
+            tree.create_runfolder("runfolder_{0:03d}".format(i), monitored_index=i % 2)
+        results = {
+            "clients": args.clients,
+            "latency_s": args.latency,
+            "on_ioloop": benchmark(0, tree.monitored_directories, args.clients,
+                                   args.requests, args.latency),
+            "thread_pool": benchmark(args.thread_pool_size, tree.monitored_directories,
+                                     args.clients, args.requests, args.latency),
+        }
+    finally:
+        tree.cleanup()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
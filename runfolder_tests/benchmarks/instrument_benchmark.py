@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Compares looking up the instrument of a runfolder with the InstrumentRegistry against
+the previous implementation, which searched the uncompiled ID patterns in turn and
+created a new instrument for every lookup.
+
+The instrument ids are a realistic mix: a few instruments of each kind, where each
+id is looked up many times, as when the runfolders are listed on every request.
+
+Usage:
+    python -m runfolder_tests.benchmarks.instrument_benchmark [--lookups 100000]
+"""
+
+import argparse
+import json
+import random
+import re
+import timeit
+
+from runfolder.lib.instrument import (InstrumentFactory, InstrumentRegistry, Instrument, NovaSeq,
+                                      NovaSeqXPlus, ISeq, MiSeq, HiSeq, HiSeqX)
+from runfolder_tests.benchmarks.synthetic import INSTRUMENT_IDS
+
+
+def previous_get_instrument(run_parameters):
+    """The instrument lookup before the InstrumentRegistry"""
+    if not run_parameters:
+        return Instrument()
+
+    instrument_id = InstrumentFactory.get_id(run_parameters)
+
+    if not instrument_id:
+        return Instrument()
+
+    if re.search(NovaSeq.ID_PATTERN, instrument_id):
+        return NovaSeq()
+    if re.search(NovaSeqXPlus.ID_PATTERN, instrument_id):
+        return NovaSeqXPlus()
+    if re.search(ISeq.ID_PATTERN, instrument_id):
+        return ISeq()
+    if re.search(MiSeq.ID_PATTERN, instrument_id):
+        return MiSeq()
+    if re.search(HiSeq.ID_PATTERN, instrument_id):
+        return HiSeq()
+    if re.search(HiSeqX.ID_PATTERN, instrument_id):
+        return HiSeqX()
+    return Instrument()
+
+
+def run_parameters_mix(lookups, instruments_per_kind=3, seed=0):
+    """Returns run parameters for lookups runfolders, from a few instruments of each kind"""
+    rnd = random.Random(seed)
+    ids = [(instrument, id_format.format(rnd.randrange(1000)))
+           for instrument, id_format in INSTRUMENT_IDS.items() for _ in range(instruments_per_kind)]
+
+    def run_parameters(instrument, instrument_id):
+        if issubclass(instrument, HiSeq):
+            return {"RunParameters": {"Setup": {"ScannerID": instrument_id}}}
+        if instrument is NovaSeqXPlus:
+            return {"RunParameters": {"InstrumentSerialNumber": instrument_id}}
+        return {"RunParameters": {"InstrumentName": instrument_id}}
+
+    return [run_parameters(*rnd.choice(ids)) for _ in range(lookups)]
+
+
+def benchmark(get_instrument, mix, repeat):
+    def lookup_all():
+        for run_parameters in mix:
+            get_instrument(run_parameters)
+    best = min(timeit.repeat(lookup_all, number=1, repeat=repeat))
+    return {"total_ms": round(best * 1000, 2), "per_lookup_us": round(best / len(mix) * 1e6, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    mix = run_parameters_mix(args.lookups)
+    registry = InstrumentRegistry()
+    for run_parameters in mix[:100]:
+        if type(registry.get_instrument(run_parameters)) is not type(previous_get_instrument(run_parameters)):
+            raise RuntimeError("The registry finds another instrument for {0}".format(run_parameters))
+
+    results = {
+        "lookups": args.lookups,
+        "previous": benchmark(previous_get_instrument, mix, args.repeat),
+        "registry": benchmark(registry.get_instrument, mix, args.repeat),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Times the runfolder service against synthetic monitored directories of increasing size.
+
+For each size, a reproducible tree of runfolders is generated (see synthetic.py) and
+list_runfolders, next_runfolder and get_runfolder_by_path are timed, both directly on
+the service and through the HTTP endpoints. The results are printed as JSON, so that
+they can be stored and compared between releases.
+
+Listing is timed twice: cold, with an empty run parameters cache, and warm.
+
+Usage:
+    python -m runfolder_tests.benchmarks.service_benchmark [--sizes 100 1000 10000]
+                                                           [--repeat 5] [--output results.json]
+"""
+
+import argparse
+import collections
+import http.client
+import json
+import multiprocessing
+import platform
+import statistics
+import sys
+import time
+
+import tornado.ioloop
+import tornado.web
+
+from arteria.web.state import State
+
+from runfolder import __version__ as version
+from runfolder.app import create_executor, routes
+from runfolder.services import RunfolderService
+from runfolder_tests.benchmarks.concurrency_benchmark import find_port, wait_for_listening
+from runfolder_tests.benchmarks.synthetic import SyntheticRunfolderTree
+
+
+GRACE_MINUTES = 10
+
+
+def create_config(monitored_directories):
+    return {"monitored_directories": monitored_directories,
+            "completed_marker_grace_minutes": GRACE_MINUTES}
+
+
+def summarize(timings):
+    """Summarizes a list of timings in seconds, in milliseconds"""
+    return {"min_ms": round(min(timings) * 1000, 3),
+            "median_ms": round(statistics.median(timings) * 1000, 3),
+            "max_ms": round(max(timings) * 1000, 3),
+            "runs": len(timings)}
+
+
+def time_calls(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def sample_paths(paths, count=20):
+    """Returns count paths spread evenly over paths"""
+    step = max(1, len(paths) // count)
+    return paths[::step][:count]
+
+
+def benchmark_service(tree, repeat):
+    """
+    Times the RunfolderService methods. Returns the results by name, and the number of
+    runfolders per state.
+    """
+    runfolder_svc = RunfolderService(create_config(tree.monitored_directories))
+    results = dict()
+
+    started = time.perf_counter()
+    runfolders = list(runfolder_svc.list_runfolders(None))
+    results["list_runfolders_all_cold"] = summarize([time.perf_counter() - started])
+    results["list_runfolders_all"] = summarize(
+        time_calls(lambda: list(runfolder_svc.list_runfolders(None)), repeat))
+    results["list_runfolders_ready"] = summarize(
+        time_calls(lambda: list(runfolder_svc.list_runfolders(State.READY)), repeat))
+    results["next_runfolder"] = summarize(time_calls(runfolder_svc.next_runfolder, repeat))
+
+    paths = sample_paths(tree.paths)
+    results["get_runfolder_by_path"] = summarize(
+        [timing for path in paths
+         for timing in time_calls(lambda: runfolder_svc.get_runfolder_by_path(path), repeat)])
+
+    states = collections.Counter(info.state for info in runfolders)
+    return results, dict(states)
+
+
+def serve(port, monitored_directories):
+    """Runs the service in the current process"""
+    config = create_config(monitored_directories)
+    runfolder_svc = RunfolderService(config)
+    args = dict(app_svc=None, runfolder_svc=runfolder_svc, config_svc=config,
+                executor=create_executor(config))
+    tornado.web.Application(routes(**args)).listen(port)
+    tornado.ioloop.IOLoop.current().start()
+
+
+def benchmark_http(tree, repeat):
+    """Times the HTTP endpoints of a service running in another process"""
+    port = find_port()
+    server = multiprocessing.Process(target=serve, args=(port, tree.monitored_directories))
+    server.start()
+    try:
+        wait_for_listening(port)
+        connection = http.client.HTTPConnection("localhost", port)
+
+        def get(url):
+            connection.request("GET", url)
+            response = connection.getresponse()
+            response.read()
+            if response.status not in (200, 204):
+                raise RuntimeError("GET {0} returned {1}".format(url, response.status))
+
+        # Warm up the run parameters cache of the service
+        get("/api/1.0/runfolders?state=*")
+
+        results = dict()
+        results["GET /runfolders?state=*"] = summarize(
+            time_calls(lambda: get("/api/1.0/runfolders?state=*"), repeat))
+        results["GET /runfolders"] = summarize(time_calls(lambda: get("/api/1.0/runfolders"), repeat))
+        results["GET /runfolders?state=*&limit=100"] = summarize(
+            time_calls(lambda: get("/api/1.0/runfolders?state=*&limit=100"), repeat))
+        results["GET /runfolders/next"] = summarize(
+            time_calls(lambda: get("/api/1.0/runfolders/next"), repeat))
+        results["GET /runfolders/path"] = summarize(
+            [timing for path in sample_paths(tree.paths)
+             for timing in time_calls(lambda: get("/api/1.0/runfolders/path" + path), repeat)])
+        connection.close()
+        return results
+    finally:
+        server.terminate()
+        server.join()
+
+
+def benchmark(size, repeat, http=True):
+    started = time.perf_counter()
+    tree = SyntheticRunfolderTree(size, grace_minutes=GRACE_MINUTES)
+    try:
+        generate_s = round(time.perf_counter() - started, 2)
+        service, states = benchmark_service(tree, repeat)
+        result = {"runfolders": size, "generate_s": generate_s, "states": states, "service": service}
+        if http:
+            result["http"] = benchmark_http(tree, repeat)
+        return result
+    finally:
+        tree.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="The numbers of runfolders to benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="Times to repeat each measurement")
+    parser.add_argument("--no-http", action="store_true", help="Only time the service methods")
+    parser.add_argument("--output", help="Write the results to this file rather than stdout")
+    args = parser.parse_args()
+
+    results = {
+        "service_version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "repeat": args.repeat,
+        "results": [benchmark(size, args.repeat, http=not args.no_http) for size in args.sizes],
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
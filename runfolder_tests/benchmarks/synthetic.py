@@ -0,0 +1,180 @@
+"""
+Generates synthetic monitored directories for benchmarking, with runfolders for each
+of the supported instruments in a mix of states.
+
+The runParameters.xml of each instrument has its instrument id and barcodes where
+the real instrument writes them, and is padded with read and lane setup to roughly
+the size of the real files, so that parsing costs about the same.
+"""
+
+import os
+import random
+
+from arteria.web.state import State
+
+from runfolder.lib.instrument import Instrument, NovaSeq, NovaSeqXPlus, ISeq, MiSeq, HiSeq, HiSeqX
+from runfolder_tests.unit.helpers import RunfolderTree
+
+
+LANES = """
+    <LaneInfo>{lanes}
+    </LaneInfo>"""
+
+LANE = """
+      <Lane Number="{number}">
+        <TileCount>{tiles}</TileCount>
+        <SwathCount>2</SwathCount>
+        <SurfaceCount>2</SurfaceCount>
+        <ChemistryVersion>v1.5</ChemistryVersion>
+      </Lane>"""
+
+READS = """
+  <Reads>
+    <Read Number="1" NumCycles="151" IsIndexedRead="N" />
+    <Read Number="2" NumCycles="10" IsIndexedRead="Y" />
+    <Read Number="3" NumCycles="10" IsIndexedRead="Y" />
+    <Read Number="4" NumCycles="151" IsIndexedRead="N" />
+  </Reads>"""
+
+# The instrument specific part of each runParameters.xml, keyed by the instrument class
+RUN_PARAMETERS = {
+    HiSeq: """
+  <Setup>
+    <ScannerID>{instrument_id}</ScannerID>
+    <ApplicationName>HiSeq Control Software</ApplicationName>
+    <ApplicationVersion>2.2.68</ApplicationVersion>{reads}{lanes}
+  </Setup>""",
+    HiSeqX: """
+  <Setup>
+    <ScannerID>{instrument_id}</ScannerID>
+    <ApplicationName>HiSeq Control Software</ApplicationName>
+    <ApplicationVersion>3.4.0.38</ApplicationVersion>{reads}{lanes}
+  </Setup>""",
+    MiSeq: """
+  <ScannerID>{instrument_id}</ScannerID>
+  <ReagentKitBarcode>MS{barcode}-600V3</ReagentKitBarcode>
+  <Setup>
+    <ApplicationName>MiSeq Control Software</ApplicationName>
+    <ApplicationVersion>2.6.2.1</ApplicationVersion>
+  </Setup>{reads}{lanes}""",
+    NovaSeq: """
+  <InstrumentName>{instrument_id}</InstrumentName>
+  <RfidsInfo>
+    <FlowCellSerialBarcode>H{barcode}DSXY</FlowCellSerialBarcode>
+    <LibraryTubeSerialBarcode>NV{barcode}-LIB</LibraryTubeSerialBarcode>
+    <SbsSerialBarcode>NV{barcode}-RGSBS</SbsSerialBarcode>
+  </RfidsInfo>
+  <ApplicationName>NovaSeq Control Software</ApplicationName>
+  <ApplicationVersion>1.7.5</ApplicationVersion>{reads}{lanes}""",
+    NovaSeqXPlus: """
+  <InstrumentType>NovaSeqXPlus</InstrumentType>
+  <InstrumentSerialNumber>{instrument_id}</InstrumentSerialNumber>
+  <ConsumableInfo>
+    <ConsumableInfo>
+      <SerialNumber>LC{barcode}-LC1</SerialNumber>
+      <Type>FlowCell</Type>
+    </ConsumableInfo>
+    <ConsumableInfo>
+      <SerialNumber>LC{barcode}-LIB</SerialNumber>
+      <Type>SampleTube</Type>
+    </ConsumableInfo>
+    <ConsumableInfo>
+      <SerialNumber>LC{barcode}-RGT</SerialNumber>
+      <Type>Reagent</Type>
+    </ConsumableInfo>
+  </ConsumableInfo>{reads}{lanes}""",
+    ISeq: """
+  <InstrumentName>{instrument_id}</InstrumentName>
+  <RfidsInfo>
+    <LibraryTubeSerialBarcode>LC{barcode}-LIB</LibraryTubeSerialBarcode>
+  </RfidsInfo>
+  <ApplicationName>iSeq Control Software</ApplicationName>
+  <ApplicationVersion>2.0.0</ApplicationVersion>{reads}{lanes}""",
+    Instrument: """
+  <InstrumentId>{instrument_id}</InstrumentId>{reads}{lanes}""",
+}
+
+INSTRUMENT_IDS = {
+    HiSeq: "D00{0:03d}",
+    HiSeqX: "ST-E00{0:03d}",
+    MiSeq: "M0{0:04d}",
+    NovaSeq: "A00{0:03d}",
+    NovaSeqXPlus: "LH00{0:03d}",
+    ISeq: "FS1000{0:04d}",
+    Instrument: "X{0:05d}",
+}
+
+LANE_COUNTS = {HiSeq: 8, HiSeqX: 8, MiSeq: 1, NovaSeq: 4, NovaSeqXPlus: 8, ISeq: 1, Instrument: 1}
+
+# How the runfolders are distributed over the states. Runfolders without a state file
+# are either still sequencing (no marker), finished but within the grace period (fresh
+# marker), or ready (old marker).
+STATE_WEIGHTS = [
+    ("sequencing", 10),
+    ("in_grace_period", 5),
+    (State.READY, 15),
+    (State.PENDING, 5),
+    (State.STARTED, 10),
+    (State.DONE, 50),
+    (State.ERROR, 5),
+]
+
+
+def run_parameters(instrument, instrument_id, barcode):
+    """Returns the contents of a runParameters.xml written by instrument"""
+    lanes = "".join(LANE.format(number=number, tiles=random.Random(number).choice([16, 64, 88]))
+                    for number in range(1, LANE_COUNTS[instrument] + 1))
+    body = RUN_PARAMETERS[instrument].format(instrument_id=instrument_id, barcode=barcode,
+                                             reads=READS, lanes=LANES.format(lanes=lanes))
+    return '<?xml version="1.0"?>\n<RunParameters xmlns:xsd="http://www.w3.org/2001/XMLSchema">' \
+           '{0}\n</RunParameters>\n'.format(body)
+
+
+class SyntheticRunfolderTree(RunfolderTree):
+    """
+    A RunfolderTree with a reproducible set of runfolders, spread over the monitored
+    directories, instruments and states
+    """
+
+    def __init__(self, runfolders, monitored=("mon1", "mon2"), grace_minutes=10, seed=0):
+        super(SyntheticRunfolderTree, self).__init__(monitored)
+        self.grace_minutes = grace_minutes
+        self.paths_by_kind = dict()
+        rnd = random.Random(seed)
+        instruments = sorted(RUN_PARAMETERS, key=lambda instrument: instrument.__name__)
+        kinds = [kind for kind, _ in STATE_WEIGHTS]
+        weights = [weight for _, weight in STATE_WEIGHTS]
+        for i in range(runfolders):
+            instrument = instruments[i % len(instruments)]
+            kind = rnd.choices(kinds, weights)[0]
+            path = self._create_synthetic_runfolder(i, instrument, kind, rnd)
+            self.paths_by_kind.setdefault(kind, []).append(path)
+
+    @property
+    def paths(self):
+        return sorted(path for paths in self.paths_by_kind.values() for path in paths)
+
+    def _create_synthetic_runfolder(self, i, instrument, kind, rnd):
+        instrument_id = INSTRUMENT_IDS[instrument].format(rnd.randrange(1000))
+        name = "{0:06d}_{1}_{2:04d}_{3:09d}".format(rnd.randrange(200101, 241231), instrument_id, i,
+                                                    rnd.randrange(10 ** 9))
+        path = os.path.join(self.monitored_directories[i % len(self.monitored_directories)], name)
+        os.mkdir(path)
+        with open(os.path.join(path, "runParameters.xml"), "w") as f:
+            f.write(run_parameters(instrument, instrument_id, "{0:07d}".format(rnd.randrange(10 ** 7))))
+
+        marker = instrument.completed_marker_file()
+        if kind == "in_grace_period":
+            self.add_marker(path, marker, rnd.uniform(0, self.grace_minutes * 60 - 60))
+        elif kind != "sequencing":
+            # Finished runs also have the RTAComplete.txt that precedes CopyComplete.txt
+            self.add_marker(path, Instrument.completed_marker_file(), self._marker_age(rnd))
+            self.add_marker(path, marker, self._marker_age(rnd))
+        if kind in (State.PENDING, State.STARTED, State.DONE, State.ERROR):
+            self.set_state(path, kind)
+        return path
+
+    def _marker_age(self, rnd):
+        """Returns an age past the grace period, between minutes and months"""
+        return self.grace_minutes * 60 + rnd.expovariate(1.0 / (7 * 24 * 3600))
+
@@ -0,0 +1,58 @@
+import threading
+
+import tornado.gen
+import tornado.testing
+
+from arteria.web.state import State
+
+from runfolder.lib.events import RunfolderEventLog
+
+
+class RunfolderEventLogTestCase(tornado.testing.AsyncTestCase):
+
+    def test_events_since_sequence(self):
+        events = RunfolderEventLog()
+        self.assertEqual(events.since(0), ([], False))
+        events.publish("/mon/a", State.NONE, State.READY)
+        events.publish("/mon/b", State.READY, State.PENDING)
+        events.publish("/mon/a", State.READY, State.STARTED)
+
+        found, missed = events.since(1)
+        self.assertEqual([(event.sequence, event.path, event.state) for event in found],
+                         [(2, "/mon/b", State.PENDING), (3, "/mon/a", State.STARTED)])
+        self.assertFalse(missed)
+        self.assertEqual([event.sequence for event in events.since(0, limit=2)[0]], [1, 2])
+        self.assertEqual(events.since(3), ([], False))
+        self.assertEqual(events.last_sequence, 3)
+
+    def test_dropped_events_are_missed(self):
+        events = RunfolderEventLog(capacity=2)
+        for state in (State.READY, State.PENDING, State.STARTED):
+            events.publish("/mon/a", None, state)
+
+        found, missed = events.since(0)
+        self.assertEqual([event.sequence for event in found], [2, 3])
+        self.assertTrue(missed)
+        self.assertFalse(events.since(1)[1])
+
+    @tornado.testing.gen_test
+    def test_waiters_are_woken_by_events_from_other_threads(self):
+        events = RunfolderEventLog()
+        waiting = events.wait(0)
+        self.assertFalse(waiting.done())
+
+        publisher = threading.Thread(target=events.publish, args=("/mon/a", State.NONE, State.READY))
+        publisher.start()
+        yield waiting
+        publisher.join()
+        self.assertEqual(len(events.since(0)[0]), 1)
+        self.assertTrue(events.wait(0).done())
+
+    @tornado.testing.gen_test
+    def test_cancelled_waiters_are_not_woken(self):
+        events = RunfolderEventLog()
+        waiting = events.wait(0)
+        events.cancel(waiting)
+        events.publish("/mon/a", State.NONE, State.READY)
+        yield tornado.gen.moment
+        self.assertFalse(waiting.done())
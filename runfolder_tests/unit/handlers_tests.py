@@ -0,0 +1,341 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import mock
+import tornado.gen
+import tornado.tcpclient
+import tornado.testing
+import tornado.web
+
+from arteria.web.state import State
+
+from runfolder.app import routes
+from runfolder.lib.events import RunfolderEventLog
+from runfolder.services import DirectoryDoesNotExist, InvalidStateUpdates, PathNotMonitored, RunfolderInfo, \
+    RunfolderService
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseHandlerTestCase(tornado.testing.AsyncHTTPTestCase):
+    """Runs the handlers in-process against a mocked RunfolderService"""
+
+    def get_app(self):
+        self.runfolder_svc = mock.create_autospec(RunfolderService, instance=True)
+        self.runfolder_svc.events = RunfolderEventLog()
+        self.runfolder_svc.listing_version.return_value = None
+        self.runfolder_svc.stale_directories.return_value = []
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        args = dict(app_svc=None, runfolder_svc=self.runfolder_svc, config_svc=dict(),
+                    executor=self.executor)
+        return tornado.web.Application(routes(**args))
+
+    def tearDown(self):
+        super(BaseHandlerTestCase, self).tearDown()
+        self.executor.shutdown()
+
+    @staticmethod
+    def _runfolder(path, state=State.READY):
+        return RunfolderInfo("localhost", path, state, dict())
+
+
+class RunfolderHandlersTestCase(BaseHandlerTestCase):
+
+    def test_list_runfolders(self):
+        self.runfolder_svc.list_runfolders.return_value = iter([self._runfolder("/mon1/runfolder001")])
+
+        response = self.fetch("/api/1.0/runfolders?state=*")
+        self.assertEqual(response.code, 200)
+        runfolders = json.loads(response.body.decode())["runfolders"]
+        self.assertEqual([runfolder["path"] for runfolder in runfolders], ["/mon1/runfolder001"])
+        self.assertTrue(runfolders[0]["link"].endswith("/api/1.0/runfolders/path/mon1/runfolder001"))
+        self.runfolder_svc.list_runfolders.assert_called_once_with(None, None, None, True)
+
+    def test_list_runfolders_response(self):
+        runfolder = self._runfolder("/mon1/runfolder001")
+        self.runfolder_svc.list_runfolders.return_value = iter([runfolder])
+
+        response = self.fetch("/api/1.0/runfolders?limit=1")
+        self.assertEqual(response.headers["Content-Type"], "application/json; charset=UTF-8")
+        expected = runfolder.replace(link=self.get_url("/api/1.0/runfolders/path/mon1/runfolder001"))
+        self.assertEqual(json.loads(response.body.decode()),
+                         {"next_cursor": None, "runfolders": [expected.to_dict()]})
+
+    def _list_runfolders(self, count):
+        paths = ["/mon1/runfolder{0:03d}".format(i) for i in range(count)]
+
+        def list_runfolders(state, after=None, filters=None, with_metadata=True):
+            return iter([self._runfolder(path) for path in paths if after is None or path > after])
+        self.runfolder_svc.list_runfolders.side_effect = list_runfolders
+
+    def test_list_runfolders_in_pages(self):
+        self._list_runfolders(5)
+
+        pages = []
+        url = "/api/1.0/runfolders?limit=2"
+        while url:
+            body = json.loads(self.fetch(url).body.decode())
+            pages.append([runfolder["path"] for runfolder in body["runfolders"]])
+            cursor = body["next_cursor"]
+            url = "/api/1.0/runfolders?limit=2&cursor={0}".format(cursor) if cursor else None
+
+        self.assertEqual(pages, [["/mon1/runfolder000", "/mon1/runfolder001"],
+                                 ["/mon1/runfolder002", "/mon1/runfolder003"],
+                                 ["/mon1/runfolder004"]])
+
+    def test_list_runfolders_rejects_invalid_paging_arguments(self):
+        self._list_runfolders(1)
+        self.assertEqual(self.fetch("/api/1.0/runfolders?limit=0").code, 400)
+        self.assertEqual(self.fetch("/api/1.0/runfolders?limit=all").code, 400)
+        self.assertEqual(self.fetch("/api/1.0/runfolders?cursor=%25%25").code, 400)
+
+    def test_stream_runfolders(self):
+        self._list_runfolders(3)
+
+        response = self.fetch("/api/1.0/runfolders?stream=true&limit=2")
+        self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(line) for line in response.body.decode().splitlines()]
+        self.assertEqual([line.get("path") for line in lines[:2]],
+                         ["/mon1/runfolder000", "/mon1/runfolder001"])
+        self.assertTrue(lines[0]["link"].endswith("/runfolders/path/mon1/runfolder000"))
+        self.assertEqual(set(lines[2].keys()), {"next_cursor"})
+
+        response = self.fetch("/api/1.0/runfolders?stream=true&cursor={0}".format(lines[2]["next_cursor"]))
+        lines = [json.loads(line) for line in response.body.decode().splitlines()]
+        self.assertEqual([line["path"] for line in lines], ["/mon1/runfolder002"])
+
+    def test_list_runfolders_with_filters_and_fields(self):
+        self.runfolder_svc.list_runfolders.return_value = iter([self._runfolder("/mon1/runfolder001")])
+
+        response = self.fetch("/api/1.0/runfolders?root=/mon1&instrument=NovaSeq,MiSeq&glob=*001"
+                              "&max_marker_age=3600&fields=path,state")
+        self.assertEqual(json.loads(response.body.decode())["runfolders"],
+                         [{"path": "/mon1/runfolder001", "state": State.READY}])
+        state, after, filters, with_metadata = self.runfolder_svc.list_runfolders.call_args[0]
+        self.assertEqual(filters.roots, {"/mon1"})
+        self.assertEqual(filters.instruments, {"novaseq", "miseq"})
+        self.assertEqual((filters.glob, filters.min_marker_age, filters.max_marker_age), ("*001", None, 3600))
+        self.assertFalse(with_metadata)
+
+    def test_list_runfolders_rejects_invalid_filters(self):
+        self._list_runfolders(1)
+        self.assertEqual(self.fetch("/api/1.0/runfolders?fields=path,size").code, 400)
+        self.assertEqual(self.fetch("/api/1.0/runfolders?min_marker_age=-1").code, 400)
+        self.assertEqual(self.fetch("/api/1.0/runfolders?max_marker_age=old").code, 400)
+
+        self.runfolder_svc.list_runfolders.side_effect = PathNotMonitored("The path '/mon3' is not being monitored.")
+        self.assertEqual(self.fetch("/api/1.0/runfolders?root=/mon3").code, 400)
+
+    def test_stale_directories_are_flagged(self):
+        self._list_runfolders(1)
+        self.runfolder_svc.stale_directories.return_value = ["/mon2"]
+
+        body = json.loads(self.fetch("/api/1.0/runfolders").body.decode())
+        self.assertEqual(body["stale_directories"], ["/mon2"])
+        self.assertEqual(len(body["runfolders"]), 1)
+        response = self.fetch("/api/1.0/runfolders?stream=true")
+        self.assertEqual(response.headers["X-Stale-Directories"], "/mon2")
+
+    def test_monitored_directories(self):
+        status = [{"path": "/mon1", "circuit": "closed", "stale": False}]
+        self.runfolder_svc.monitored_directory_status.return_value = status
+
+        response = self.fetch("/api/1.0/monitored_directories")
+        self.assertEqual(json.loads(response.body.decode()), {"monitored_directories": status})
+
+    def test_unchanged_listing_is_not_modified(self):
+        self.runfolder_svc.listing_version.return_value = "1.1"
+        self.runfolder_svc.list_runfolders.side_effect = lambda state, after, *args: iter([self._runfolder("/mon1/a")])
+
+        response = self.fetch("/api/1.0/runfolders")
+        self.assertEqual(response.code, 200)
+        etag = response.headers["Etag"]
+        self.assertNotEqual(etag, self.fetch("/api/1.0/runfolders?state=*").headers["Etag"])
+
+        self.runfolder_svc.list_runfolders.reset_mock()
+        response = self.fetch("/api/1.0/runfolders", headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 304)
+        self.assertFalse(self.runfolder_svc.list_runfolders.called)
+
+        self.runfolder_svc.listing_version.return_value = "1.2"
+        response = self.fetch("/api/1.0/runfolders", headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+
+        etag = response.headers["Etag"]
+        self.runfolder_svc.stale_directories.return_value = ["/mon2"]
+        response = self.fetch("/api/1.0/runfolders", headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+
+        # Runfolders age into the listing without the version changing
+        etag = self.fetch("/api/1.0/runfolders?min_marker_age=60").headers["Etag"]
+        self.runfolder_svc.list_runfolders.reset_mock()
+        self.fetch("/api/1.0/runfolders?min_marker_age=60", headers={"If-None-Match": etag})
+        self.assertTrue(self.runfolder_svc.list_runfolders.called)
+        self.assertNotEqual(response.headers["Etag"], etag)
+
+    def test_next_without_ready_runfolder(self):
+        self.runfolder_svc.next_runfolder.return_value = None
+        response = self.fetch("/api/1.0/runfolders/next")
+        self.assertEqual(response.code, 204)
+
+    def test_pickup(self):
+        self.runfolder_svc.pickup_runfolder.return_value = self._runfolder("/mon1/runfolder001",
+                                                                           State.PENDING)
+
+        response = self.fetch("/api/1.0/runfolders/pickup")
+        body = json.loads(response.body.decode())
+        self.assertEqual(body["state"], State.PENDING)
+        self.assertEqual(body["path"], "/mon1/runfolder001")
+
+    def test_pickup_without_ready_runfolder(self):
+        self.runfolder_svc.pickup_runfolder.return_value = None
+        response = self.fetch("/api/1.0/runfolders/pickup")
+        self.assertEqual(response.code, 204)
+
+    def test_metrics(self):
+        self.runfolder_svc.next_runfolder.return_value = None
+        self.fetch("/api/1.0/runfolders/next")
+
+        response = self.fetch("/api/1.0/metrics")
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn('runfolder_http_request_duration_seconds_count{handler="NextAvailableRunfolderHandler",'
+                      'method="GET",code="204"}', response.body.decode())
+
+    def test_lookup(self):
+        self.runfolder_svc.get_runfolders_by_path.return_value = [
+            self._runfolder("/mon1/runfolder001"), PathNotMonitored("/other/runfolder002"),
+            DirectoryDoesNotExist("/mon1/runfolder003"), self._runfolder("/mon1/runfolder004", State.DONE)]
+        paths = ["/mon1/runfolder001", "/other/runfolder002", "/mon1/runfolder003", "/mon1/runfolder004"]
+
+        response = self.fetch("/api/1.0/runfolders/lookup", method="POST", body=json.dumps({"paths": paths}))
+        self.assertEqual(response.code, 200)
+        self.runfolder_svc.get_runfolders_by_path.assert_called_once_with(paths)
+        body = json.loads(response.body.decode())
+        self.assertEqual([(runfolder["path"], runfolder["state"]) for runfolder in body["runfolders"]],
+                         [("/mon1/runfolder001", State.READY), ("/mon1/runfolder004", State.DONE)])
+        self.assertTrue(body["runfolders"][0]["link"].endswith("/api/1.0/runfolders/path/mon1/runfolder001"))
+        self.assertEqual(body["not_monitored"], ["/other/runfolder002"])
+        self.assertEqual(body["not_found"], ["/mon1/runfolder003"])
+
+    def test_lookup_rejects_malformed_body(self):
+        for body in ("not json", "{}", '{"paths": "/mon1/runfolder001"}', '{"paths": [1]}'):
+            response = self.fetch("/api/1.0/runfolders/lookup", method="POST", body=body)
+            self.assertEqual(response.code, 400, body)
+
+    def test_set_states(self):
+        self.runfolder_svc.set_runfolder_states.return_value = [None, "Permission denied"]
+        body = {"runfolders": [{"path": "/mon1/runfolder001", "state": State.DONE},
+                               {"path": "/mon1/runfolder002", "state": State.ERROR}]}
+
+        response = self.fetch("/api/1.0/runfolders/states", method="POST", body=json.dumps(body))
+        self.assertEqual(response.code, 200)
+        self.runfolder_svc.set_runfolder_states.assert_called_once_with(
+            [("/mon1/runfolder001", State.DONE), ("/mon1/runfolder002", State.ERROR)])
+        self.assertEqual(json.loads(response.body.decode())["runfolders"], [
+            {"path": "/mon1/runfolder001", "state": State.DONE, "updated": True, "error": None},
+            {"path": "/mon1/runfolder002", "state": State.ERROR, "updated": False, "error": "Permission denied"}])
+
+    def test_set_states_with_invalid_update(self):
+        self.runfolder_svc.set_runfolder_states.side_effect = InvalidStateUpdates(
+            "1 of 2 state updates are invalid", [None, "The state 'archived' is not valid"])
+        body = {"runfolders": [{"path": "/mon1/runfolder001", "state": State.DONE},
+                               {"path": "/mon1/runfolder002", "state": "archived"}]}
+
+        response = self.fetch("/api/1.0/runfolders/states", method="POST", body=json.dumps(body))
+        self.assertEqual(response.code, 400)
+        results = json.loads(response.body.decode())["runfolders"]
+        self.assertEqual([result["updated"] for result in results], [False, False])
+        self.assertEqual(results[1]["error"], "The state 'archived' is not valid")
+
+    def test_set_states_rejects_malformed_body(self):
+        for body in ("not json", "{}", '{"runfolders": {}}', '{"runfolders": [{"path": "/mon1/runfolder001"}]}',
+                     '{"runfolders": [{"path": 1, "state": "done"}]}'):
+            response = self.fetch("/api/1.0/runfolders/states", method="POST", body=body)
+            self.assertEqual(response.code, 400, body)
+        self.assertFalse(self.runfolder_svc.set_runfolder_states.called)
+
+    def test_events_since_sequence(self):
+        events = self.runfolder_svc.events
+        events.publish("/mon1/runfolder001", State.NONE, State.READY)
+        events.publish("/mon1/runfolder002", State.READY, State.PENDING)
+
+        response = self.fetch("/api/1.0/runfolders/events?since=1")
+        self.assertEqual(response.code, 200)
+        body = json.loads(response.body.decode())
+        self.assertEqual(body["last_sequence"], 2)
+        self.assertFalse(body["missed"])
+        self.assertEqual([(event["path"], event["previous_state"], event["state"]) for event in body["events"]],
+                         [("/mon1/runfolder002", State.READY, State.PENDING)])
+        self.assertTrue(body["events"][0]["link"].endswith("/api/1.0/runfolders/path/mon1/runfolder002"))
+
+    def test_events_times_out_without_events(self):
+        self.runfolder_svc.events.publish("/mon1/runfolder001", State.NONE, State.READY)
+
+        response = self.fetch("/api/1.0/runfolders/events?timeout=0.1")
+        body = json.loads(response.body.decode())
+        self.assertEqual(body, {"events": [], "last_sequence": 1, "missed": False})
+
+    def test_events_after_restart_are_missed(self):
+        self.runfolder_svc.events.publish("/mon1/runfolder001", State.NONE, State.READY)
+
+        body = json.loads(self.fetch("/api/1.0/runfolders/events?since=50").body.decode())
+        self.assertTrue(body["missed"])
+        self.assertEqual([event["sequence"] for event in body["events"]], [1])
+
+    def test_events_rejects_invalid_arguments(self):
+        for query in ("since=-1", "since=abc", "timeout=301", "timeout=abc"):
+            response = self.fetch("/api/1.0/runfolders/events?" + query)
+            self.assertEqual(response.code, 400, query)
+
+    @tornado.testing.gen_test
+    def test_long_poll_returns_published_event(self):
+        polling = self.http_client.fetch(self.get_url("/api/1.0/runfolders/events?since=0&timeout=5"))
+        yield tornado.gen.sleep(0.1)
+        self.assertFalse(polling.done())
+
+        threading.Thread(target=self.runfolder_svc.events.publish,
+                         args=("/mon1/runfolder001", State.NONE, State.READY)).start()
+        response = yield polling
+        body = json.loads(response.body.decode())
+        self.assertEqual([event["state"] for event in body["events"]], [State.READY])
+
+    @tornado.testing.gen_test
+    def test_server_sent_events_resume_after_last_event_id(self):
+        events = self.runfolder_svc.events
+        events.publish("/mon1/runfolder001", State.NONE, State.READY)
+        events.publish("/mon1/runfolder002", State.NONE, State.READY)
+        stream = yield tornado.tcpclient.TCPClient().connect("127.0.0.1", self.get_http_port())
+        yield stream.write(b"GET /api/1.0/runfolders/events HTTP/1.1\r\nHost: localhost\r\n"
+                           b"Accept: text/event-stream\r\nLast-Event-ID: 1\r\n\r\n")
+        received = yield stream.read_until(b"id: 2\n")
+        events.publish("/mon1/runfolder001", State.READY, State.PENDING)
+        received += yield stream.read_until(b"id: 3\n")
+        stream.close()
+
+        received = received.decode()
+        self.assertIn("Content-Type: text/event-stream", received)
+        self.assertNotIn("id: 1\n", received)
+        self.assertIn('id: 2\nevent: state\ndata: {"sequence": 2, "path": "/mon1/runfolder002"', received)
+
+    @tornado.testing.gen_test
+    def test_slow_listing_does_not_block_other_requests(self):
+        listing_may_finish = threading.Event()
+
+        def slow_listing(state, after=None, *args):
+            listing_may_finish.wait(5)
+            return iter([])
+        self.runfolder_svc.list_runfolders.side_effect = slow_listing
+        self.runfolder_svc.next_runfolder.return_value = None
+
+        slow = self.http_client.fetch(self.get_url("/api/1.0/runfolders"))
+        fast = yield self.http_client.fetch(self.get_url("/api/1.0/runfolders/next"))
+        self.assertEqual(fast.code, 204)
+        self.assertFalse(slow.done())
+
+        listing_may_finish.set()
+        response = yield slow
+        self.assertEqual(response.code, 200)
@@ -0,0 +1,261 @@
+import unittest
+import logging
+import os
+import shutil
+import threading
+import time
+
+import mock
+from arteria.web.state import State
+
+from runfolder.lib.health import CLOSED, OPEN, MonitoredDirectoryHealth
+from runfolder.lib.scanner import subdirectories
+from runfolder.services import RunfolderService
+from runfolder_tests.unit.helpers import RunfolderTree, wait_for
+
+
+logger = logging.getLogger(__name__)
+
+
+class MonitoredDirectoryHealthTestCase(unittest.TestCase):
+
+    def test_circuit_opens_after_failures_in_a_row(self):
+        health = MonitoredDirectoryHealth(failure_threshold=2, logger=logger)
+        health.record_failure("/mon1", "timed out")
+        health.record_success("/mon1", 0.1)
+        health.record_failure("/mon1", "timed out")
+        self.assertFalse(health.is_open("/mon1"))
+        self.assertEqual(health.stale_directories(), ["/mon1"])
+
+        health.record_failure("/mon1", "timed out")
+        self.assertTrue(health.is_open("/mon1"))
+        status = health.status()[0]
+        self.assertEqual((status["path"], status["circuit"], status["consecutive_failures"], status["last_error"]),
+                         ("/mon1", OPEN, 2, "timed out"))
+
+        health.record_success("/mon1", 0.1)
+        self.assertFalse(health.is_open("/mon1"))
+        self.assertEqual(health.stale_directories(), [])
+
+    def test_circuit_never_opens_without_threshold(self):
+        health = MonitoredDirectoryHealth(failure_threshold=0, logger=logger)
+        for _ in range(10):
+            health.record_failure("/mon1", "timed out")
+        self.assertFalse(health.is_open("/mon1"))
+
+    def test_open_circuit_is_closed_by_probe(self):
+        health = MonitoredDirectoryHealth(failure_threshold=1, probe_interval=0.05, logger=logger)
+        responding = threading.Event()
+        probed = []
+
+        def probe(path):
+            probed.append(path)
+            if not responding.is_set():
+                raise OSError("Stale file handle")
+        health.record_failure("/mon1", "timed out")
+        health.start_probing(probe)
+        try:
+            self.assertTrue(wait_for(lambda: len(probed) >= 2))
+            self.assertTrue(health.is_open("/mon1"))
+            responding.set()
+            self.assertTrue(wait_for(lambda: not health.is_open("/mon1")))
+        finally:
+            health.stop()
+        self.assertEqual(health.status()[0]["circuit"], CLOSED)
+
+
+class RunfolderServiceHealthTestCase(unittest.TestCase):
+    """Shows that a monitored directory that hangs degrades the listing rather than blocking it"""
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.hung = self.tree.create_runfolder("runfolder_hung")
+        self.healthy = self.tree.create_runfolder("runfolder_healthy", monitored_index=1)
+        self.unblock = threading.Event()
+        self.unblock.set()
+        self.listed = []
+        self.runfolder_svc = RunfolderService({
+            "monitored_directories": self.tree.monitored_directories,
+            "scan_root_timeout_seconds": 0.2,
+            "scan_root_failure_threshold": 2,
+        }, logger)
+        self.runfolder_svc._subdirectories = self._subdirectories
+
+    def tearDown(self):
+        self.unblock.set()
+        self.tree.cleanup()
+
+    def _subdirectories(self, path):
+        self.listed.append(path)
+        if path == self.tree.monitored_directories[0]:
+            self.unblock.wait(5)
+        return subdirectories(path)
+
+    def _list(self):
+        started = time.time()
+        paths = [info.path for info in self.runfolder_svc.list_runfolders(State.READY)]
+        self.assertLess(time.time() - started, 2)
+        return paths
+
+    def test_hung_directory_is_served_from_last_seen_runfolders(self):
+        mon1 = self.tree.monitored_directories[0]
+        self.assertEqual(self._list(), [self.hung, self.healthy])
+        self.assertEqual(self.runfolder_svc.stale_directories(), [])
+
+        self.unblock.clear()
+        self.assertEqual(self._list(), [self.hung, self.healthy])
+        self.assertEqual(self.runfolder_svc.stale_directories(), [mon1])
+        self.assertEqual(self._list(), [self.hung, self.healthy])
+        status = dict((health["path"], health) for health in self.runfolder_svc.monitored_directory_status())
+        self.assertEqual(status[mon1]["circuit"], OPEN)
+        self.assertEqual(status[self.tree.monitored_directories[1]]["circuit"], CLOSED)
+
+        # The open circuit isn't tried by requests
+        del self.listed[:]
+        self.assertEqual(self._list(), [self.hung, self.healthy])
+        self.assertNotIn(mon1, self.listed)
+        # and its runfolders aren't picked up
+        self.assertEqual(self.runfolder_svc.pickup_runfolder().path, self.healthy)
+
+        self.unblock.set()
+        self.runfolder_svc._directory_health.record_success(mon1, 0.1)
+        self.assertEqual(self._list(), [self.hung])
+        self.assertEqual(self.runfolder_svc.stale_directories(), [])
+
+    def test_state_set_while_stale_is_listed(self):
+        self.assertEqual(self._list(), [self.hung, self.healthy])
+        self.runfolder_svc.set_runfolder_state(self.hung, State.STARTED)
+
+        self.unblock.clear()
+        self.assertEqual(self._list(), [self.healthy])
+
+    def test_directory_that_fails_to_be_listed_is_stale(self):
+        mon2 = self.tree.monitored_directories[1]
+        self.assertEqual(self._list(), [self.hung, self.healthy])
+        shutil.rmtree(mon2)
+
+        self.assertEqual(self._list(), [self.hung, self.healthy])
+        self.assertEqual(self.runfolder_svc.stale_directories(), [mon2])
+        self.assertIn("No such file or directory", self.runfolder_svc.monitored_directory_status()[1]["last_error"])
+
+
+class RunfolderServiceParallelHealthTestCase(unittest.TestCase):
+    """Shows that a monitored directory that hangs doesn't take the scan threads of the others"""
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.hung = self.tree.create_runfolder("runfolder_hung")
+        self.healthy = self.tree.create_runfolder("runfolder_healthy", monitored_index=1)
+        self.unblock = threading.Event()
+        self.unblock.set()
+        self.runfolder_svc = RunfolderService({
+            "monitored_directories": self.tree.monitored_directories,
+            "scan_workers": 2,
+            "scan_root_timeout_seconds": 0.2,
+            "scan_root_failure_threshold": 3,
+        }, logger)
+        self._read_runfolder = self.runfolder_svc._read_runfolder
+        self.runfolder_svc._read_runfolder = self._blocking_read_runfolder
+        self._subdirectories = self.runfolder_svc._subdirectories
+        self.runfolder_svc._subdirectories = self._blocking_subdirectories
+
+    def tearDown(self):
+        self.unblock.set()
+        self.tree.cleanup()
+
+    def _blocking_read_runfolder(self, path, *args, **kwargs):
+        if path == self.hung:
+            self.unblock.wait(5)
+        return self._read_runfolder(path, *args, **kwargs)
+
+    def _blocking_subdirectories(self, path):
+        if path == self.tree.monitored_directories[0] and self.hang_listing:
+            self.unblock.wait(5)
+        return self._subdirectories(path)
+
+    def _list(self):
+        started = time.time()
+        paths = [info.path for info in self.runfolder_svc.list_runfolders(State.READY)]
+        self.assertLess(time.time() - started, 2)
+        return paths
+
+    def _assert_healthy_directory_unaffected(self):
+        mon1, mon2 = self.tree.monitored_directories
+        self.assertEqual(self.runfolder_svc.stale_directories(), [mon1])
+        status = dict((health["path"], health) for health in self.runfolder_svc.monitored_directory_status())
+        self.assertEqual(status[mon1]["circuit"], OPEN)
+        self.assertEqual(status[mon2]["circuit"], CLOSED)
+        self.assertEqual(status[mon2]["consecutive_failures"], 0)
+
+    def test_hung_reads_only_affect_their_directory(self):
+        self.hang_listing = False
+        self.assertEqual(self._list(), [self.hung, self.healthy])
+
+        self.unblock.clear()
+        for _ in range(5):
+            self.assertEqual(self._list(), [self.hung, self.healthy])
+        self._assert_healthy_directory_unaffected()
+
+    def test_hung_listings_only_affect_their_directory(self):
+        self.hang_listing = False
+        self.assertEqual(self._list(), [self.hung, self.healthy])
+
+        self.hang_listing = True
+        self.unblock.clear()
+        for _ in range(5):
+            self.assertEqual(self._list(), [self.hung, self.healthy])
+        self._assert_healthy_directory_unaffected()
+
+
+class NestedRunfolderServiceParallelHealthTestCase(unittest.TestCase):
+    """Shows that a nested monitored directory that hangs doesn't take the walk threads of the others"""
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.hung = [self.tree.create_runfolder(os.path.join(group, "runfolder_hung")) for group in ("a", "b")]
+        self.healthy = [self.tree.create_runfolder(os.path.join(group, "runfolder_healthy"), monitored_index=1)
+                        for group in ("a", "b")]
+        self.unblock = threading.Event()
+        self.unblock.set()
+        self.runfolder_svc = RunfolderService({
+            "monitored_directories": self.tree.monitored_directories,
+            "monitored_directory_depth": 2,
+            "scan_workers": 2,
+            "scan_root_timeout_seconds": 0.2,
+            "scan_root_failure_threshold": 3,
+        }, logger)
+        self._scandir = os.scandir
+
+    def tearDown(self):
+        self.unblock.set()
+        self.tree.cleanup()
+
+    def _blocking_scandir(self, path):
+        # Only the levels below the monitored directory hang, which are listed in the walk threads
+        if os.path.dirname(path) == self.tree.monitored_directories[0]:
+            self.unblock.wait(5)
+        return self._scandir(path)
+
+    def _list(self):
+        started = time.time()
+        paths = [info.path for info in self.runfolder_svc.list_runfolders(State.READY)]
+        self.assertLess(time.time() - started, 2)
+        return paths
+
+    def test_hung_walks_only_affect_their_directory(self):
+        mon1, mon2 = self.tree.monitored_directories
+        self.assertEqual(self._list(), self.hung + self.healthy)
+
+        self.unblock.clear()
+        with mock.patch("os.scandir", self._blocking_scandir):
+            for _ in range(5):
+                self.assertEqual(self._list(), self.hung + self.healthy)
+        self.assertEqual(self.runfolder_svc.stale_directories(), [mon1])
+        status = dict((health["path"], health) for health in self.runfolder_svc.monitored_directory_status())
+        self.assertEqual(status[mon1]["circuit"], OPEN)
+        self.assertEqual(status[mon2]["circuit"], CLOSED)
+        self.assertEqual(status[mon2]["consecutive_failures"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
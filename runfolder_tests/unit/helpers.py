@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import time
+
+
+RUN_PARAMETERS_TEMPLATE = """<?xml version="1.0"?>
+<RunParameters>
+  <{id_key}>{instrument_id}</{id_key}>
+  <ReagentKitBarcode>AB1234567-123V1</ReagentKitBarcode>
+  <RfidsInfo>
+    <LibraryTubeSerialBarcode>NV0012345-LIB</LibraryTubeSerialBarcode>
+  </RfidsInfo>
+</RunParameters>
+"""
+
+
+class RunfolderTree:
+    """Creates monitored directories with runfolders in a temporary directory"""
+
+    def __init__(self, monitored=("mon1",)):
+        self.root = tempfile.mkdtemp()
+        self.monitored_directories = []
+        for name in monitored:
+            path = os.path.join(self.root, name)
+            os.mkdir(path)
+            self.monitored_directories.append(path)
+
+    def cleanup(self):
+        shutil.rmtree(self.root)
+
+    def create_runfolder(self, name, monitored_index=0, instrument_id="M04499", id_key="ScannerID",
+                         marker="RTAComplete.txt", marker_age=None, state=None):
+        """
+        Creates a runfolder with a runParameters.xml and, unless marker is None, a completed
+        marker that was last modified marker_age seconds ago.
+        """
+        path = os.path.join(self.monitored_directories[monitored_index], name)
+        os.makedirs(path)
+        with open(os.path.join(path, "runParameters.xml"), "w") as f:
+            f.write(RUN_PARAMETERS_TEMPLATE.format(id_key=id_key, instrument_id=instrument_id))
+        if marker:
+            self.add_marker(path, marker, marker_age)
+        if state:
+            self.set_state(path, state)
+        return path
+
+    @staticmethod
+    def add_marker(path, marker="RTAComplete.txt", marker_age=None):
+        marker_path = os.path.join(path, marker)
+        open(marker_path, "a").close()
+        if marker_age is not None:
+            modified = time.time() - marker_age
+            os.utime(marker_path, (modified, modified))
+
+    @staticmethod
+    def set_state(path, state):
+        state_dir = os.path.join(path, ".arteria")
+        if not os.path.isdir(state_dir):
+            os.mkdir(state_dir)
+        with open(os.path.join(state_dir, "state"), "w") as f:
+            f.write(state)
+
+
+def wait_for(predicate, timeout=5, interval=0.05):
+    """Waits until predicate returns True, returning False if it didn't within timeout seconds"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return predicate()
@@ -0,0 +1,212 @@
+import unittest
+import logging
+import os
+
+import mock
+
+from arteria.web.state import State
+
+from runfolder.lib.index import RunfolderIndex
+from runfolder.services import RunfolderService
+from runfolder_tests.unit.helpers import RUN_PARAMETERS_TEMPLATE, RunfolderTree, wait_for
+
+
+logger = logging.getLogger(__name__)
+
+
+class RunfolderIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.configuration_svc = {
+            "monitored_directories": self.tree.monitored_directories,
+            "completed_marker_grace_minutes": 0
+        }
+        self.runfolder_svc = RunfolderService(self.configuration_svc, logger)
+        self.index = None
+
+    def tearDown(self):
+        if self.index:
+            self.index.stop()
+        self.tree.cleanup()
+
+    def _start_index(self, use_inotify=False):
+        self.index = RunfolderIndex(self.runfolder_svc, reconcile_interval=3600,
+                                    use_inotify=use_inotify, logger=logger)
+        self.runfolder_svc._index = self.index
+        self.index.start()
+
+    def _paths(self, state=None):
+        return [info.path for info in self.index.runfolders(state)]
+
+    def test_lists_runfolders_by_state(self):
+        ready = self.tree.create_runfolder("runfolder_ready")
+        started = self.tree.create_runfolder("runfolder_started", monitored_index=1, state=State.STARTED)
+        not_ready = self.tree.create_runfolder("runfolder_none", marker=None)
+        self._start_index()
+
+        self.assertEqual(self._paths(State.READY), [ready])
+        self.assertEqual(self._paths(State.STARTED), [started])
+        self.assertEqual(self._paths(State.NONE), [not_ready])
+        self.assertEqual(self._paths(), sorted([ready, started, not_ready]))
+
+        runfolders = list(self.runfolder_svc.list_runfolders(State.READY))
+        self.assertEqual([info.path for info in runfolders], [ready])
+        self.assertEqual(runfolders[0].metadata["reagent_kit_barcode"], "AB1234567-123V1")
+
+    def test_does_not_scan_on_queries(self):
+        self.tree.create_runfolder("runfolder_ready")
+        self._start_index()
+
+        with mock.patch.object(self.runfolder_svc, "_runfolder_candidates") as candidates:
+            self.assertIsNotNone(self.runfolder_svc.next_runfolder())
+            list(self.runfolder_svc.list_runfolders(None))
+            self.assertFalse(candidates.called)
+
+    def test_set_state_updates_index(self):
+        path = self.tree.create_runfolder("runfolder_ready")
+        self._start_index()
+
+        self.runfolder_svc.set_runfolder_state(path, State.STARTED)
+        self.assertEqual(self._paths(State.READY), [])
+        self.assertEqual(self._paths(State.STARTED), [path])
+
+    def test_version_changes_with_runfolders(self):
+        path = self.tree.create_runfolder("runfolder_ready")
+        self._start_index()
+        version = self.index.version
+
+        self.index.reconcile()
+        self.assertEqual(self.index.version, version)
+
+        self.runfolder_svc.set_runfolder_state(path, State.STARTED)
+        self.assertNotEqual(self.index.version, version)
+        version = self.index.version
+
+        self.tree.create_runfolder("runfolder_new")
+        self.index.reconcile()
+        self.assertNotEqual(self.index.version, version)
+        self.assertEqual(self.runfolder_svc.listing_version(), self.index.version)
+
+    def test_returned_infos_can_not_change_index(self):
+        path = self.tree.create_runfolder("runfolder_ready")
+        self._start_index()
+
+        info = next(self.index.runfolders(State.READY))
+        with self.assertRaises(AttributeError):
+            info.state = State.PENDING
+        info.replace(state=State.PENDING)
+        self.assertEqual(self._paths(State.READY), [path])
+
+    def test_reconcile_picks_up_changes(self):
+        first = self.tree.create_runfolder("runfolder_1")
+        self._start_index()
+
+        second = self.tree.create_runfolder("runfolder_2", monitored_index=1)
+        self.tree.set_state(first, State.DONE)
+        self.index.reconcile()
+
+        self.assertEqual(self._paths(State.READY), [second])
+        self.assertEqual(self._paths(State.DONE), [first])
+
+        os.rename(second, second + "_moved")
+        self.index.reconcile()
+        self.assertEqual(self._paths(State.READY), [second + "_moved"])
+
+    def test_marker_within_grace_period_becomes_ready(self):
+        self.configuration_svc["completed_marker_grace_minutes"] = 1
+        path = self.tree.create_runfolder("runfolder_1", marker_age=59.5)
+        self._start_index()
+
+        self.assertEqual(self._paths(State.NONE), [path])
+        self.assertTrue(wait_for(lambda: self._paths(State.READY) == [path], timeout=3))
+
+    def test_marker_added_after_start_becomes_ready_at_end_of_grace_period(self):
+        self.configuration_svc["completed_marker_grace_minutes"] = 1
+        path = self.tree.create_runfolder("runfolder_1", marker=None)
+        self._start_index()
+
+        self.tree.add_marker(path, marker_age=59.5)
+        self.index.refresh(path)
+        self.assertEqual(self._paths(State.NONE), [path])
+        self.assertIsNotNone(self.index._grace_scheduler.deadline(path))
+        self.assertTrue(wait_for(lambda: self._paths(State.READY) == [path], timeout=3))
+        self.assertNotIn(path, self.index._grace_scheduler)
+
+    def test_queries_do_not_check_marker_age(self):
+        self.configuration_svc["completed_marker_grace_minutes"] = 1
+        self.tree.create_runfolder("runfolder_1", marker_age=30)
+        self._start_index()
+
+        with mock.patch.object(self.runfolder_svc, "_runfolder_info_and_deadline") as read:
+            self.assertEqual(len(self._paths(State.NONE)), 1)
+            self.assertEqual(self.index.counts(), {State.NONE: 1})
+            self.assertFalse(read.called)
+
+    def test_transition_out_of_grace_period_is_published_without_queries(self):
+        self.configuration_svc["completed_marker_grace_minutes"] = 1
+        path = self.tree.create_runfolder("runfolder_1", marker_age=59.5)
+        self._start_index()
+
+        events = self.runfolder_svc.events
+        self.assertTrue(wait_for(lambda: events.last_sequence == 1, timeout=3))
+        event = events.since(0)[0][0]
+        self.assertEqual((event.path, event.previous_state, event.state), (path, State.NONE, State.READY))
+
+    def test_set_state_is_published_once(self):
+        path = self.tree.create_runfolder("runfolder_ready")
+        self._start_index()
+
+        self.runfolder_svc.set_runfolder_state(path, State.STARTED)
+        found, _ = self.runfolder_svc.events.since(0)
+        self.assertEqual([(event.previous_state, event.state) for event in found], [(State.READY, State.STARTED)])
+
+    def test_inotify_keeps_index_current(self):
+        self._start_index(use_inotify=True)
+        if not self.index._inotify:
+            self.skipTest("inotify is not available")
+
+        path = self.tree.create_runfolder("runfolder_1", marker=None)
+        self.assertTrue(wait_for(lambda: self._paths(State.NONE) == [path]))
+
+        self.tree.add_marker(path)
+        self.assertTrue(wait_for(lambda: self._paths(State.READY) == [path]))
+
+        self.tree.set_state(path, State.DONE)
+        self.assertTrue(wait_for(lambda: self._paths(State.DONE) == [path]))
+
+        os.rename(path, path + "_moved")
+        self.assertTrue(wait_for(lambda: self._paths() == [path + "_moved"]))
+
+    def test_malformed_run_parameters_only_leave_out_that_runfolder(self):
+        ready = self.tree.create_runfolder("runfolder_ready")
+        truncated = self.tree.create_runfolder("runfolder_truncated")
+        with open(os.path.join(truncated, "runParameters.xml"), "w") as f:
+            f.write('<?xml version="1.0"?>\n<RunParameters>\n  <ScannerID>M04')
+        self._start_index()
+        self.assertEqual(self._paths(), [ready])
+
+        with open(os.path.join(truncated, "runParameters.xml"), "w") as f:
+            f.write(RUN_PARAMETERS_TEMPLATE.format(id_key="ScannerID", instrument_id="M04499"))
+        self.index.reconcile()
+        self.assertEqual(self._paths(State.READY), [ready, truncated])
+
+    def test_directory_becomes_runfolder_when_required_file_is_added(self):
+        self.runfolder_svc = RunfolderService(dict(self.configuration_svc, runfolder_exclude=["*.tmp"],
+                                                   runfolder_required_files=["RunInfo.xml"]), logger)
+        self.tree.create_runfolder("runfolder_1.tmp")
+        path = self.tree.create_runfolder("runfolder_2")
+        self._start_index()
+        self.assertEqual(self._paths(), [])
+
+        open(os.path.join(path, "RunInfo.xml"), "w").close()
+        self.index.refresh(path)
+        self.assertEqual(self._paths(), [path])
+
+        os.remove(os.path.join(path, "RunInfo.xml"))
+        self.index.reconcile()
+        self.assertEqual(self._paths(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
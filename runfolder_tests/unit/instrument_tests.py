@@ -1,9 +1,11 @@
 import unittest
 import logging
-import mock
 
+from arteria.web.state import State
 
-from runfolder.lib.instrument import InstrumentFactory, Instrument
+from runfolder.lib.instrument import InstrumentFactory, InstrumentRegistry, Instrument, MiSeq, NovaSeq
+from runfolder.services import ConfigurationError, RunfolderService
+from runfolder_tests.unit.helpers import RunfolderTree
 
 
 logger = logging.getLogger(__name__)
@@ -81,5 +83,68 @@ class InstrumentTestCase(unittest.TestCase):
         self.assertEqual(i.completed_marker_file(), 'RTAComplete.txt')
 
 
+class InstrumentRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = InstrumentRegistry()
+
+    def test_instances_are_shared(self):
+        first = self.registry.get_instrument_by_id("M04499")
+        self.assertIsInstance(first, MiSeq)
+        self.assertIs(self.registry.get_instrument_by_id("M04499"), first)
+        self.assertIs(self.registry.get_instrument_by_id("M00001"), first)
+        self.assertIs(self.registry.get_instrument_by_id("foo"), self.registry.get_instrument_by_id("bar"))
+
+    def test_register_from_config(self):
+        self.registry.register_from_config([
+            {"name": "NextSeq2000", "id_pattern": "^VH", "completed_marker_file": "CopyComplete.txt"},
+            {"name": "MiniSeq", "id_pattern": "^MN"},
+        ])
+
+        instrument = self.registry.get_instrument({"RunParameters": {"InstrumentId": "VH00123"}})
+        self.assertEqual(instrument.__class__.__name__, "NextSeq2000")
+        self.assertEqual(instrument.completed_marker_file(), "CopyComplete.txt")
+        # Configured instruments are matched before the supported ones
+        instrument = self.registry.get_instrument_by_id("MN00123")
+        self.assertEqual(instrument.__class__.__name__, "MiniSeq")
+        self.assertEqual(instrument.completed_marker_file(), "RTAComplete.txt")
+        self.assertIsInstance(self.registry.get_instrument_by_id("M00123"), MiSeq)
+        self.assertIsInstance(self.registry.get_instrument_by_id("A00123"), NovaSeq)
+
+    def test_register_replaces_remembered_ids(self):
+        self.assertIsInstance(self.registry.get_instrument_by_id("VH00123"), Instrument)
+        self.registry.register_from_config([{"name": "NextSeq2000", "id_pattern": "^VH"}])
+        self.assertEqual(self.registry.get_instrument_by_id("VH00123").__class__.__name__, "NextSeq2000")
+
+        self.registry.register_from_config([{"name": "NextSeq2000", "id_pattern": "^VL"}])
+        self.assertEqual(self.registry.get_instrument_by_id("VH00123").__class__, Instrument)
+
+    def test_completed_marker_files(self):
+        self.assertEqual(self.registry.completed_marker_files(), {"RTAComplete.txt", "CopyComplete.txt"})
+        self.registry.register_from_config([{"name": "Other", "id_pattern": "^O",
+                                             "completed_marker_file": "Done.txt"}])
+        self.assertIn("Done.txt", self.registry.completed_marker_files())
+
+    def test_service_uses_configured_marker(self):
+        tree = RunfolderTree()
+        self.addCleanup(tree.cleanup)
+        path = tree.create_runfolder("runfolder_1", instrument_id="VH00123", marker="RTAComplete.txt")
+        config = {"monitored_directories": tree.monitored_directories,
+                  "instruments": [{"name": "NextSeq2000", "id_pattern": "^VH",
+                                   "completed_marker_file": "CopyComplete.txt"}]}
+        runfolder_svc = RunfolderService(config, logger)
+        self.assertEqual(runfolder_svc.get_runfolder_state(path), State.NONE)
+
+        tree.add_marker(path, "CopyComplete.txt")
+        self.assertEqual(runfolder_svc.get_runfolder_state(path), State.READY)
+
+    def test_invalid_config(self):
+        for instruments in [[{"name": "NoPattern"}], [{"name": "BadPattern", "id_pattern": "("}], ["VH"]]:
+            with self.assertRaises(ValueError):
+                InstrumentRegistry().register_from_config(instruments)
+            with self.assertRaises(ConfigurationError):
+                RunfolderService({"instruments": instruments}, logger)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,116 @@
+import logging
+import unittest
+
+from arteria.web.state import State
+
+from runfolder.lib.metrics import MetricsRegistry
+from runfolder.lib import metrics
+from runfolder.services import RunfolderService
+from runfolder_tests.unit.helpers import RunfolderTree
+
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter("requests_total", "Number of requests", ["handler"])
+        counter.inc(handler="list")
+        counter.inc(2, handler="list")
+        counter.inc(handler='say "hi"')
+
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines, ['# HELP requests_total Number of requests',
+                                 '# TYPE requests_total counter',
+                                 'requests_total{handler="list"} 3',
+                                 'requests_total{handler="say \\"hi\\""} 1'])
+
+    def test_counter_requires_its_labels(self):
+        counter = self.registry.counter("requests_total", "Number of requests", ["handler"])
+        with self.assertRaises(ValueError):
+            counter.inc(root="/mon1")
+
+    def test_registering_twice_returns_the_same_metric(self):
+        counter = self.registry.counter("requests_total", "Number of requests")
+        self.assertIs(self.registry.counter("requests_total", "Number of requests"), counter)
+        with self.assertRaises(ValueError):
+            self.registry.gauge("requests_total", "Number of requests")
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("scan_seconds", "Time to scan", ["root"], buckets=(0.1, 1))
+        histogram.observe(0.05, root="/mon1")
+        histogram.observe(0.5, root="/mon1")
+        histogram.observe(5, root="/mon1")
+
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[2:], ['scan_seconds_bucket{root="/mon1",le="0.1"} 1',
+                                     'scan_seconds_bucket{root="/mon1",le="1"} 2',
+                                     'scan_seconds_bucket{root="/mon1",le="+Inf"} 3',
+                                     'scan_seconds_sum{root="/mon1"} 5.55',
+                                     'scan_seconds_count{root="/mon1"} 3'])
+
+    def test_callback(self):
+        counts = {State.READY: 2}
+        self.registry.callback("runfolders", "Runfolders per state", "gauge",
+                               lambda: dict(((state,), count) for state, count in counts.items()),
+                               ["state"])
+        counts[State.DONE] = 1
+
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[1:], ['# TYPE runfolders gauge',
+                                     'runfolders{state="done"} 1',
+                                     'runfolders{state="ready"} 2'])
+
+    def test_timed(self):
+        histogram = self.registry.histogram("call_seconds", "Time of calls", ["name"])
+
+        class Service:
+            @metrics.timed(histogram, name=lambda name: name)
+            def call(self, name):
+                return name.upper()
+
+        self.assertEqual(Service().call("a"), "A")
+        self.assertIn('call_seconds_count{name="a"} 1', self.registry.render())
+
+
+class ServiceMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = RunfolderTree()
+        self.tree.create_runfolder("runfolder_1")
+        self.tree.create_runfolder("runfolder_2", state=State.DONE)
+        self.runfolder_svc = RunfolderService({"monitored_directories": self.tree.monitored_directories},
+                                              logger)
+        self.runfolder_svc.start()
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def test_scan_metrics(self):
+        root = self.tree.monitored_directories[0]
+        list(self.runfolder_svc.list_runfolders(None))
+        list(self.runfolder_svc.list_runfolders(None))
+
+        self.assertEqual(self.runfolder_svc.runfolder_counts(), {State.READY: 1, State.DONE: 1})
+        rendered = metrics.registry.render()
+        self.assertIn('runfolder_runfolders{state="ready"} 1', rendered)
+        self.assertIn('runfolder_list_monitored_directory_seconds_count{{root="{0}"}}'.format(root),
+                      rendered)
+        self.assertIn('runfolder_read_runfolder_seconds_count{{root="{0}"}}'.format(root), rendered)
+        cache = self.runfolder_svc._run_parameters_cache
+        self.assertGreater(cache.hits, 0)
+        self.assertIn("runfolder_run_parameters_cache_hits_total {0}\n".format(cache.hits), rendered)
+        self.assertIn("runfolder_run_parameters_cache_misses_total 2\n", rendered)
+
+    def test_filtered_listing_does_not_change_counts(self):
+        list(self.runfolder_svc.list_runfolders(None))
+        list(self.runfolder_svc.list_runfolders(State.READY))
+        self.assertEqual(self.runfolder_svc.runfolder_counts(), {State.READY: 1, State.DONE: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
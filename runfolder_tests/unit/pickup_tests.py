@@ -0,0 +1,143 @@
+import unittest
+import logging
+import os
+import threading
+import time
+
+import mock
+
+from arteria.web.state import State
+
+from runfolder.services import RunfolderService
+from runfolder_tests.unit.helpers import RunfolderTree
+
+
+logger = logging.getLogger(__name__)
+
+
+class PickupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.configuration_svc = {"monitored_directories": self.tree.monitored_directories}
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def _runfolder_svc(self):
+        return RunfolderService(self.configuration_svc, logger)
+
+    def test_pickup_sets_pending(self):
+        path = self.tree.create_runfolder("runfolder_1")
+        runfolder_svc = self._runfolder_svc()
+
+        runfolder = runfolder_svc.pickup_runfolder()
+        self.assertEqual(runfolder.path, path)
+        self.assertEqual(runfolder.state, State.PENDING)
+        self.assertEqual(runfolder_svc.get_runfolder_state(path), State.PENDING)
+        self.assertFalse(os.path.exists(os.path.join(path, ".arteria", "claim")))
+        self.assertIsNone(runfolder_svc.pickup_runfolder())
+
+    def test_concurrent_pickups_hand_out_each_runfolder_once(self):
+        paths = [self.tree.create_runfolder("runfolder_{0:02d}".format(i), monitored_index=i % 2)
+                 for i in range(20)]
+        # Two services stand in for two processes sharing the file system
+        services = [self._runfolder_svc(), self._runfolder_svc()]
+        picked = []
+        lock = threading.Lock()
+
+        def picker(runfolder_svc):
+            while True:
+                runfolder = runfolder_svc.pickup_runfolder()
+                if runfolder is None:
+                    return
+                with lock:
+                    picked.append(runfolder.path)
+
+        threads = [threading.Thread(target=picker, args=(services[i % 2],)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(picked), sorted(paths))
+
+    def test_pickup_refills_queue_only_when_empty(self):
+        for i in range(3):
+            self.tree.create_runfolder("runfolder_{0}".format(i))
+        runfolder_svc = self._runfolder_svc()
+
+        with mock.patch.object(runfolder_svc, "list_runfolders",
+                               wraps=runfolder_svc.list_runfolders) as list_runfolders:
+            for i in range(3):
+                self.assertIsNotNone(runfolder_svc.pickup_runfolder())
+            self.assertEqual(list_runfolders.call_count, 1)
+
+    def test_pickup_skips_runfolders_changed_since_queued(self):
+        first = self.tree.create_runfolder("runfolder_1")
+        second = self.tree.create_runfolder("runfolder_2")
+        runfolder_svc = self._runfolder_svc()
+        runfolder_svc._ready_queue.extend(runfolder_svc.list_runfolders(State.READY))
+
+        self.tree.set_state(first, State.STARTED)
+        self.assertEqual(runfolder_svc.pickup_runfolder().path, second)
+
+    def test_claimed_runfolder_is_skipped(self):
+        first = self.tree.create_runfolder("runfolder_1")
+        second = self.tree.create_runfolder("runfolder_2")
+        runfolder_svc = self._runfolder_svc()
+        self.assertTrue(runfolder_svc._claim(first))
+
+        self.assertEqual(runfolder_svc.pickup_runfolder().path, second)
+        self.assertEqual(runfolder_svc.get_runfolder_state(first), State.READY)
+
+    def test_pickup_gives_up_on_runfolders_claimed_by_others(self):
+        path = self.tree.create_runfolder("runfolder_1")
+        runfolder_svc = self._runfolder_svc()
+        self.assertTrue(runfolder_svc._claim(path))
+
+        with mock.patch.object(runfolder_svc, "list_runfolders",
+                               wraps=runfolder_svc.list_runfolders) as list_runfolders:
+            self.assertIsNone(runfolder_svc.pickup_runfolder())
+            # Once to find it, and once more to find that there's nothing else
+            self.assertEqual(list_runfolders.call_count, 2)
+        self.assertEqual(runfolder_svc.get_runfolder_state(path), State.READY)
+
+    def test_pickup_refreshes_index_that_lists_runfolder_no_longer_ready(self):
+        path = self.tree.create_runfolder("runfolder_1")
+        # Without inotify, the index only sees the state set below when it's refreshed
+        self.configuration_svc["runfolder_index_use_inotify"] = False
+        runfolder_svc = self._runfolder_svc()
+        runfolder_svc.start(index_enabled=True)
+        try:
+            self.tree.set_state(path, State.STARTED)
+            self.assertEqual([info.path for info in runfolder_svc.list_runfolders(State.READY)], [path])
+
+            self.assertIsNone(runfolder_svc.pickup_runfolder())
+            self.assertEqual([info.path for info in runfolder_svc.list_runfolders(State.STARTED)], [path])
+        finally:
+            runfolder_svc._index.stop()
+
+    def test_renewed_claim_is_not_broken(self):
+        path = self.tree.create_runfolder("runfolder_1")
+        runfolder_svc = self._runfolder_svc()
+        self.assertTrue(runfolder_svc._claim(path))
+        claim_file = os.path.join(path, ".arteria", "claim")
+
+        self.assertFalse(runfolder_svc._break_stale_claim(claim_file))
+        self.assertTrue(os.path.exists(claim_file))
+        self.assertEqual(os.listdir(os.path.dirname(claim_file)), ["claim"])
+
+    def test_stale_claim_is_broken(self):
+        path = self.tree.create_runfolder("runfolder_1")
+        runfolder_svc = self._runfolder_svc()
+        self.assertTrue(runfolder_svc._claim(path))
+        claim_file = os.path.join(path, ".arteria", "claim")
+        stale = time.time() - RunfolderService.STALE_CLAIM_SECONDS - 1
+        os.utime(claim_file, (stale, stale))
+
+        self.assertEqual(runfolder_svc.pickup_runfolder().path, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from runfolder.lib.roots import MonitoredRoots
+
+
+class MonitoredRootsTestCase(unittest.TestCase):
+
+    def test_runfolders_are_directly_in_a_root_by_default(self):
+        roots = MonitoredRoots(["/data/mon1", "/data/mon2"])
+        self.assertEqual(roots.root_of("/data/mon1/runfolder"), "/data/mon1")
+        self.assertEqual(roots.root_of("/data/mon2/runfolder"), "/data/mon2")
+        self.assertIsNone(roots.root_of("/data/mon1"))
+        self.assertIsNone(roots.root_of("/data/mon1/2020/runfolder"))
+        self.assertIsNone(roots.root_of("/data/mon3/runfolder"))
+        self.assertIsNone(roots.root_of("/data/mon10/runfolder"))
+        self.assertIsNone(roots.root_of("data/mon1/runfolder"))
+
+    def test_runfolders_are_up_to_depth_levels_below_a_root(self):
+        roots = MonitoredRoots(["/data/mon1"], depth=3)
+        self.assertEqual(roots.root_of("/data/mon1/runfolder"), "/data/mon1")
+        self.assertEqual(roots.root_of("/data/mon1/2020/NovaSeq/runfolder"), "/data/mon1")
+        self.assertIsNone(roots.root_of("/data/mon1/2020/NovaSeq/runfolder/Data"))
+
+    def test_paths_leaving_the_root_are_not_monitored(self):
+        roots = MonitoredRoots(["/data/mon1"], depth=2)
+        self.assertIsNone(roots.root_of("/data/mon1/../runfolder"))
+        self.assertIsNone(roots.root_of("/data/mon1/./runfolder"))
+        self.assertIsNone(roots.root_of("/data/mon1//runfolder"))
+        self.assertFalse(roots.is_monitored("/data/mon1/2020/.."))
+
+    def test_runfolder_belongs_to_the_deepest_root(self):
+        roots = MonitoredRoots(["/data", "/data/mon1"], depth=2)
+        self.assertEqual(roots.root_of("/data/mon1/runfolder"), "/data/mon1")
+        self.assertEqual(roots.root_of("/data/mon2/runfolder"), "/data")
+        self.assertIsNone(roots.root_of("/data/mon1/2020/NovaSeq/runfolder"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import unittest
+import logging
+import os
+import shutil
+import tempfile
+
+import mock
+
+from xml.parsers.expat import ExpatError
+
+from runfolder.lib.instrument import InstrumentFactory
+from runfolder.lib.run_parameters import RunParametersCache, extract_run_parameters, parse_run_parameters
+from runfolder.services import RunfolderService
+from runfolder_tests.benchmarks.synthetic import RUN_PARAMETERS, run_parameters
+
+
+logger = logging.getLogger(__name__)
+
+
+class RunParametersCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_run_parameters(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_parses_file_once_while_unchanged(self):
+        path = self._write_run_parameters("runParameters.xml",
+                                          "<RunParameters><ScannerID>M1</ScannerID></RunParameters>")
+        parser = mock.MagicMock(side_effect=parse_run_parameters)
+        cache = RunParametersCache(parser=parser)
+
+        first = cache.get(path)
+        second = cache.get(path)
+
+        self.assertEqual(first['RunParameters']['ScannerID'], 'M1')
+        self.assertIs(first, second)
+        self.assertEqual(parser.call_count, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_reparses_changed_file(self):
+        path = self._write_run_parameters("runParameters.xml",
+                                          "<RunParameters><ScannerID>M1</ScannerID></RunParameters>")
+        cache = RunParametersCache()
+        cache.get(path)
+
+        self._write_run_parameters("runParameters.xml",
+                                   "<RunParameters><ScannerID>M1234</ScannerID></RunParameters>")
+        self.assertEqual(cache.get(path)['RunParameters']['ScannerID'], 'M1234')
+
+    def test_evicts_least_recently_used(self):
+        paths = [self._write_run_parameters("run{}.xml".format(i), "<RunParameters/>")
+                 for i in range(3)]
+        parser = mock.MagicMock(side_effect=parse_run_parameters)
+        cache = RunParametersCache(max_entries=2, parser=parser)
+
+        cache.get(paths[0])
+        cache.get(paths[1])
+        cache.get(paths[0])
+        cache.get(paths[2])
+        self.assertEqual(len(cache), 2)
+
+        # paths[1] was the least recently used, so it has to be parsed again
+        cache.get(paths[0])
+        cache.get(paths[1])
+        self.assertEqual(parser.call_count, 4)
+
+    def test_invalidate(self):
+        path = self._write_run_parameters("runParameters.xml", "<RunParameters/>")
+        parser = mock.MagicMock(side_effect=parse_run_parameters)
+        cache = RunParametersCache(parser=parser)
+
+        cache.get(path)
+        cache.invalidate(path)
+        cache.get(path)
+        self.assertEqual(parser.call_count, 2)
+
+    def test_missing_file_raises(self):
+        cache = RunParametersCache()
+        with self.assertRaises(FileNotFoundError):
+            cache.get(os.path.join(self.tmp_dir, "runParameters.xml"))
+
+    def test_service_reads_either_file_name(self):
+        runfolder_svc = RunfolderService(dict(), logger)
+        self.assertIsNone(runfolder_svc.read_run_parameters(self.tmp_dir))
+
+        self._write_run_parameters("RunParameters.xml",
+                                   "<RunParameters><InstrumentName>A1</InstrumentName></RunParameters>")
+        run_parameters = runfolder_svc.read_run_parameters(self.tmp_dir)
+        self.assertEqual(run_parameters['RunParameters']['InstrumentName'], 'A1')
+
+
+class ExtractRunParametersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "runParameters.xml")
+        self.runfolder_svc = RunfolderService(dict(), logger)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+
+    def test_same_results_as_full_parse(self):
+        for instrument in RUN_PARAMETERS:
+            self._write(run_parameters(instrument, "{0}_id".format(instrument.__name__), "1234567"))
+            full = parse_run_parameters(self.path)
+            extracted = extract_run_parameters(self.path)
+
+            self.assertEqual(InstrumentFactory.get_id(extracted), InstrumentFactory.get_id(full))
+            self.assertEqual(self.runfolder_svc.get_reagent_kit_barcode(self.path, extracted),
+                             self.runfolder_svc.get_reagent_kit_barcode(self.path, full))
+            self.assertEqual(self.runfolder_svc.get_library_tube_barcode(self.path, extracted),
+                             self.runfolder_svc.get_library_tube_barcode(self.path, full))
+
+    def test_only_fields_are_extracted(self):
+        self._write("""<?xml version="1.0"?>
+            <RunParameters xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+              <Setup><ScannerID> D00123 </ScannerID><Other>1</Other></Setup>
+              <Reads><Read><ScannerID>not this one</ScannerID></Read></Reads>
+              <RfidsInfo><LibraryTubeSerialBarcode>NV1-LIB</LibraryTubeSerialBarcode></RfidsInfo>
+              <ReagentKitBarcode/>
+            </RunParameters>""")
+        self.assertEqual(extract_run_parameters(self.path),
+                         {"RunParameters": {"Setup": {"ScannerID": "D00123"},
+                                            "RfidsInfo": {"LibraryTubeSerialBarcode": "NV1-LIB"},
+                                            "ReagentKitBarcode": None}})
+
+    def test_single_consumable_is_a_list(self):
+        self._write("""<RunParameters><ConsumableInfo><ConsumableInfo>
+            <SerialNumber>LC1-LIB</SerialNumber><Type>SampleTube</Type>
+            </ConsumableInfo></ConsumableInfo></RunParameters>""")
+        extracted = extract_run_parameters(self.path)
+        self.assertEqual(extracted["RunParameters"]["ConsumableInfo"]["ConsumableInfo"],
+                         [{"SerialNumber": "LC1-LIB", "Type": "SampleTube"}])
+        self.assertEqual(self.runfolder_svc.get_library_tube_barcode(self.path, extracted), "LC1-LIB")
+
+    def test_malformed_file_raises(self):
+        self._write("<RunParameters><Setup></RunParameters>")
+        with self.assertRaises(ExpatError):
+            extract_run_parameters(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
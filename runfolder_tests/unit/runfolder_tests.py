@@ -1,10 +1,20 @@
+import json
+import os
+import shutil
 import unittest
 import logging
+import threading
+import time
 import mock
+import tornado.escape
 
 from arteria.web.state import State
 
-from runfolder.services import RunfolderService
+from runfolder.lib.filters import RunfolderFilter
+from runfolder.lib.scanner import RunfolderEntries
+from runfolder.services import ConfigurationError, DirectoryDoesNotExist, InvalidStateUpdates, PathNotMonitored, \
+    RunfolderInfo, RunfolderService
+from runfolder_tests.unit.helpers import RunfolderTree
 
 
 logger = logging.getLogger(__name__)
@@ -12,15 +22,11 @@ logger = logging.getLogger(__name__)
 class RunfolderServiceTestCase(unittest.TestCase):
 
     def _valid_runfolder(self, path):
-        if path.endswith("RTAComplete.txt"):
-            return True
-        elif path.endswith(".arteria/state"):
-            return False
-        else:
-            raise Exception("Unexpected path")
-
-    def _is_older_wrapper(self, path, age):
-        return self._valid_runfolder(path)
+        # A runfolder with an old RTAComplete.txt and no .arteria/state
+        marker = mock.Mock(path=path + "/RTAComplete.txt")
+        marker.is_file.return_value = True
+        marker.stat.return_value = mock.Mock(st_mtime=0)
+        return RunfolderEntries(path, {"RTAComplete.txt": marker})
 
     def test_list_available_runfolders(self):
         # Setup
@@ -32,8 +38,7 @@ class RunfolderServiceTestCase(unittest.TestCase):
         }
         runfolder_svc = RunfolderService(configuration_svc, logger)
 
-        runfolder_svc._file_exists = self._valid_runfolder
-        runfolder_svc._file_exists_and_is_older_than = self._is_older_wrapper
+        runfolder_svc._runfolder_entries = self._valid_runfolder
         runfolder_svc._subdirectories = lambda path: ["runfolder001"]
         runfolder_svc._host = lambda: "localhost"
 
@@ -57,8 +62,7 @@ class RunfolderServiceTestCase(unittest.TestCase):
 
         # Since keys in configuration_svc can be directly indexed, we can mock it with a dict:
         runfolder_svc = RunfolderService(configuration_svc, logger)
-        runfolder_svc._file_exists = self._valid_runfolder
-        runfolder_svc._file_exists_and_is_older_than = self._is_older_wrapper
+        runfolder_svc._runfolder_entries = self._valid_runfolder
         runfolder_svc._subdirectories = lambda path: ["runfolder001"]
         runfolder_svc._host = lambda: "localhost"
 
@@ -67,6 +71,66 @@ class RunfolderServiceTestCase(unittest.TestCase):
         expected = "ready: /data/testarteria1/mon1/runfolder001@localhost"
         self.assertEqual(str(runfolder), expected)
 
+    def test_list_runfolders_ordered_by_path_after(self):
+        # Setup
+        configuration_svc = {
+            "monitored_directories": [
+                "/data/testarteria1/mon2",
+                "/data/testarteria1/mon1"
+            ]
+        }
+        runfolder_svc = RunfolderService(configuration_svc, logger)
+
+        runfolder_svc._runfolder_entries = self._valid_runfolder
+        runfolder_svc._subdirectories = lambda path: ["runfolder002", "runfolder001"]
+        runfolder_svc._host = lambda: "localhost"
+
+        # Test
+        runfolders = runfolder_svc.list_runfolders(State.READY,
+                                                   after="/data/testarteria1/mon1/runfolder001")
+        paths = [runfolder.path for runfolder in runfolders]
+        self.assertEqual(paths, ["/data/testarteria1/mon1/runfolder002",
+                                 "/data/testarteria1/mon2/runfolder001",
+                                 "/data/testarteria1/mon2/runfolder002"])
+
+    def _parallel_runfolder_svc(self, subdirectories, scan_root_timeout_seconds=None):
+        configuration_svc = {
+            "monitored_directories": [
+                "/data/testarteria1/mon1",
+                "/data/testarteria1/mon2"
+            ],
+            "scan_workers": 4,
+            "scan_root_timeout_seconds": scan_root_timeout_seconds
+        }
+        runfolder_svc = RunfolderService(configuration_svc, logger)
+        runfolder_svc._runfolder_entries = self._valid_runfolder
+        runfolder_svc._subdirectories = subdirectories
+        runfolder_svc._host = lambda: "localhost"
+        return runfolder_svc
+
+    def test_parallel_scan_is_ordered_by_path(self):
+        names = ["runfolder{0:03d}".format(i) for i in range(20, 0, -1)]
+        runfolder_svc = self._parallel_runfolder_svc(lambda path: names)
+
+        paths = [runfolder.path for runfolder in runfolder_svc.list_runfolders(State.READY)]
+        self.assertEqual(len(paths), 40)
+        self.assertEqual(paths, sorted(paths))
+
+    def test_parallel_scan_skips_hung_monitored_directory(self):
+        unblock = threading.Event()
+
+        def subdirectories(path):
+            if path.endswith("mon1"):
+                unblock.wait(5)
+            return ["runfolder001"]
+        runfolder_svc = self._parallel_runfolder_svc(subdirectories, scan_root_timeout_seconds=0.2)
+
+        started = time.time()
+        runfolders = [str(runfolder) for runfolder in runfolder_svc.list_runfolders(State.READY)]
+        unblock.set()
+        self.assertLess(time.time() - started, 2)
+        self.assertEqual(runfolders, ["ready: /data/testarteria1/mon2/runfolder001@localhost"])
+
     def test_monitored_directory_validates(self):
         configuration_svc = dict()
         configuration_svc["monitored_directories"] = ["/data/testarteria1/runfolders"]
@@ -165,5 +229,360 @@ class RunfolderServiceTestCase(unittest.TestCase):
             metadata_dict = runfolder_svc.get_metadata('/path/to/runfolder/')
             self.assertEqual(metadata_dict, {})
 
+class LazyEnumerationTestCase(unittest.TestCase):
+    """
+    Counts the runParameters.xml files parsed when looking for the next runfolder, to
+    show that the cost depends on the runfolders inspected rather than on all of them
+    """
+
+    def setUp(self):
+        self.tree = RunfolderTree()
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def _create_runfolders(self, count, ready_index):
+        for i in range(count):
+            name = "runfolder_{0:05d}".format(i)
+            if i == ready_index:
+                self.tree.create_runfolder(name)
+            elif i % 2:
+                self.tree.create_runfolder(name, state=State.DONE)
+            else:
+                self.tree.create_runfolder(name, marker=None)
+
+    def _parsed_files(self, action):
+        runfolder_svc = RunfolderService({"monitored_directories": self.tree.monitored_directories}, logger)
+        result = action(runfolder_svc)
+        return result, runfolder_svc._run_parameters_cache.misses
+
+    def test_next_runfolder_only_parses_ready_runfolder(self):
+        for count in (10, 200):
+            self.tree.cleanup()
+            self.tree = RunfolderTree()
+            self._create_runfolders(count, ready_index=count - 1)
+
+            runfolder, parsed = self._parsed_files(lambda svc: svc.next_runfolder())
+            self.assertTrue(runfolder.path.endswith("runfolder_{0:05d}".format(count - 1)))
+            self.assertEqual(parsed, 1)
+
+    def test_listing_by_state_only_parses_matching_runfolders(self):
+        self._create_runfolders(20, ready_index=4)
+
+        # The metadata of the done runfolders, and the instrument of the ready runfolder,
+        # to know which completed marker it should have
+        runfolders, parsed = self._parsed_files(lambda svc: list(svc.list_runfolders(State.DONE)))
+        self.assertEqual(len(runfolders), 10)
+        self.assertEqual(parsed, 11)
+
+        runfolders, parsed = self._parsed_files(lambda svc: list(svc.list_runfolders(None)))
+        self.assertEqual(len(runfolders), 20)
+        self.assertEqual(parsed, 20)
+
+
+class FilteredEnumerationTestCase(unittest.TestCase):
+    """Shows that runfolders that don't match the filters aren't read further than needed"""
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.novaseq = self.tree.create_runfolder("200101_A00123_0001_AH1", instrument_id="A00123",
+                                                  marker="CopyComplete.txt", marker_age=7200)
+        self.miseq = self.tree.create_runfolder("200102_M04499_0002_000", marker_age=60)
+        self.unfinished = self.tree.create_runfolder("200103_M04499_0003_000", marker=None)
+        self.done = self.tree.create_runfolder("200104_M04499_0004_000", monitored_index=1, marker_age=7200,
+                                               state=State.DONE)
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def _list(self, filters, state=None, config=None):
+        configuration_svc = {"monitored_directories": self.tree.monitored_directories}
+        configuration_svc.update(config or {})
+        runfolder_svc = RunfolderService(configuration_svc, logger)
+        runfolder_svc.start()
+        try:
+            with mock.patch.object(runfolder_svc, "get_metadata", wraps=runfolder_svc.get_metadata) as get_metadata:
+                paths = [info.path for info in runfolder_svc.list_runfolders(state, filters=filters)]
+                return paths, runfolder_svc._run_parameters_cache.misses, \
+                    [call[0][0] for call in get_metadata.call_args_list]
+        finally:
+            if runfolder_svc._index:
+                runfolder_svc._index.stop()
+
+    def test_root_and_glob_filters_read_only_matching_runfolders(self):
+        paths, parsed, _ = self._list(RunfolderFilter(roots=[self.tree.monitored_directories[1]]))
+        self.assertEqual((paths, parsed), ([self.done], 1))
+
+        paths, parsed, _ = self._list(RunfolderFilter(glob="*_0002_*"))
+        self.assertEqual((paths, parsed), ([self.miseq], 1))
+
+    def test_metadata_is_only_built_for_matching_runfolders(self):
+        paths, _, metadata_read = self._list(RunfolderFilter(instruments=["novaseq"]))
+        self.assertEqual(paths, [self.novaseq])
+        self.assertEqual(metadata_read, [self.novaseq])
+
+        paths, _, metadata_read = self._list(RunfolderFilter(max_marker_age=3600))
+        self.assertEqual(paths, [self.miseq])
+        self.assertEqual(metadata_read, [self.miseq])
+
+        paths, _, _ = self._list(RunfolderFilter(min_marker_age=3600, instruments=["MiSeq", "NovaSeq"]),
+                                 state=State.READY)
+        self.assertEqual(paths, [self.novaseq])
+
+    def test_indexed_runfolders_are_filtered(self):
+        config = {"runfolder_index_enabled": True, "runfolder_index_use_inotify": False}
+        paths, _, _ = self._list(RunfolderFilter(roots=[self.tree.monitored_directories[0]],
+                                                 instruments=["MiSeq"]), config=config)
+        self.assertEqual(paths, [self.miseq, self.unfinished])
+
+    def test_unmonitored_root_is_rejected(self):
+        runfolder_svc = RunfolderService({"monitored_directories": self.tree.monitored_directories}, logger)
+        with self.assertRaises(PathNotMonitored):
+            runfolder_svc.list_runfolders(None, filters=RunfolderFilter(roots=["/not/monitored"]))
+
+
+class RunfolderStatesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = RunfolderTree()
+        self.runfolder_svc = RunfolderService({"monitored_directories": self.tree.monitored_directories}, logger)
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def _states(self, paths):
+        return [self.runfolder_svc.get_runfolder_state(path) for path in paths]
+
+    def test_sets_states_of_all_runfolders(self):
+        paths = [self.tree.create_runfolder("runfolder_{0}".format(i)) for i in range(20)]
+        updates = [(path, State.DONE if i % 2 else State.ERROR) for i, path in enumerate(paths)]
+
+        self.assertEqual(self.runfolder_svc.set_runfolder_states(updates), [None] * 20)
+        self.assertEqual(self._states(paths), [state for _, state in updates])
+        self.assertEqual(os.listdir(os.path.join(paths[0], ".arteria")), ["state"])
+
+    def test_invalid_updates_set_no_states(self):
+        ready = self.tree.create_runfolder("runfolder_ready")
+        other = self.tree.create_runfolder("runfolder_other")
+        missing = os.path.join(self.tree.monitored_directories[0], "missing")
+        updates = [(ready, State.DONE), (other, "archived"), ("/not/monitored", State.DONE),
+                   (missing, State.DONE), (ready, State.ERROR)]
+
+        with self.assertRaises(InvalidStateUpdates) as raised:
+            self.runfolder_svc.set_runfolder_states(updates)
+        errors = raised.exception.errors
+        self.assertIsNone(errors[0])
+        self.assertIn("'archived' is not valid", errors[1])
+        self.assertIn("not being monitored", errors[2])
+        self.assertIn("does not exist", errors[3])
+        self.assertIn("more than once", errors[4])
+        self.assertEqual(self._states([ready, other]), [State.READY, State.READY])
+
+    def test_failed_writes_are_reported(self):
+        paths = [self.tree.create_runfolder("runfolder_{0}".format(i)) for i in range(2)]
+        # A file in the way of the .arteria directory
+        open(os.path.join(paths[1], ".arteria"), "w").close()
+
+        errors = self.runfolder_svc.set_runfolder_states([(path, State.DONE) for path in paths])
+        self.assertIsNone(errors[0])
+        self.assertIsNotNone(errors[1])
+        self.assertEqual(self.runfolder_svc.get_runfolder_state(paths[0]), State.DONE)
+
+
+class StateFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = RunfolderTree()
+        self.path = self.tree.create_runfolder("runfolder_1")
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def _service(self, state_fsync=None):
+        return RunfolderService({"monitored_directories": self.tree.monitored_directories,
+                                 "state_fsync": state_fsync}, logger)
+
+    def _fsync_count(self, state_fsync):
+        runfolder_svc = self._service(state_fsync)
+        with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+            runfolder_svc.set_runfolder_state(self.path, State.STARTED)
+            runfolder_svc.set_runfolder_state(self.path, State.DONE)
+        self.assertEqual(runfolder_svc.get_runfolder_state(self.path), State.DONE)
+        return fsync.call_count
+
+    def test_fsync_policies(self):
+        self.assertEqual(self._fsync_count("none"), 0)
+        self.assertEqual(self._fsync_count("file"), 2)
+        # The runfolder directory is also flushed when .arteria is created
+        shutil.rmtree(os.path.join(self.path, ".arteria"))
+        self.assertEqual(self._fsync_count("directory"), 5)
+        self.assertEqual(self._fsync_count(None), 2)
+
+    def test_unknown_fsync_policy_is_rejected(self):
+        with self.assertRaises(ConfigurationError):
+            self._service("always")
+
+    def test_readers_never_see_partial_state(self):
+        runfolder_svc = self._service("none")
+        runfolder_svc.set_runfolder_state(self.path, State.STARTED)
+        writing = threading.Event()
+        writing.set()
+
+        def write():
+            while writing.is_set():
+                for state in (State.DONE, State.STARTED):
+                    runfolder_svc.set_runfolder_state(self.path, state)
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            states = set(runfolder_svc.get_runfolder_state(self.path) for _ in range(2000))
+        finally:
+            writing.clear()
+            writer.join()
+        self.assertTrue(states <= {State.STARTED, State.DONE}, states)
+        self.assertEqual(os.listdir(os.path.join(self.path, ".arteria")), ["state"])
+
+
+class NestedMonitoredDirectoryTestCase(unittest.TestCase):
+    """Runfolders in an archive organized as <year>/<instrument>/<runfolder>"""
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.nested = self.tree.create_runfolder(os.path.join("2020", "NovaSeq", "runfolder_nested"))
+        self.top = self.tree.create_runfolder("runfolder_top", monitored_index=1, state=State.DONE)
+        self.runfolder_svc = RunfolderService({
+            "monitored_directories": self.tree.monitored_directories,
+            "monitored_directory_depth": 3,
+            "scan_workers": 2,
+            "runfolder_index_use_inotify": False,
+        }, logger)
+
+    def tearDown(self):
+        if self.runfolder_svc._index:
+            self.runfolder_svc._index.stop()
+        self.tree.cleanup()
+
+    def _paths(self, state=None, filters=None):
+        return [info.path for info in self.runfolder_svc.list_runfolders(state, filters=filters)]
+
+    def test_lists_nested_runfolders(self):
+        self.assertEqual(self._paths(), [self.nested, self.top])
+        self.assertEqual(self._paths(State.READY), [self.nested])
+        self.assertEqual(self._paths(filters=RunfolderFilter(roots=[self.tree.monitored_directories[0]])),
+                         [self.nested])
+
+    def test_nested_runfolders_are_indexed(self):
+        self.runfolder_svc.start(index_enabled=True)
+        self.assertEqual(self._paths(), [self.nested, self.top])
+
+        shutil.rmtree(self.top)
+        self.runfolder_svc._index.reconcile()
+        self.assertEqual(self._paths(), [self.nested])
+
+    def test_state_can_be_set_on_nested_runfolders(self):
+        self.runfolder_svc.set_runfolder_state(self.nested, State.STARTED)
+        self.assertEqual(self.runfolder_svc.get_runfolder_by_path(self.nested).state, State.STARTED)
+
+        too_deep = os.path.join(self.nested, "Data")
+        os.mkdir(too_deep)
+        with self.assertRaises(PathNotMonitored):
+            self.runfolder_svc.get_runfolder_by_path(too_deep)
+        with self.assertRaises(InvalidStateUpdates):
+            self.runfolder_svc.set_runfolder_states([(self.nested, State.DONE), (too_deep, State.DONE)])
+
+    def test_depth_must_be_positive(self):
+        with self.assertRaises(ConfigurationError):
+            RunfolderService({"monitored_directories": [], "monitored_directory_depth": 0}, logger)
+
+
+class RunfolderLookupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.runfolder_svc = RunfolderService({"monitored_directories": self.tree.monitored_directories}, logger)
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def test_looks_up_runfolders_in_order(self):
+        ready = self.tree.create_runfolder("runfolder_ready", monitored_index=1)
+        done = self.tree.create_runfolder("runfolder_done", state=State.DONE)
+        missing = os.path.join(self.tree.monitored_directories[0], "missing")
+
+        with mock.patch.object(self.runfolder_svc, "_monitored_directories",
+                               wraps=self.runfolder_svc._monitored_directories) as monitored:
+            results = self.runfolder_svc.get_runfolders_by_path([ready, "/not/monitored", done, missing, ready])
+            self.assertEqual(monitored.call_count, 1)
+
+        self.assertEqual([(result.path, result.state) for result in (results[0], results[2], results[4])],
+                         [(ready, State.READY), (done, State.DONE), (ready, State.READY)])
+        self.assertEqual(results[2].metadata["reagent_kit_barcode"], "AB1234567-123V1")
+        self.assertIsInstance(results[1], PathNotMonitored)
+        self.assertIsInstance(results[3], DirectoryDoesNotExist)
+
+
+class RunfolderEventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = RunfolderTree()
+        self.runfolder_svc = RunfolderService({"monitored_directories": self.tree.monitored_directories}, logger)
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def _transitions(self):
+        return [(event.path, event.previous_state, event.state) for event in self.runfolder_svc.events.since(0)[0]]
+
+    def test_set_state_is_published(self):
+        path = self.tree.create_runfolder("runfolder_1")
+        self.runfolder_svc.set_runfolder_state(path, State.STARTED)
+        self.runfolder_svc.set_runfolder_state(path, State.DONE)
+        self.assertEqual(self._transitions(), [(path, None, State.STARTED), (path, State.STARTED, State.DONE)])
+
+    def test_transitions_seen_when_listing_are_published(self):
+        path = self.tree.create_runfolder("runfolder_1", marker=None)
+        list(self.runfolder_svc.list_runfolders(None))
+        self.assertEqual(self._transitions(), [])
+
+        self.tree.add_marker(path)
+        self.assertEqual([info.path for info in self.runfolder_svc.list_runfolders(State.READY)], [path])
+        self.assertEqual(self._transitions(), [(path, State.NONE, State.READY)])
+
+
+class RunfolderInfoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.info = RunfolderInfo("host1", "/mon1/runfolder</1", State.READY,
+                                  {"reagent_kit_barcode": "MS1-600V3", "library_tube_barcode": "NV\u00e91"})
+
+    def test_can_not_be_modified(self):
+        with self.assertRaises(AttributeError):
+            self.info.state = State.DONE
+        with self.assertRaises(AttributeError):
+            self.info.other = 1
+
+    def test_replace(self):
+        replaced = self.info.replace(state=State.PENDING, link="http://localhost/runfolder1")
+        self.assertEqual((replaced.state, replaced.link), (State.PENDING, "http://localhost/runfolder1"))
+        self.assertEqual((self.info.state, self.info.link), (State.READY, None))
+        self.assertEqual(replaced.path, self.info.path)
+        self.assertEqual(replaced.service_version, self.info.service_version)
+
+    def test_to_json_is_the_same_as_the_generic_encoder(self):
+        for info in [self.info, self.info.replace(link="http://localhost/runfolder1"),
+                     self.info.replace(metadata=dict())]:
+            self.assertEqual(info.to_json(), tornado.escape.json_encode(info.to_dict()))
+            self.assertEqual(json.loads(info.to_json()), info.to_dict())
+        self.assertEqual(self.info.to_json(link="http://localhost/runfolder1"),
+                         self.info.replace(link="http://localhost/runfolder1").to_json())
+
+    def test_to_json_with_fields(self):
+        self.assertEqual(json.loads(self.info.to_json(fields={"state", "path"})),
+                         {"path": self.info.path, "state": State.READY})
+        self.assertEqual(json.loads(self.info.to_json(link="http://localhost/runfolder1", fields={"metadata", "link"})),
+                         {"metadata": self.info.metadata, "link": "http://localhost/runfolder1"})
+        self.assertNotIn("</", self.info.to_json(fields={"path"}))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,233 @@
+import builtins
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import os
+import unittest
+
+import mock
+
+from arteria.web.state import State
+
+from runfolder.lib.scanner import CandidateMatcher, RunfolderEntries, find_runfolders, subdirectories
+from runfolder.services import ConfigurationError, RunfolderService
+from runfolder_tests.unit.helpers import RunfolderTree
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyscallCounter:
+    """
+    Counts the file system calls made through the os module and open, including the
+    stat of os.DirEntry objects returned by os.scandir, which is cached by each entry
+    """
+
+    PATCHED = ["stat", "lstat", "listdir", "access"]
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def total(self):
+        return sum(self.counts.values())
+
+    @contextlib.contextmanager
+    def patch(self):
+        counter = self
+        real_scandir = os.scandir
+        real_open = builtins.open
+
+        class CountingDirEntry:
+            def __init__(self, entry):
+                self._entry = entry
+                self._stat = None
+                self.name = entry.name
+                self.path = entry.path
+
+            def is_dir(self, **kwargs):
+                return self._entry.is_dir(**kwargs)
+
+            def is_file(self, **kwargs):
+                return self._entry.is_file(**kwargs)
+
+            def stat(self, **kwargs):
+                if self._stat is None:
+                    counter.counts["DirEntry.stat"] += 1
+                    self._stat = self._entry.stat(**kwargs)
+                return self._stat
+
+        class CountingScandirIterator:
+            def __init__(self, iterator):
+                self._iterator = iterator
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self._iterator.close()
+
+            def __iter__(self):
+                return (CountingDirEntry(entry) for entry in self._iterator)
+
+        def scandir(path):
+            counter.counts["scandir"] += 1
+            return CountingScandirIterator(real_scandir(path))
+
+        def counting_open(*args, **kwargs):
+            counter.counts["open"] += 1
+            return real_open(*args, **kwargs)
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch("os.scandir", scandir))
+            stack.enter_context(mock.patch("builtins.open", counting_open))
+            for name in self.PATCHED:
+                real = getattr(os, name)
+
+                def counting(*args, _name=name, _real=real, **kwargs):
+                    counter.counts[_name] += 1
+                    return _real(*args, **kwargs)
+                stack.enter_context(mock.patch("os." + name, counting))
+            yield self
+
+
+class ScannerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = RunfolderTree()
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def test_subdirectories_skips_other_entries(self):
+        root = self.tree.monitored_directories[0]
+        self.tree.create_runfolder("runfolder_1")
+        open(os.path.join(root, "notes.txt"), "w").close()
+        os.symlink("/does/not/exist", os.path.join(root, "broken_link"))
+
+        self.assertEqual(subdirectories(root), ["runfolder_1"])
+
+    def test_subdirectories_skips_entries_that_are_not_candidates(self):
+        root = self.tree.monitored_directories[0]
+        self.tree.create_runfolder("200624_M04499_0001_000000000-J6BKD")
+        self.tree.create_runfolder("200624_M04499_0002_000000000-J6BKD.tmp")
+        os.mkdir(os.path.join(root, "lost+found"))
+        os.mkdir(os.path.join(root, "200625_M04499_0003_000000000-J6BKD"))
+        matcher = CandidateMatcher(name_pattern=r"^\d{6}_", exclude=["*.tmp"],
+                                   required_files=["runParameters.xml", "RunParameters.xml"])
+
+        self.assertEqual(subdirectories(root, matcher), ["200624_M04499_0001_000000000-J6BKD"])
+
+    def test_candidate_names_are_matched_without_system_calls(self):
+        root = self.tree.monitored_directories[0]
+        for i in range(10):
+            os.mkdir(os.path.join(root, "transfer_{0}".format(i)))
+        self.tree.create_runfolder("runfolder_1")
+        matcher = CandidateMatcher(include=["runfolder_*"], required_files=["runParameters.xml"])
+
+        with SyscallCounter().patch() as counter:
+            self.assertEqual(subdirectories(root, matcher), ["runfolder_1"])
+        self.assertEqual(counter.counts["stat"], 1)
+
+    def test_candidate_matcher_without_rules_matches_everything(self):
+        matcher = CandidateMatcher()
+        self.assertTrue(matcher.matches_name("lost+found"))
+        self.assertTrue(matcher.has_required_file("/does/not/exist"))
+
+    def test_invalid_name_pattern_is_a_configuration_error(self):
+        with self.assertRaises(ConfigurationError):
+            RunfolderService({"runfolder_name_pattern": "(unclosed"}, logger)
+        with self.assertRaises(ConfigurationError):
+            RunfolderService({"runfolder_required_files": {"runParameters.xml": True}}, logger)
+
+    def test_find_runfolders_stops_descending_at_runfolders(self):
+        root = self.tree.monitored_directories[0]
+        top = self.tree.create_runfolder("runfolder_top")
+        os.mkdir(os.path.join(top, "Data"))
+        nested = self.tree.create_runfolder(os.path.join("2020", "NovaSeq", "runfolder_nested"))
+        without_parameters = os.path.join(root, "2020", "MiSeq", "runfolder_new")
+        os.makedirs(without_parameters)
+        os.makedirs(os.path.join(root, "2021", "NovaSeq", "runfolder_too_deep", "Data"))
+        os.makedirs(os.path.join(root, "lost+found", "MiSeq", "runfolder_lost"))
+        matcher = CandidateMatcher(exclude=["lost+found"])
+
+        self.assertEqual(sorted(find_runfolders(root, 3, matcher, ["runParameters.xml"])),
+                         sorted([nested, without_parameters, top,
+                                 os.path.join(root, "2021", "NovaSeq", "runfolder_too_deep")]))
+        self.assertEqual(sorted(find_runfolders(root, 1, matcher, ["runParameters.xml"])),
+                         [os.path.join(root, "2020"), os.path.join(root, "2021"), top])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            self.assertEqual(sorted(find_runfolders(root, 3, matcher, ["runParameters.xml"], executor)),
+                             sorted(find_runfolders(root, 3, matcher, ["runParameters.xml"])))
+
+    def test_find_runfolders_fails_if_root_can_not_be_listed(self):
+        with self.assertRaises(FileNotFoundError):
+            find_runfolders(os.path.join(self.tree.root, "missing"), 2)
+
+    def test_runfolder_entries(self):
+        path = self.tree.create_runfolder("runfolder_1", marker_age=120, state=State.DONE)
+        entries = RunfolderEntries.read(path)
+
+        self.assertTrue(entries.has_file("runParameters.xml"))
+        self.assertFalse(entries.has_file("RunParameters.xml"))
+        self.assertTrue(entries.has_dir(".arteria"))
+        self.assertFalse(entries.has_file(".arteria"))
+        self.assertTrue(entries.is_older_than("RTAComplete.txt", 1))
+        self.assertFalse(entries.is_older_than("RTAComplete.txt", 3))
+        self.assertIsNone(entries.modification_time("CopyComplete.txt"))
+
+    def test_missing_runfolder_has_no_entries(self):
+        runfolder_svc = RunfolderService(dict(), logger)
+        path = os.path.join(self.tree.monitored_directories[0], "missing")
+        self.assertEqual(runfolder_svc.get_runfolder_state(path), State.NONE)
+
+
+class SyscallBenchmarkTestCase(unittest.TestCase):
+    """Counts the file system calls needed to list runfolders once run parameters are cached"""
+
+    RUNFOLDERS = 30
+
+    def setUp(self):
+        self.tree = RunfolderTree()
+        for i in range(self.RUNFOLDERS):
+            name = "runfolder_{0:03d}".format(i)
+            if i % 3 == 0:
+                self.tree.create_runfolder(name)
+            elif i % 3 == 1:
+                self.tree.create_runfolder(name, state=State.STARTED)
+            else:
+                self.tree.create_runfolder(name, marker=None)
+        open(os.path.join(self.tree.monitored_directories[0], "not_a_runfolder.txt"), "w").close()
+
+        configuration_svc = {"monitored_directories": self.tree.monitored_directories}
+        self.runfolder_svc = RunfolderService(configuration_svc, logger)
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def test_syscalls_per_runfolder(self):
+        # Warm up the run parameters cache
+        self.assertEqual(len(list(self.runfolder_svc.list_runfolders(None))), self.RUNFOLDERS)
+
+        with SyscallCounter().patch() as counter:
+            runfolders = list(self.runfolder_svc.list_runfolders(None))
+        self.assertEqual(len(runfolders), self.RUNFOLDERS)
+
+        per_runfolder = float(counter.total() - 1) / self.RUNFOLDERS
+        logger.info("{0:.2f} file system calls per runfolder: {1}".format(per_runfolder, dict(counter.counts)))
+
+        # One directory read per runfolder, plus one for the monitored directory
+        self.assertEqual(counter.counts["scandir"], self.RUNFOLDERS + 1)
+        # Only runfolders with a .arteria directory have their state file opened
+        self.assertEqual(counter.counts["open"], self.RUNFOLDERS // 3)
+        self.assertEqual(counter.counts["listdir"] + counter.counts["access"] + counter.counts["lstat"], 0)
+        # The stat of runParameters.xml is shared by the state and metadata lookups and
+        # the marker is only stat'ed for runfolders without a state file
+        self.assertLessEqual(counter.counts["DirEntry.stat"] + counter.counts["stat"],
+                             self.RUNFOLDERS + self.RUNFOLDERS // 3)
+        self.assertLessEqual(per_runfolder, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
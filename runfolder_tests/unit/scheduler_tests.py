@@ -0,0 +1,46 @@
+import unittest
+
+from runfolder.lib.scheduler import GraceScheduler
+
+
+class GraceSchedulerTestCase(unittest.TestCase):
+
+    def test_pops_due_runfolders_in_order_once(self):
+        scheduler = GraceScheduler()
+        scheduler.schedule("/mon/b", 20)
+        scheduler.schedule("/mon/a", 10)
+        scheduler.schedule("/mon/c", 30)
+
+        self.assertEqual(scheduler.next_deadline(), 10)
+        self.assertEqual(scheduler.pop_due(5), [])
+        self.assertEqual(scheduler.pop_due(20), [("/mon/a", 10), ("/mon/b", 20)])
+        self.assertEqual(scheduler.pop_due(20), [])
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.next_deadline(), 30)
+
+    def test_rescheduling_replaces_deadline(self):
+        scheduler = GraceScheduler()
+        scheduler.schedule("/mon/a", 10)
+        scheduler.schedule("/mon/a", 40)
+        scheduler.schedule("/mon/a", 10)
+        scheduler.schedule("/mon/a", 25)
+
+        self.assertEqual(scheduler.next_deadline(), 25)
+        self.assertEqual(scheduler.deadline("/mon/a"), 25)
+        self.assertEqual(scheduler.pop_due(100), [("/mon/a", 25)])
+        self.assertIsNone(scheduler.next_deadline())
+
+    def test_cancelled_runfolders_are_not_due(self):
+        scheduler = GraceScheduler()
+        for i in range(200):
+            scheduler.schedule("/mon/{0}".format(i), i)
+        for i in range(199):
+            scheduler.cancel("/mon/{0}".format(i))
+
+        self.assertNotIn("/mon/0", scheduler)
+        self.assertEqual(scheduler.pop_due(1000), [("/mon/199", 199)])
+        self.assertEqual(len(scheduler._heap), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
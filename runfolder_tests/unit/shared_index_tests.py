@@ -0,0 +1,141 @@
+import unittest
+import logging
+import os
+import shutil
+
+import tornado.testing
+
+from arteria.web.state import State
+
+from runfolder.lib.shared_index import SharedDatabase, SharedEventLog
+from runfolder.services import RunfolderService
+from runfolder_tests.unit.helpers import RunfolderTree, wait_for
+
+
+logger = logging.getLogger(__name__)
+
+
+class SharedIndexTestCase(unittest.TestCase):
+    """Runs a scanner and a worker in the same process, sharing the index through a database"""
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.database_path = os.path.join(self.tree.root, "shared", "shared_index.sqlite")
+        configuration_svc = {
+            "monitored_directories": self.tree.monitored_directories,
+            "completed_marker_grace_minutes": 0,
+            "runfolder_index_reconcile_interval_seconds": 3600,
+            "runfolder_index_use_inotify": False,
+        }
+        self.scanner = RunfolderService(configuration_svc, logger)
+        self.worker = RunfolderService(configuration_svc, logger)
+
+    def tearDown(self):
+        if self.scanner._shared_index_writer:
+            self.scanner._shared_index_writer.stop()
+        if self.scanner._index:
+            self.scanner._index.stop()
+        self.tree.cleanup()
+
+    def _start(self):
+        self.scanner.start_scanner(self.database_path)
+        self.worker.start_worker(self.database_path)
+
+    def _paths(self, runfolder_svc, state=None):
+        return [info.path for info in runfolder_svc.list_runfolders(state)]
+
+    def test_worker_lists_runfolders_of_scanner(self):
+        ready = self.tree.create_runfolder("runfolder_ready")
+        started = self.tree.create_runfolder("runfolder_started", monitored_index=1, state=State.STARTED)
+        self._start()
+
+        self.assertEqual(self._paths(self.worker, State.READY), [ready])
+        self.assertEqual(self._paths(self.worker), sorted([ready, started]))
+        runfolder = list(self.worker.list_runfolders(State.READY))[0]
+        self.assertEqual(runfolder.metadata["reagent_kit_barcode"], "AB1234567-123V1")
+
+    def test_state_set_in_worker_is_seen_in_next_request(self):
+        path = self.tree.create_runfolder("runfolder_ready")
+        self._start()
+        version = self.worker.listing_version()
+
+        self.worker.set_runfolder_state(path, State.STARTED)
+        self.assertEqual(self._paths(self.worker, State.READY), [])
+        self.assertEqual(self._paths(self.worker, State.STARTED), [path])
+        self.assertNotEqual(self.worker.listing_version(), version)
+
+        events, _ = self.worker.events.since(0)
+        self.assertEqual([(event.path, event.previous_state, event.state) for event in events],
+                         [(path, State.READY, State.STARTED)])
+
+    def test_state_set_in_scanner_is_seen_by_worker(self):
+        path = self.tree.create_runfolder("runfolder_ready")
+        self._start()
+
+        self.scanner.set_runfolder_state(path, State.PENDING)
+        self.assertEqual(self._paths(self.worker, State.PENDING), [path])
+
+    def test_removed_runfolder_is_dropped(self):
+        path = self.tree.create_runfolder("runfolder_ready")
+        self._start()
+        self.assertEqual(self._paths(self.worker), [path])
+
+        shutil.rmtree(path)
+        self.scanner._index.reconcile()
+        self.assertTrue(wait_for(lambda: self._paths(self.worker) == []))
+
+    def test_worker_reports_health_seen_by_scanner(self):
+        self._start()
+        mon2 = self.tree.monitored_directories[1]
+        self.scanner._directory_health.record_failure(mon2, "timed out")
+
+        self.assertEqual(self.worker.stale_directories(), [mon2])
+        status = self.worker.monitored_directory_status()
+        self.assertEqual([(health["path"], health["stale"]) for health in status],
+                         [(self.tree.monitored_directories[0], False), (mon2, True)])
+
+
+class SharedEventLogTestCase(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(SharedEventLogTestCase, self).setUp()
+        self.tree = RunfolderTree()
+        self.database = SharedDatabase(os.path.join(self.tree.root, "shared_index.sqlite"))
+        self.database.create()
+
+    def tearDown(self):
+        self.tree.cleanup()
+        super(SharedEventLogTestCase, self).tearDown()
+
+    def test_created_database_is_not_ready(self):
+        self.database.set_meta("ready", "1")
+        SharedDatabase(self.database.path).create()
+        self.assertIsNone(self.database.meta("ready"))
+
+    def test_only_the_publisher_writes_events(self):
+        publisher = SharedEventLog(self.database, capacity=2, publisher=True)
+        reader = SharedEventLog(self.database)
+        self.assertIsNone(reader.publish("/mon/a", State.NONE, State.READY))
+        for state in (State.READY, State.PENDING, State.STARTED):
+            publisher.publish("/mon/a", None, state)
+
+        found, missed = reader.since(0)
+        self.assertEqual([event.sequence for event in found], [2, 3])
+        self.assertTrue(missed)
+        self.assertEqual(reader.since(3), ([], False))
+        self.assertEqual(reader.last_sequence, 3)
+
+    @tornado.testing.gen_test
+    def test_readers_are_woken_by_published_events(self):
+        publisher = SharedEventLog(self.database, publisher=True)
+        reader = SharedEventLog(self.database)
+        waiting = reader.wait(0)
+        self.assertFalse(waiting.done())
+
+        publisher.publish("/mon/a", State.NONE, State.READY)
+        yield waiting
+        self.assertEqual(len(reader.since(0)[0]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
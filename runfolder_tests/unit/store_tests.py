@@ -0,0 +1,193 @@
+import unittest
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+
+from arteria.web.state import State
+
+from runfolder.lib.store import RunfolderRecord, RunfolderStore
+from runfolder.services import RunfolderService
+from runfolder_tests.unit.helpers import RunfolderTree
+
+
+logger = logging.getLogger(__name__)
+
+
+def age(path, seconds=3600):
+    """Moves the modification times of a runfolder and its state file seconds back"""
+    modified = time.time() - seconds
+    for changed in (os.path.join(path, ".arteria", "state"), path):
+        if os.path.exists(changed):
+            os.utime(changed, (modified, modified))
+
+
+class RunfolderStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _record(self, path, state=State.DONE):
+        return RunfolderRecord(path, state, 1, True, 2, None, "MiSeq", {"reagent_kit_barcode": "AB1"})
+
+    def test_records_survive_reopening(self):
+        store = RunfolderStore(self.directory, "config", logger=logger)
+        store.open()
+        store.put(self._record("/mon/a"))
+        store.put(self._record("/mon/b"))
+        store.remove("/mon/b")
+        store.close()
+
+        store = RunfolderStore(self.directory, "config", logger=logger)
+        store.open()
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get("/mon/a"), self._record("/mon/a"))
+        self.assertIsNone(store.get("/mon/b"))
+        store.close()
+
+    def test_records_of_another_config_are_discarded(self):
+        store = RunfolderStore(self.directory, "config", logger=logger)
+        store.open()
+        store.put(self._record("/mon/a"))
+        store.close()
+
+        store = RunfolderStore(self.directory, "other config", logger=logger)
+        store.open()
+        self.assertEqual(len(store), 0)
+        store.close()
+
+    def test_retain_removes_other_records(self):
+        store = RunfolderStore(self.directory, logger=logger)
+        store.open()
+        store.put(self._record("/mon/a"))
+        store.put(self._record("/mon/b"))
+        store.retain(["/mon/b"])
+        store.close()
+
+        store = RunfolderStore(self.directory, logger=logger)
+        store.open()
+        self.assertIsNone(store.get("/mon/a"))
+        self.assertIsNotNone(store.get("/mon/b"))
+        store.close()
+
+
+class RunfolderServiceStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = RunfolderTree(monitored=("mon1", "mon2"))
+        self.store_dir = os.path.join(self.tree.root, "store")
+        self.services = []
+
+    def tearDown(self):
+        for runfolder_svc in self.services:
+            runfolder_svc._store.close()
+        self.tree.cleanup()
+
+    def _start_service(self, grace_minutes=10):
+        runfolder_svc = RunfolderService({
+            "monitored_directories": self.tree.monitored_directories,
+            "completed_marker_grace_minutes": grace_minutes,
+            "runfolder_store_dir": self.store_dir,
+        }, logger)
+        runfolder_svc.start()
+        self.services.append(runfolder_svc)
+        return runfolder_svc
+
+    def _restart_service(self, grace_minutes=10):
+        self.services[-1]._store.close()
+        return self._start_service(grace_minutes)
+
+    def _create_runfolder(self, name, **kwargs):
+        kwargs.setdefault("marker_age", 3600)
+        path = self.tree.create_runfolder(name, **kwargs)
+        age(path)
+        return path
+
+    def _paths(self, runfolder_svc, state=None):
+        return [info.path for info in runfolder_svc.list_runfolders(state)]
+
+    def test_restarted_service_lists_from_store(self):
+        ready = self._create_runfolder("runfolder_ready")
+        done = self._create_runfolder("runfolder_done", monitored_index=1, state=State.DONE)
+        self.assertEqual(self._paths(self._start_service(), None), sorted([ready, done]))
+
+        runfolder_svc = self._restart_service()
+        with mock.patch.object(runfolder_svc, "read_run_parameters") as read_run_parameters:
+            runfolders = list(runfolder_svc.list_runfolders(None))
+            self.assertFalse(read_run_parameters.called)
+        self.assertEqual([(info.path, info.state) for info in runfolders],
+                         [(ready, State.READY), (done, State.DONE)])
+        self.assertEqual(runfolders[1].metadata["reagent_kit_barcode"], "AB1234567-123V1")
+
+    def test_changed_state_is_read_again(self):
+        path = self._create_runfolder("runfolder_ready")
+        self.assertEqual(self._paths(self._start_service(), State.READY), [path])
+
+        RunfolderTree.set_state(path, State.STARTED)
+        runfolder_svc = self._restart_service()
+        self.assertEqual(self._paths(runfolder_svc, State.READY), [])
+        self.assertEqual(self._paths(runfolder_svc, State.STARTED), [path])
+
+    def test_state_set_through_service_is_read_again(self):
+        path = self._create_runfolder("runfolder_ready", state=State.PENDING)
+        runfolder_svc = self._start_service()
+        self.assertEqual(self._paths(runfolder_svc, State.PENDING), [path])
+
+        runfolder_svc.set_runfolder_state(path, State.STARTED)
+        self.assertEqual(self._paths(runfolder_svc, State.STARTED), [path])
+
+    def test_recently_modified_runfolder_is_not_trusted(self):
+        path = self.tree.create_runfolder("runfolder_new", marker=None)
+        runfolder_svc = self._start_service()
+        self.assertEqual(self._paths(runfolder_svc, State.NONE), [path])
+        self.assertIsNone(runfolder_svc._store.get(path).dir_mtime_ns)
+
+        age(path)
+        self.assertEqual(self._paths(runfolder_svc, State.NONE), [path])
+        self.assertIsNotNone(runfolder_svc._store.get(path).dir_mtime_ns)
+
+    def test_runfolder_becomes_ready_after_grace_period(self):
+        path = self._create_runfolder("runfolder_finishing", marker_age=30)
+        runfolder_svc = self._start_service()
+        self.assertEqual(self._paths(runfolder_svc, State.NONE), [path])
+
+        with mock.patch("time.time", return_value=time.time() + 600):
+            self.assertEqual(self._paths(runfolder_svc, State.READY), [path])
+
+    def test_longer_grace_period_discards_stored_ready_states(self):
+        path = self._create_runfolder("runfolder_ready")
+        self.assertEqual(self._paths(self._start_service(), State.READY), [path])
+
+        runfolder_svc = self._restart_service(grace_minutes=120)
+        self.assertEqual(self._paths(runfolder_svc, State.READY), [])
+        self.assertEqual(self._paths(runfolder_svc, State.NONE), [path])
+
+    def test_removed_runfolders_are_dropped(self):
+        kept = self._create_runfolder("runfolder_kept")
+        removed = self._create_runfolder("runfolder_removed")
+        runfolder_svc = self._start_service()
+        self.assertEqual(self._paths(runfolder_svc), [kept, removed])
+
+        shutil.rmtree(removed)
+        self.assertEqual(self._paths(runfolder_svc), [kept])
+        self.assertIsNone(runfolder_svc._store.get(removed))
+
+    def test_metadata_is_only_read_for_listed_state(self):
+        path = self._create_runfolder("runfolder_done", state=State.DONE)
+        runfolder_svc = self._start_service()
+        self.assertEqual(self._paths(runfolder_svc, State.READY), [])
+        self.assertIsNone(runfolder_svc._store.get(path).metadata)
+
+        runfolders = list(runfolder_svc.list_runfolders(State.DONE))
+        self.assertEqual(runfolders[0].metadata["reagent_kit_barcode"], "AB1234567-123V1")
+        self.assertEqual(runfolder_svc._store.get(path).instrument, "MiSeq")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import logging
+import unittest
+
+from arteria.web.state import State
+
+from runfolder.lib.instrument import InstrumentFactory
+from runfolder.services import RunfolderService
+from runfolder_tests.benchmarks.synthetic import SyntheticRunfolderTree, RUN_PARAMETERS, run_parameters
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyntheticRunfolderTreeTestCase(unittest.TestCase):
+    """Checks that the runfolders generated for the benchmarks are seen as intended by the service"""
+
+    def setUp(self):
+        self.tree = SyntheticRunfolderTree(70, grace_minutes=10)
+        config = {"monitored_directories": self.tree.monitored_directories,
+                  "completed_marker_grace_minutes": 10}
+        self.runfolder_svc = RunfolderService(config, logger)
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def test_states(self):
+        states = dict((info.path, info.state) for info in self.runfolder_svc.list_runfolders(None))
+        self.assertEqual(sorted(states), self.tree.paths)
+        for kind, paths in self.tree.paths_by_kind.items():
+            expected = State.NONE if kind in ("sequencing", "in_grace_period") else kind
+            self.assertEqual(set(states[path] for path in paths), {expected}, kind)
+
+    def test_run_parameters_identify_the_instrument(self):
+        for instrument in RUN_PARAMETERS:
+            path = self.tree.paths[0] + "/runParameters.xml"
+            with open(path, "w") as f:
+                f.write(run_parameters(instrument, "{0}_id".format(instrument.__name__), "1234567"))
+            parsed = self.runfolder_svc.read_run_parameters(self.tree.paths[0])
+            self.assertEqual(InstrumentFactory.get_id(parsed), "{0}_id".format(instrument.__name__))
+
+    def test_barcodes(self):
+        metadata = [info.metadata for info in self.runfolder_svc.list_runfolders(None)]
+        self.assertTrue(any("reagent_kit_barcode" in m for m in metadata))
+        self.assertTrue(any(m.get("library_tube_barcode", "").endswith("-LIB") for m in metadata))
+
+
+if __name__ == '__main__':
+    unittest.main()